@@ -1,11 +1,18 @@
 from typing import Callable
 
-from django.contrib import admin
+from django import forms
+from django.contrib import admin, messages
+from django.core.files.storage import default_storage
+from django.db.models import Count, Prefetch, Q, prefetch_related_objects
 from django.urls import reverse
 from django.utils.html import format_html
 from django.utils.safestring import SafeText, mark_safe
 
-from bot.models import PromoGroup, Participant, TelegramUser, TelegramChannel, Topic
+from bot.models import BroadcastRun, Delivery, Profiling, PromoGroup, Participant, TelegramUser, TelegramChannel, Topic
+from bot.promotion.importer import ParticipantImporter
+from bot.promotion.renderer import template_problem
+from bot.utils.cache import chat_cache
+from bot.utils.internal import bot_not_running_protect
 
 
 link_template = '<a href="{link}" target={target}>{text}</a>'
@@ -27,7 +34,40 @@ def model_link(obj: str, text_field: str = None, prefix: str = '', suffix: str =
     return link(url, f'{prefix}{text}{suffix}'.strip())
 
 
-class TelegramUserAdmin(admin.ModelAdmin):
+class PrefetchMixin:
+    """Load the related objects used by the list and detail fields with a fixed number of queries
+
+    `list_prefetch` is applied to the queryset of the changelist and the change view, `detail_prefetch` only to the
+    object of the change view.
+    """
+    list_prefetch = []
+    detail_prefetch = []
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).prefetch_related(*self.list_prefetch)
+
+    def get_object(self, request, object_id, from_field=None):
+        obj = super().get_object(request, object_id, from_field)
+        if obj is not None and self.detail_prefetch:
+            prefetch_related_objects([obj], *self.detail_prefetch)
+        return obj
+
+
+class ChatPrefetchMixin:
+    """Fetch the chat infos of all the chats on a changelist page at once"""
+
+    def get_changelist_instance(self, request):
+        changelist = super().get_changelist_instance(request)
+        self.prefetch_chats([obj.id for obj in changelist.result_list])
+        return changelist
+
+    @staticmethod
+    @bot_not_running_protect
+    def prefetch_chats(ids):
+        chat_cache.prefetch(ids)
+
+
+class TelegramUserAdmin(PrefetchMixin, ChatPrefetchMixin, admin.ModelAdmin):
     fieldsets = (
         ('Infos', {
             'fields': ('id', 'linked_username', 'linked_name', 'affiliated_groups', 'affiliated_channels')
@@ -40,6 +80,12 @@ class TelegramUserAdmin(admin.ModelAdmin):
     readonly_fields = ['id', 'linked_username', 'linked_name', 'affiliated_groups', 'affiliated_channels']
     list_display = ['id', 'linked_username', 'full_name', 'linked_channels', 'current_group__link', 'modified', 'created']
     list_filter = ['channels']
+    list_select_related = ['current_group']
+    list_prefetch = ['channels']
+    detail_prefetch = [
+        'admins_at',
+        Prefetch('channels__participating', queryset=Participant.objects.select_related('promo_group')),
+    ]
 
     def current_group__link(self, obj: TelegramUser) -> SafeText or None:
         if obj.current_group:
@@ -70,7 +116,7 @@ class TelegramUserAdmin(admin.ModelAdmin):
         admins = set(obj.admins_at.all())
 
         final_resultset = []
-        for group in participating | admins:
+        for group in sorted(participating | admins, key=lambda group: group.name):
             addition = []
             if {group} & admins:
                 addition.append('admin')
@@ -103,18 +149,22 @@ class TelegramUserAdmin(admin.ModelAdmin):
 admin.site.register(TelegramUser, TelegramUserAdmin)
 
 
-class TelegramChannelAdmin(admin.ModelAdmin):
+class TelegramChannelAdmin(PrefetchMixin, admin.ModelAdmin):
     fieldsets = (
         ('Infos', {
-            'fields': ('id', 'linked_username', 'linked_title', 'admins', 'linked_admins', 'participating_in')
+            'fields': ('id', 'linked_username', 'linked_title', 'invite_link', 'invite_link_fetched', 'admins',
+                       'linked_admins', 'admins_synced', 'participating_in')
         }),
     )
 
-    readonly_fields = ['id', 'linked_username', 'linked_title', 'participating_in', 'linked_admins']
+    readonly_fields = ['id', 'linked_username', 'linked_title', 'invite_link', 'invite_link_fetched',
+                       'participating_in', 'linked_admins', 'admins_synced']
     list_display = ['id', 'linked_username', 'linked_title', 'linked_admins', 'modified', 'created']
+    list_prefetch = ['admins']
+    detail_prefetch = [Prefetch('participating', queryset=Participant.objects.select_related('promo_group'))]
 
     def url(self, obj: TelegramChannel) -> str:
-        return (obj.chat.link or obj.chat.invite_link) if obj.chat else ''
+        return obj.link or ''
 
     def linked_username(self, obj: TelegramChannel) -> SafeText or str:
         if not obj.username:
@@ -151,7 +201,26 @@ class TelegramChannelAdmin(admin.ModelAdmin):
 admin.site.register(TelegramChannel, TelegramChannelAdmin)
 
 
-class PromoGroupAdmin(admin.ModelAdmin):
+class PromoGroupForm(forms.ModelForm):
+    import_participants = forms.CharField(
+        widget=forms.Textarea(attrs={'rows': 5}), required=False,
+        help_text='@usernames, t.me links or ids of channels to add as participants, one per line. The bot has to be '
+                  'an admin of the channels.')
+
+    class Meta:
+        model = PromoGroup
+        fields = '__all__'
+
+    def clean_template(self):
+        template = self.cleaned_data['template']
+        problem = template_problem(template)
+        if problem:
+            raise forms.ValidationError(f'The template is invalid: {problem}')
+        return template
+
+
+class PromoGroupAdmin(PrefetchMixin, admin.ModelAdmin):
+    form = PromoGroupForm
     fieldsets = (
         ('Infos', {
             'fields': ('name', 'linked_participants', 'linked_topics')
@@ -159,10 +228,21 @@ class PromoGroupAdmin(admin.ModelAdmin):
         ('Settings', {
             'fields': ('admins', 'linked_admins', 'active', 'template', ),
         }),
+        ('Media', {
+            'fields': ('media_type', 'media_file', 'media_file_id', ),
+        }),
+        ('Import Participants', {
+            'fields': ('import_participants', ),
+        }),
     )
 
-    readonly_fields = ['linked_participants', 'linked_topics', 'linked_admins']
+    readonly_fields = ['linked_participants', 'linked_topics', 'linked_admins', 'media_file_id']
     list_display = ['name', 'linked_admins', 'linked_participants', 'linked_topics', 'active', 'modified', 'created']
+    list_prefetch = [
+        'admins',
+        'topics',
+        Prefetch('participants', queryset=Participant.objects.select_related('channel')),
+    ]
 
     def linked_admins(self, obj: PromoGroup) -> SafeText or None:
         return mark_safe(', '.join(map(lambda o: model_link(o, 'username_or_name'), obj.admins.all())))
@@ -180,6 +260,24 @@ class PromoGroupAdmin(admin.ModelAdmin):
 
     linked_topics.short_description = 'Topics'
 
+    def save_model(self, request, obj: PromoGroup, form, change):
+        if {'media_type', 'media_file'} & set(form.changed_data):
+            # The new file has to be uploaded again
+            obj.media_file_id = ''
+        super().save_model(request, obj, form, change)
+
+        if form.cleaned_data.get('import_participants'):
+            self.import_participants(request, obj, form.cleaned_data['import_participants'])
+
+    def import_participants(self, request, obj: PromoGroup, text: str):
+        from bot.telegrambot import my_bot
+        if my_bot is None:
+            self.message_user(request, 'The bot is not running, no participants were imported', messages.ERROR)
+            return
+        importer = ParticipantImporter(obj)
+        result = importer.run(text)
+        self.message_user(request, importer.report(result), messages.WARNING if result.failed else messages.SUCCESS)
+
 
 admin.site.register(PromoGroup, PromoGroupAdmin)
 
@@ -193,6 +291,7 @@ class ParticipantAdmin(admin.ModelAdmin):
 
     readonly_fields = ['linked_channel', 'linked_promo_group']
     list_display = ['__str__', 'linked_channel', 'linked_promo_group', 'active', 'linked_topic', 'modified', 'created']
+    list_select_related = ['channel', 'promo_group', 'topic']
     # list_filter = ['']
 
     def linked_channel(self, obj: Participant) -> SafeText or None:
@@ -224,6 +323,7 @@ class TopicAdmin(admin.ModelAdmin):
     )
 
     list_display = ['name', 'linked_promo_group']
+    list_select_related = ['promo_group']
 
     def linked_promo_group(self, obj: Topic) -> SafeText or None:
         return model_link(obj.promo_group, 'name')
@@ -232,3 +332,102 @@ class TopicAdmin(admin.ModelAdmin):
 
 
 admin.site.register(Topic, TopicAdmin)
+
+
+class BroadcastRunAdmin(admin.ModelAdmin):
+    fieldsets = (
+        ('Infos', {
+            'fields': ('linked_promo_group', 'scheduled_for', 'finished', 'sent', 'failed')
+        }),
+    )
+
+    readonly_fields = ['linked_promo_group', 'scheduled_for', 'finished', 'sent', 'failed']
+    list_display = ['__str__', 'linked_promo_group', 'scheduled_for', 'finished', 'sent', 'failed']
+    list_select_related = ['promo_group']
+    list_filter = ['promo_group']
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('promo_group').annotate(
+            sent_count=Count('deliveries', filter=Q(deliveries__status=Delivery.SENT)),
+            failed_count=Count('deliveries', filter=Q(deliveries__status=Delivery.FAILED)),
+        )
+
+    def linked_promo_group(self, obj: BroadcastRun) -> SafeText or None:
+        return model_link(obj.promo_group, 'name')
+
+    linked_promo_group.short_description = 'Promotion Group'
+
+    def sent(self, obj: BroadcastRun) -> int:
+        return obj.sent_count
+
+    sent.admin_order_field = 'sent_count'
+
+    def failed(self, obj: BroadcastRun) -> SafeText or int:
+        if not obj.failed_count:
+            return 0
+        url = reverse('admin:bot_delivery_changelist')
+        return link(f'{url}?run__id__exact={obj.id}&status__exact={Delivery.FAILED}', obj.failed_count)
+
+    failed.admin_order_field = 'failed_count'
+
+
+admin.site.register(BroadcastRun, BroadcastRunAdmin)
+
+
+class DeliveryAdmin(admin.ModelAdmin):
+    fieldsets = (
+        ('Infos', {
+            'fields': ('linked_run', 'linked_participant', 'status', 'message_id', 'error')
+        }),
+    )
+
+    readonly_fields = ['linked_run', 'linked_participant', 'status', 'message_id', 'error']
+    list_display = ['__str__', 'linked_run', 'linked_participant', 'status', 'error', 'created']
+    list_select_related = ['run__promo_group', 'participant__channel', 'participant__promo_group']
+    list_filter = ['status']
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related(*self.list_select_related)
+
+    def linked_run(self, obj: Delivery) -> SafeText or None:
+        return model_link(obj.run, '__str__')
+
+    linked_run.short_description = 'Run'
+
+    def linked_participant(self, obj: Delivery) -> SafeText or None:
+        return model_link(obj.participant, 'channel')
+
+    linked_participant.short_description = 'Participant'
+
+
+admin.site.register(Delivery, DeliveryAdmin)
+
+
+class ProfilingAdmin(admin.ModelAdmin):
+    fieldsets = (
+        ('Settings', {
+            'fields': ('active', 'sample_rate', 'output')
+        }),
+        ('Profiles', {
+            'fields': ('profiles', )
+        }),
+    )
+
+    readonly_fields = ['profiles']
+    list_display = ['__str__', 'active', 'sample_rate', 'output', 'modified']
+
+    def has_add_permission(self, request):
+        # The profiler only reads the first row
+        return not Profiling.objects.exists()
+
+    def profiles(self, obj: Profiling) -> SafeText or str:
+        try:
+            files = sorted(default_storage.listdir('profiles')[1], reverse=True)[:20]
+        except OSError:
+            return 'None yet'
+        return mark_safe('<br>'.join(link(default_storage.url(f'profiles/{name}'), name) for name in files))
+
+    profiles.short_description = 'Latest profiles'
+
+
+admin.site.register(Profiling, ProfilingAdmin)
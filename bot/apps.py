@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class DjangoTelegramBotBaseConfig(AppConfig):
     name = 'bot'
+
+    def ready(self):
+        # Connect the signals keeping the promotion scheduler up to date
+        from bot.promotion import scheduler  # noqa: F401
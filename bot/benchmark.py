@@ -0,0 +1,193 @@
+import itertools
+import logging
+import time
+from typing import Callable, Dict, List, NamedTuple
+
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django_telegrambot.apps import DjangoTelegramBot
+from telegram import Bot, CallbackQuery, Chat, Message, MessageEntity, TelegramError, Update, User
+from telegram.ext import Dispatcher
+
+from bot import telegrambot
+from bot.menus import MAIN, MANAGE_GROUP, MANAGE_GROUPS
+from bot.models.promo_group import Participant, PromoGroup, TelegramChannel, TelegramUser
+from bot.utils.cache import chat_cache
+from bot.utils.fake_api import FakeBotApi
+from bot.utils.ratelimit import rate_limiter
+
+# Generated users and channels get ids far away from real ones
+ID_OFFSET = 9_000_000_000
+
+
+class Scenario(NamedTuple):
+    """Updates of one kind, `name` is the handler which should handle them"""
+    name: str
+    update: Callable[['ReplayBenchmark', TelegramUser], Update]
+    menu: str = None
+
+
+class BenchmarkResult(NamedTuple):
+    name: str
+    latencies: List[float]
+    queries: List[int]
+    errors: int
+
+    @property
+    def count(self) -> int:
+        return len(self.latencies)
+
+    @property
+    def throughput(self) -> float:
+        return self.count / sum(self.latencies) if self.latencies else 0
+
+    def percentile(self, percent: float) -> float:
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percent / 100))] if latencies else 0
+
+    @property
+    def queries_per_update(self) -> float:
+        return sum(self.queries) / len(self.queries) if self.queries else 0
+
+
+class _Rollback(Exception):
+    pass
+
+
+def install_bot(bot: Bot):
+    """Let the running bot use `bot` (eg. talking to a fake api) and load the plugins
+
+    If the bot was not started (no valid token), it is started with `bot`. The bot is not rate limited.
+    """
+    rate_limiter.exempt(bot._request)
+    if telegrambot.my_bot is None:
+        DjangoTelegramBot.dispatchers.append(Dispatcher(bot, None, workers=0))
+        DjangoTelegramBot.bot_tokens.append(bot.token)
+        DjangoTelegramBot.bots.append(bot)
+        telegrambot.main()
+    else:
+        index = DjangoTelegramBot.dispatchers.index(telegrambot.my_bot.dispatcher)
+        DjangoTelegramBot.bots[index] = bot
+        DjangoTelegramBot.bot_tokens[index] = bot.token
+        telegrambot.my_bot.bot = telegrambot.my_bot.dispatcher.bot = bot
+
+    from bot.commands import load_plugins
+    load_plugins()
+    chat_cache.clear()
+
+
+class ReplayBenchmark:
+    """Replay synthetic updates through the dispatcher and the command plugins
+
+    The bot talks to a `FakeBotApi`, so no request leaves the process. The generated users, channels and groups are
+    created in a transaction which is rolled back at the end, the database can be a copy of the real one.
+    """
+
+    scenarios = [
+        Scenario('start', lambda self, user: self.command(user, '/start')),
+        Scenario('help', lambda self, user: self.command(user, '/help')),
+        Scenario('mygroups', lambda self, user: self.command(user, '/mygroups')),
+        Scenario('manage_group', lambda self, user: self.text(user, self.groups[user.id][0].name), MANAGE_GROUPS),
+        Scenario('list_participants', lambda self, user: self.text(user, 'List Participants'), MANAGE_GROUP),
+        Scenario('start (callback)', lambda self, user: self.callback(user, 'home')),
+        Scenario('add_participant_wait', lambda self, user: self.forward(user, self.channels[user.id][0]),
+                 MANAGE_GROUP),
+        Scenario('unhandled text', lambda self, user: self.text(user, 'Hello there'), MAIN),
+    ]
+
+    def __init__(self, users: int = 20, groups: int = 3, participants: int = 10, api: FakeBotApi = None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.user_count = users
+        self.group_count = groups
+        self.participant_count = participants
+        self.api = api or FakeBotApi()
+        self.bot = Bot('123:benchmark', request=self.api)
+        self._ids = itertools.count(1)
+        self._errors = 0
+
+        self.users: List[TelegramUser] = []
+        self.groups: Dict[int, List[PromoGroup]] = {}
+        self.channels: Dict[int, List[TelegramChannel]] = {}
+
+    def setup_bot(self):
+        install_bot(self.bot)
+        telegrambot.my_bot.dispatcher.add_error_handler(self._count_error)
+
+    def _count_error(self, bot: Bot, update: Update, error: TelegramError):
+        self._errors += 1
+
+    def generate(self):
+        """Create users which are admin of their groups, every group has participating channels"""
+        base = ID_OFFSET + next(self._ids) * 1_000_000
+        self.users = TelegramUser.objects.bulk_create(TelegramUser(id=base + number, full_name=f'User {number}')
+                                                      for number in range(self.user_count))
+        for user in self.users:
+            channels = TelegramChannel.objects.bulk_create(
+                TelegramChannel(id=-(user.id * 100 + number), title=f'Channel {number}')
+                for number in range(self.participant_count))
+            TelegramChannel.admins.through.objects.bulk_create(
+                TelegramChannel.admins.through(telegramchannel=channel, telegramuser=user) for channel in channels)
+
+            groups = [PromoGroup.objects.create(name=f'Group {user.id} {number}', active=True)
+                      for number in range(self.group_count)]
+            PromoGroup.admins.through.objects.bulk_create(
+                PromoGroup.admins.through(promogroup=group, telegramuser=user) for group in groups)
+            Participant.objects.bulk_create(Participant(channel=channel, promo_group=group)
+                                            for group in groups for channel in channels)
+
+            self.groups[user.id] = groups
+            self.channels[user.id] = channels
+
+    def message(self, user: TelegramUser, text: str = None, **kwargs) -> Message:
+        return Message(next(self._ids), User(user.id, user.full_name, False), 0, Chat(user.id, Chat.PRIVATE),
+                       text=text, bot=self.bot, **kwargs)
+
+    def text(self, user: TelegramUser, text: str) -> Update:
+        return Update(next(self._ids), message=self.message(user, text))
+
+    def command(self, user: TelegramUser, text: str) -> Update:
+        entities = [MessageEntity(MessageEntity.BOT_COMMAND, 0, len(text.split()[0]))]
+        return Update(next(self._ids), message=self.message(user, text, entities=entities))
+
+    def callback(self, user: TelegramUser, data: str) -> Update:
+        query = CallbackQuery(str(next(self._ids)), User(user.id, user.full_name, False), str(user.id),
+                              message=self.message(user, '/home'), data=data, bot=self.bot)
+        return Update(next(self._ids), callback_query=query)
+
+    def forward(self, user: TelegramUser, channel: TelegramChannel) -> Update:
+        forward_from_chat = Chat(channel.id, Chat.CHANNEL, title=channel.title)
+        return Update(next(self._ids), message=self.message(user, 'Post', forward_from_chat=forward_from_chat))
+
+    def replay(self, scenario: Scenario, iterations: int) -> BenchmarkResult:
+        dispatcher = telegrambot.my_bot.dispatcher
+        latencies, queries, errors = [], [], self._errors
+        for user in itertools.islice(itertools.cycle(self.users), iterations):
+            if scenario.menu:
+                TelegramUser.objects.filter(id=user.id).update(menu=scenario.menu,
+                                                               current_group=self.groups[user.id][0])
+            update = scenario.update(self, user)
+
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                dispatcher.process_update(update)
+                latencies.append(time.perf_counter() - started)
+            queries.append(len(captured))
+        return BenchmarkResult(scenario.name, latencies, queries, self._errors - errors)
+
+    def run(self, iterations: int = 100, names: List[str] = None) -> List[BenchmarkResult]:
+        """Replay `iterations` updates of every scenario (or the named ones) and roll back all changes"""
+        self.setup_bot()
+        results = []
+        try:
+            with transaction.atomic():
+                self.generate()
+                for scenario in self.scenarios:
+                    if not names or scenario.name in names:
+                        results.append(self.replay(scenario, iterations))
+                raise _Rollback()
+        except _Rollback:
+            pass
+        finally:
+            telegrambot.my_bot.dispatcher.remove_error_handler(self._count_error)
+            chat_cache.clear()
+        return results
@@ -1,20 +1,33 @@
+import importlib
 import inspect
 import itertools
+import json
 import logging
 import pkgutil
+import threading
+import time
 from functools import wraps
 from pathlib import Path
 from typing import Callable, List, Type
 
 from telegram import Bot, Chat, Message, Update, User
-from telegram.ext import Handler, run_async, CommandHandler
+from telegram.ext import Handler, CommandHandler
 
 from bot.models.promo_group import TelegramChannel
 from bot.models.promo_group import TelegramUser
-from bot.telegrambot import my_bot
+from bot import telegrambot
+from bot.utils import metrics
+from bot.utils.context import UpdateContext
+from bot.utils.executor import command_executor
 from bot.utils.internal import get_class_that_defined_method
+from bot.utils.profiler import profiler
 
 _plugin_group_index = 0
+_registration_time = 0
+_plugins_lock = threading.Lock()
+_plugins_loaded = False
+
+MANIFEST = Path(__file__).with_name('plugins.json')
 
 logger = logging.getLogger('BaseCommand')
 
@@ -39,15 +52,11 @@ class BaseCommand:
         self.chat = update.effective_chat
         self.message = update.effective_message
         self.update = update
-        self.bot = my_bot.bot
-
-        self.telegram_user = TelegramUser.objects.get_or_create(id=self.user.id)[0]
-        self.telegram_user.auto_update_values(self.user, save=True)
+        self.bot = telegrambot.my_bot.bot
 
-        try:
-            self.telegram_channel = TelegramChannel.objects.get(id=self.chat.id)
-        except TelegramChannel.DoesNotExist:
-            pass
+        context = UpdateContext.for_update(update)
+        self.telegram_user = context.telegram_user
+        self.telegram_channel = context.telegram_channel
 
     @staticmethod
     def register_start_button(name: str, header: bool = False, footer: bool = False):
@@ -99,7 +108,13 @@ class BaseCommand:
 
     @staticmethod
     def command_wrapper(handler: Type[Handler] or Handler = None, names: str or List[str] = None,
-                        is_async: bool = False, **kwargs):
+                        is_async: bool = False, timeout: float = None, **kwargs):
+        """Register the decorated function or method as handler
+
+        Async handlers run on the `command_executor`, the handlers of a chat still run one after the other. The next
+        update of the chat is only dispatched once they are done, see `MyBot.process_update`. `timeout` overrides the
+        `COMMAND_EXECUTOR_TIMEOUT` of async handlers.
+        """
         global _plugin_group_index, _messagehandler_group_index
         logger.debug(f'Register new command: handler={handler}, names={names}, async={is_async}, kwargs={kwargs}')
 
@@ -116,46 +131,119 @@ class BaseCommand:
                                 and isinstance(inner_args[1], Update)):
                     return func(*inner_args, **inner_kwargs)
 
-                _args, _kwargs = inner_args, inner_kwargs
-                if method_class and BaseCommand in method_class.__mro__:
-                    try:
-                        instance = method_class(*inner_args, **inner_kwargs)
-                    except CancelOperation:
-                        return
-                    _args = [instance]
-                    _kwargs = {}
+                def run():
+                    _args, _kwargs = inner_args, inner_kwargs
+                    if method_class and BaseCommand in method_class.__mro__:
+                        try:
+                            instance = method_class(*inner_args, **inner_kwargs)
+                        except CancelOperation:
+                            return
+                        _args = [instance]
+                        _kwargs = {}
+                    name = func.__qualname__
+                    with profiler.profile(name):
+                        if not metrics.enabled():
+                            func(*_args, **_kwargs)
+                            return
+
+                        update_metrics = metrics.UpdateMetrics.current()
+                        if update_metrics:
+                            update_metrics.handler = name
+                        started = time.perf_counter()
+                        try:
+                            func(*_args, **_kwargs)
+                        except Exception:
+                            metrics.metrics.inc('bot_handler_errors_total', handler=name)
+                            raise
+                        finally:
+                            metrics.metrics.observe('bot_handler_seconds', time.perf_counter() - started,
+                                                    handler=name)
 
                 if is_async:
-                    run_async(func)(*_args, **_kwargs)
+                    # The instance is created in the executor with the state loaded again, so the state changed by
+                    # the previous handlers of the update, like a new menu, is saved before
+                    update = inner_args[1]
+                    chat = update.effective_chat or update.effective_user
+                    context = UpdateContext.current()
+                    if context:
+                        context.save_state()
+
+                    def run_in_context():
+                        with UpdateContext(update):
+                            run()
+
+                    run_in_context.__qualname__ = func.__qualname__
+                    command_executor.submit(chat.id if chat else None, run_in_context, timeout=timeout)
                 else:
-                    func(*_args, **_kwargs)
+                    run()
 
+            global _registration_time
+            started = time.perf_counter()
             kwargs.setdefault('group', _plugin_group_index)
-            my_bot.add_command(handler=handler, names=names, func=wrapper, **kwargs)
+            telegrambot.my_bot.add_command(handler=handler, names=names, func=wrapper, **kwargs)
+            _registration_time += time.perf_counter() - started
             return wrapper
 
         return outer_wrapper
 
     def run_command(self, command: str, handle_update: bool = False, *args, **kwargs):
-        handlers = list(itertools.chain.from_iterable(my_bot.dispatcher.handlers.values()))
+        handlers = itertools.chain(telegrambot.my_bot.router.handlers,
+                                   itertools.chain.from_iterable(telegrambot.my_bot.dispatcher.handlers.values()))
         handler = next(filter(lambda h: isinstance(h, CommandHandler) and command in h.command, handlers))
-        handler.handle_update(self.update, my_bot.dispatcher, True)
+        handler.handle_update(self.update, telegrambot.my_bot.dispatcher, True)
 
     def set_menu(self, menu):
         self.telegram_user.set_menu(menu)
 
 
-# Import submodules
 __all__ = []
 
-for loader, module_name, is_pkg in pkgutil.walk_packages(__path__):
-    module_path = Path(loader.path) / f'{module_name}.py'
-    if module_path.is_file() and module_path.open().readline().strip() == '# no-autoload':
-        continue
-    _plugin_group_index += 1
-    __all__.append(module_name)
-    if module_name not in globals():
-        _module = loader.find_module(module_name).load_module(module_name)
-        globals()[module_name] = _module
-
-BaseCommand._check_home_class()
+
+def discover_plugins() -> List[str]:
+    """Names of the plugin modules in this package, modules starting with `# no-autoload` are left out"""
+    names = []
+    for module in pkgutil.iter_modules(__path__):
+        module_path = Path(module.module_finder.path) / f'{module.name}.py'
+        if module_path.is_file():
+            with module_path.open() as file:
+                if file.readline().strip() == '# no-autoload':
+                    continue
+        names.append(module.name)
+    return names
+
+
+def plugin_names() -> List[str]:
+    """Names of the plugins from the manifest written by `manage.py plugins`, discovered if there is none"""
+    if MANIFEST.is_file():
+        return json.loads(MANIFEST.read_text())
+    logger.info(f'No plugin manifest found, run "manage.py plugins" to create {MANIFEST.name}')
+    return discover_plugins()
+
+
+def load_plugins():
+    """Import the plugins, which registers their handlers, and log how long each one took
+
+    Every plugin gets its own handler group in the order of the manifest. The plugins are only loaded once.
+    """
+    global _plugin_group_index, _plugins_loaded, _registration_time
+    if _plugins_loaded:
+        return
+    with _plugins_lock:
+        if _plugins_loaded:
+            return
+
+        total = time.perf_counter()
+        for module_name in plugin_names():
+            _plugin_group_index += 1
+            _registration_time = 0
+            started = time.perf_counter()
+            globals()[module_name] = importlib.import_module(f'{__name__}.{module_name}')
+            duration = time.perf_counter() - started
+            __all__.append(module_name)
+            logger.info(f'Loaded plugin {module_name} in {duration * 1000:.1f}ms '
+                        f'(import {(duration - _registration_time) * 1000:.1f}ms, '
+                        f'registration {_registration_time * 1000:.1f}ms)')
+
+        BaseCommand._check_home_class()
+        _plugins_loaded = True
+        logger.info(f'Loaded {len(__all__)} plugins in {(time.perf_counter() - total) * 1000:.1f}ms')
@@ -6,7 +6,7 @@ from bot.models.promo_group import PromoGroup
 class GroupBase(BaseCommand):
     name_blacklist = [
         'Back to list', 'Enable', 'Disable', 'Delete', 'Yes', 'No', 'Edit Name', 'Add Participant',
-        'Cancel', 'New Group',
+        'Cancel', 'New Group', 'Change Promotion Template', 'Set Date/Time', 'Default', 'Remove Schedule',
     ]
 
     def get_group(self, name):
@@ -18,5 +18,4 @@ class GroupBase(BaseCommand):
 
     @current_group.setter
     def current_group(self, group: PromoGroup):
-        self.telegram_user.current_group = group
-        self.telegram_user.save(update_fields=['current_group'])
+        self.telegram_user.set_state(current_group=group)
@@ -1,16 +1,24 @@
+import math
 import re
+from datetime import datetime, timedelta
 
 from django.template.loader import get_template
+from django.utils import timezone
 from telegram import ReplyKeyboardMarkup
-from telegram.ext import MessageHandler
+from telegram.ext import Filters, MessageHandler
 
 from bot.commands import BaseCommand
 from bot.commands.group_base import GroupBase
 from bot.filters import Filters as OF
 from bot.models.promo_group import TelegramChannel, Participant
 from bot.models.promo_group import PromoGroup
+from bot.promotion.importer import ParticipantImporter
+from bot.promotion.renderer import template_problem
 from bot.utils.chat import build_menu
-from bot import MANAGE_GROUPS, MANAGE_GROUP, EDIT_NAME, DELETE_GROUP, ADD_PARTICIPANT
+from bot import MANAGE_GROUPS, MANAGE_GROUP, EDIT_NAME, DELETE_GROUP, ADD_PARTICIPANT, EDIT_TEMPLATE, SET_DATETIME
+
+# Longest interval between the scheduled promotions of a group, one year
+MAX_POST_INTERVAL_HOURS = 24 * 365
 
 
 class GroupEditor(GroupBase):
@@ -99,7 +107,8 @@ class GroupEditor(GroupBase):
     @BaseCommand.command_wrapper(MessageHandler, filters=(OF.text_is('Add Participant')))
     def add_participant(self):
         self.message.reply_text('Make sure this bot is an admin of the channel you want to add and then forward any '
-                                'message from that channel here.',
+                                'message from that channel here. To add many channels at once send me their '
+                                '@usernames, links or ids, one per line.',
                                 reply_markup=ReplyKeyboardMarkup(build_menu('Cancel')))
 
         self.set_menu(ADD_PARTICIPANT)
@@ -110,7 +119,7 @@ class GroupEditor(GroupBase):
         channel = TelegramChannel.objects.get_or_create(id=channel_chat.id)[0]
         channel.auto_update_values()
 
-        if Participant.objects.get(promo_group=self.current_group, channel=channel):
+        if Participant.objects.filter(promo_group=self.current_group, channel=channel).exists():
             self.message.reply_text(f'The channel "{channel.name}" is already a participant of '
                                     f'"{self.current_group.name}"')
             return
@@ -118,26 +127,147 @@ class GroupEditor(GroupBase):
         participant = Participant.objects.create(channel=channel, promo_group=self.current_group, active=True)
         participant.save()
 
-        self.bot.export_chat_invite_link(channel.id)
+        if not channel.link:
+            channel.set_invite_link(self.bot.export_chat_invite_link(channel.id))
         self.message.reply_text(f'Participant "{channel.name}" added to "{self.current_group.name}"')
         self.manage_group(self.current_group)
 
+    @BaseCommand.command_wrapper(MessageHandler, is_async=True,
+                                 filters=(OF.menu(ADD_PARTICIPANT) & Filters.text & ~Filters.forwarded
+                                          & OF.text_is_not('Cancel')))
+    def import_participants(self):
+        self.message.reply_text('Adding the channels, this may take a moment...')
+        importer = ParticipantImporter(self.current_group, self.bot)
+        self.message.reply_text(importer.report(importer.run(self.message.text)))
+        self.manage_group(self.current_group)
+
     @BaseCommand.command_wrapper(MessageHandler, filters=(OF.text_is('Cancel')
-                                                          & OF.menu(ADD_PARTICIPANT, EDIT_NAME)))
+                                                          & OF.menu(ADD_PARTICIPANT, EDIT_NAME, EDIT_TEMPLATE,
+                                                                    SET_DATETIME)))
     def cancel(self):
         if self.current_group:
             self.manage_group(self.current_group)
 
     @BaseCommand.command_wrapper(MessageHandler, filters=OF.menu(MANAGE_GROUP) & OF.text_is('List Participants'))
     def list_participants(self):
+        participants = Participant.objects.filter(promo_group=self.current_group).select_related('channel')
+
         html = get_template('commands/group_editor/list_participants.html').render({
-            'participants': Participant.objects.filter(promo_group=self.current_group)
+            'participants': participants
         })
         html = re.sub('\n+', '\n\n', html)
         self.message.reply_html(html)
 
     @BaseCommand.command_wrapper(MessageHandler, filters=(OF.menu(MANAGE_GROUP)
-                                                         & OF.text_is('Edit Topics', 'Edit Participants',
-                                                                      'Change Promotion Template', 'Set Date/Time')))
+                                                          & OF.text_is('Change Promotion Template')))
+    def pre_edit_template(self):
+        if self.current_group.template:
+            self.message.reply_text(f'The current template is:\n\n{self.current_group.template}')
+        else:
+            self.message.reply_text('The group uses the default template.')
+        if self.current_group.media_type:
+            self.message.reply_text(f'The promotion is sent with a {self.current_group.media_type}.')
+
+        self.message.reply_text('Send me the new template. Write "{{ participants }}" where the list of the other '
+                                'participating channels should be placed and "{{ group.name }}" for the name of the '
+                                'group. You can also send a photo, video, GIF or file with the template as caption. '
+                                'Use "Default" to use the default template.',
+                                reply_markup=ReplyKeyboardMarkup(build_menu('Default', 'Cancel')))
+        self.set_menu(EDIT_TEMPLATE)
+
+    @BaseCommand.command_wrapper(MessageHandler, filters=OF.menu(EDIT_TEMPLATE) & OF.text_is_not('Cancel'))
+    def edit_template(self):
+        media_type, media = self.message_media()
+        if self.message.text == 'Default':
+            template = ''
+        elif media_type:
+            template = self.message.caption_html or ''
+        else:
+            template = self.message.text_html or ''
+
+        if not template and not media_type and self.message.text != 'Default':
+            self.message.reply_text('Send me the template as text or as caption of a photo, video, GIF or file.')
+            return
+        problem = template_problem(template) if template else None
+        if problem:
+            self.message.reply_text(f'The template is invalid: {problem}')
+            return
+
+        self.current_group.template = template
+        # The file id of the users message can be used to send the media, it does not have to be uploaded again
+        self.current_group.media_type = media_type or ''
+        self.current_group.media_file_id = media.file_id if media else ''
+        self.current_group.media_file = None
+        self.current_group.save(update_fields=['template', 'media_type', 'media_file_id', 'media_file', 'modified'])
+
+        if template and 'participants' not in template:
+            self.message.reply_text('Template saved, but it does not contain the "{{ participants }}" list.')
+        else:
+            self.message.reply_text('Template saved')
+        self.manage_group(self.current_group)
+
+    def message_media(self) -> tuple:
+        """The (media type, media) of the message, (None, None) for text messages"""
+        if self.message.photo:
+            return PromoGroup.PHOTO, self.message.photo[-1]
+        for media_type in (PromoGroup.ANIMATION, PromoGroup.VIDEO, PromoGroup.DOCUMENT):
+            media = getattr(self.message, media_type)
+            if media:
+                return media_type, media
+        return None, None
+
+    @BaseCommand.command_wrapper(MessageHandler, filters=(OF.menu(MANAGE_GROUP)
+                                                          & OF.text_is('Set Date/Time')))
+    def pre_set_datetime(self):
+        group = self.current_group
+        if group.post_at:
+            text = f'The next promotion is posted at {group.post_at:%Y-%m-%d %H:%M} UTC'
+            if group.post_interval:
+                text += f' and then every {group.post_interval.total_seconds() / 3600:g} hours'
+        else:
+            text = 'No promotion is scheduled'
+
+        self.message.reply_text(f'{text}.\n\nSend me the date and time of the next promotion in UTC, e.g. '
+                                f'"2020-02-14 18:00". Add the hours between the promotions to repeat it, e.g. '
+                                f'"2020-02-14 18:00 24".',
+                                reply_markup=ReplyKeyboardMarkup(build_menu('Remove Schedule', 'Cancel')))
+        self.set_menu(SET_DATETIME)
+
+    @BaseCommand.command_wrapper(MessageHandler, filters=OF.menu(SET_DATETIME) & OF.text_is_not('Cancel'))
+    def set_datetime(self):
+        group = self.current_group
+        if self.message.text == 'Remove Schedule':
+            group.post_at = group.post_interval = None
+        else:
+            parts = self.message.text.split()
+            try:
+                post_at = datetime.strptime(' '.join(parts[:2]), '%Y-%m-%d %H:%M').replace(tzinfo=timezone.utc)
+                hours = float(parts[2]) if len(parts) > 2 else None
+                # float() accepts "nan", "inf" and "1e12" as well
+                if hours is not None and not (math.isfinite(hours) and hours <= MAX_POST_INTERVAL_HOURS):
+                    raise ValueError(hours)
+                post_interval = timedelta(hours=hours) if hours else None
+            except (ValueError, OverflowError):
+                self.message.reply_text('Please use the format "YYYY-MM-DD HH:MM" optionally followed by the hours '
+                                        f'between the promotions, at most {MAX_POST_INTERVAL_HOURS}.')
+                return
+
+            if post_at <= timezone.now():
+                self.message.reply_text('The date must be in the future.')
+                return
+            if hours is not None and hours <= 0:
+                self.message.reply_text('The hours between the promotions must be more than 0.')
+                return
+
+            group.post_at = post_at
+            group.post_interval = post_interval
+
+        group.save(update_fields=['post_at', 'post_interval', 'modified'])
+        self.message.reply_text(f'Promotion scheduled for {group.post_at:%Y-%m-%d %H:%M} UTC'
+                                if group.post_at else 'Schedule removed')
+        self.manage_group(group)
+
+    @BaseCommand.command_wrapper(MessageHandler, filters=(OF.menu(MANAGE_GROUP)
+                                                         & OF.text_is('Edit Topics', 'Edit Participants')))
     def comming_soon(self):
         self.message.reply_text('Work in progrss')
@@ -3,9 +3,8 @@ from typing import List
 from telegram import Chat
 from telegram.ext import BaseFilter
 
-from bot.models.promo_group import TelegramChannel
-from bot.models.promo_group import TelegramUser
 from bot.utils.chat import is_media_message
+from bot.utils.context import UpdateContext
 
 
 class Filters:
@@ -36,10 +35,15 @@ class Filters:
         class TextIs(BaseFilter):
             name = 'Filters.text_is'
 
+            def __init__(self):
+                # Used by the router to index the handler
+                self.texts = set(texts)
+                self.lower = lower
+
             def filter(self, message):
-                if lower and message.text:
-                    return message.text.lower() in texts
-                return message.text in texts
+                if self.lower and message.text:
+                    return message.text.lower() in self.texts
+                return message.text in self.texts
 
         return TextIs()
 
@@ -72,11 +76,15 @@ class Filters:
         class MenuIs(BaseFilter):
             name = 'Filters.menu'
 
+            def __init__(self):
+                # Used by the router to index the handler
+                self.menus = set(menus)
+
             def filter(self, message):
                 if not message.from_user:
                     return False
-                user = TelegramUser.objects.get(id=message.from_user.id)
+                user = UpdateContext.get_telegram_user(message.from_user)
 
-                return user.menu in menus
+                return user is not None and user.menu in self.menus
 
         return MenuIs()
@@ -0,0 +1,259 @@
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Tuple
+
+from django.conf import settings
+from django_telegrambot.apps import DjangoTelegramBot
+from telegram import Update
+
+from bot.utils.db import connection_limiter
+from bot.utils.metrics import metrics
+
+Item = Tuple[int, str, str]
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+    connection.execute('PRAGMA journal_mode=WAL')
+    return connection
+
+
+class UpdateQueue:
+    """Durable queue of the incoming updates
+
+    The updates are stored in a SQLite file (`UPDATE_QUEUE_PATH`) which is shared by all processes on the host, so
+    updates acknowledged to telegram survive a restart. Every update is put into one of `UPDATE_QUEUE_WORKERS` shards
+    by its user or chat id, the updates of a shard are handled in order.
+    """
+
+    def __init__(self, path: str = None, shards: int = None):
+        self._path = path
+        self._shards = shards
+        self._local = threading.local()
+        self._events: Dict[int, threading.Event] = {}
+
+    @property
+    def path(self) -> str:
+        return self._path or getattr(settings, 'UPDATE_QUEUE_PATH', f'{settings.BASE_DIR}/update_queue.sqlite3')
+
+    @property
+    def shards(self) -> int:
+        return self._shards if self._shards is not None else getattr(settings, 'UPDATE_QUEUE_WORKERS', 8)
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = _connect(self.path)
+            connection.execute('CREATE TABLE IF NOT EXISTS updates (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                               'shard INTEGER NOT NULL, token TEXT NOT NULL, data TEXT NOT NULL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS updates_shard ON updates (shard, id)')
+        return connection
+
+    def event(self, shard: int) -> threading.Event:
+        return self._events.setdefault(shard, threading.Event())
+
+    def shard(self, key: int) -> int:
+        return key % self.shards
+
+    def put(self, token: str, data: str, key: int):
+        shard = self.shard(key)
+        self.connection.execute('INSERT INTO updates (shard, token, data) VALUES (?, ?, ?)', (shard, token, data))
+        self.event(shard).set()
+
+    def get(self, shard: int) -> Item or None:
+        """The oldest (id, token, data) of the shard, it stays in the queue until it is marked as done"""
+        return self.connection.execute('SELECT id, token, data FROM updates WHERE shard = ? ORDER BY id LIMIT 1',
+                                       (shard,)).fetchone()
+
+    def done(self, item_id: int):
+        self.connection.execute('DELETE FROM updates WHERE id = ?', (item_id,))
+
+    def wait(self, shard: int, timeout: float):
+        """Wait until an update is put into the shard by this process or `timeout` passed"""
+        self.event(shard).wait(timeout)
+
+    def depth(self) -> Dict[int, int]:
+        """Number of waiting updates per shard"""
+        return dict(self.connection.execute('SELECT shard, COUNT(*) FROM updates GROUP BY shard').fetchall())
+
+
+class UpdateDeduplicator:
+    """Recognize updates telegram delivered more than once
+
+    The ids of the updates seen in the last `UPDATE_DEDUPE_WINDOW` seconds are remembered in memory (at most
+    `UPDATE_DEDUPE_SIZE`) and in a table of the `UpdateQueue` file, so an update received by another process is
+    recognized as well. The shared table is cleaned up from time to time.
+    """
+
+    def __init__(self, path: str = None, window: float = None, max_size: int = None):
+        self._path = path
+        self._window = window
+        self._max_size = max_size
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._seen: Dict[Tuple[str, int], float] = OrderedDict()
+        self._inserts = 0
+
+    @property
+    def path(self) -> str:
+        return self._path or update_queue.path
+
+    @property
+    def window(self) -> float:
+        return self._window if self._window is not None else getattr(settings, 'UPDATE_DEDUPE_WINDOW', 600)
+
+    @property
+    def max_size(self) -> int:
+        return self._max_size if self._max_size is not None else getattr(settings, 'UPDATE_DEDUPE_SIZE', 10000)
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = _connect(self.path)
+            connection.execute('CREATE TABLE IF NOT EXISTS seen_updates (token TEXT NOT NULL, '
+                               'update_id INTEGER NOT NULL, seen REAL NOT NULL, PRIMARY KEY (token, update_id))')
+        return connection
+
+    def _seen_locally(self, key: Tuple[str, int], now: float) -> bool:
+        with self._lock:
+            while self._seen:
+                oldest, seen = next(iter(self._seen.items()))
+                if seen > now - self.window and len(self._seen) < self.max_size:
+                    break
+                del self._seen[oldest]
+
+            if key in self._seen:
+                return True
+            self._seen[key] = now
+            return False
+
+    def _seen_shared(self, key: Tuple[str, int], now: float) -> bool:
+        connection = self.connection
+        cursor = connection.execute('INSERT OR IGNORE INTO seen_updates (token, update_id, seen) VALUES (?, ?, ?)',
+                                    (*key, now))
+        if not cursor.rowcount:
+            seen = connection.execute('SELECT seen FROM seen_updates WHERE token = ? AND update_id = ?',
+                                      key).fetchone()
+            if seen and seen[0] > now - self.window:
+                return True
+            connection.execute('UPDATE seen_updates SET seen = ? WHERE token = ? AND update_id = ?', (now, *key))
+
+        self._inserts += 1
+        if self._inserts % 1000 == 0:
+            connection.execute('DELETE FROM seen_updates WHERE seen <= ?', (now - self.window,))
+        return False
+
+    def is_duplicate(self, token: str, update_id: int) -> bool:
+        """Whether the update was already seen, the first call for an update marks it as seen"""
+        if not self.window:
+            return False
+        key, now = (token, update_id), time.time()
+        return self._seen_locally(key, now) or self._seen_shared(key, now)
+
+
+def process_update(token: str, data: str):
+    bot = DjangoTelegramBot.getBot(bot_id=token, safe=False)
+    dispatcher = DjangoTelegramBot.getDispatcher(token, safe=False)
+    if bot is None or dispatcher is None:
+        logging.getLogger('UpdateWorkers').error(f'Dropped update for unknown bot {token}')
+        return
+    dispatcher.process_update(Update.de_json(json.loads(data), bot))
+
+
+class UpdateWorkers:
+    """Pool of threads handling the updates of the `UpdateQueue`, one thread per shard
+
+    Each shard is only handled by one process at a time, the thread holds a lock on a file next to the queue while it
+    works on the shard. The threads of the other processes wait for the lock and take over when the process ends.
+    Updates are removed from the queue after they were handled, so an update interrupted by a crash is handled again.
+    """
+
+    def __init__(self, queue: UpdateQueue, process: Callable[[str, str], None] = process_update):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.queue = queue
+        self.process = process
+        self.stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return bool(self._threads)
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            self.stop.clear()
+            for shard in range(self.queue.shards):
+                thread = threading.Thread(target=self._work, args=(shard,), name=f'UpdateWorker-{shard}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        self.logger.info(f'Started {len(self._threads)} update workers')
+
+    def join(self, timeout: float = None):
+        """Stop the workers once they are idle"""
+        self.stop.set()
+        for shard in range(self.queue.shards):
+            self.queue.event(shard).set()
+        with self._lock:
+            for thread in self._threads:
+                thread.join(timeout)
+            self._threads = []
+
+    def _work(self, shard: int):
+        poll_interval = getattr(settings, 'UPDATE_QUEUE_POLL_INTERVAL', 1)
+        with open(f'{self.queue.path}.{shard}.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                while not self.stop.is_set():
+                    self.queue.event(shard).clear()
+                    item = self.queue.get(shard)
+                    if not item:
+                        connection_limiter.release()
+                        self.queue.wait(shard, poll_interval)
+                        continue
+
+                    item_id, token, data = item
+                    try:
+                        with connection_limiter.connection():
+                            self.process(token, data)
+                    except Exception:
+                        self.logger.exception(f'Update {item_id} could not be handled')
+                    finally:
+                        self.queue.done(item_id)
+            finally:
+                connection_limiter.release()
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+update_queue = UpdateQueue()
+update_workers = UpdateWorkers(update_queue)
+update_deduplicator = UpdateDeduplicator()
+
+
+def _queue_depth() -> Dict[tuple, int]:
+    # The queue file only exists once the webhook received updates, a scrape should not create it
+    if not os.path.exists(update_queue.path):
+        return {}
+    return {(('shard', shard),): depth for shard, depth in update_queue.depth().items()}
+
+
+metrics.describe('bot_update_queue_depth', 'gauge', 'Updates waiting in the update queue by shard')
+metrics.gauge('bot_update_queue_depth', _queue_depth)
+
+
+def update_key(update: Update) -> int:
+    """Shard key of an update, updates of the same user or chat have the same key"""
+    for chat in (update.effective_user, update.effective_chat):
+        if chat:
+            return abs(chat.id)
+    return update.update_id
@@ -0,0 +1,155 @@
+import itertools
+import json
+import logging
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Deque, Dict, List
+
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler, get_internal_wsgi_application
+from django.urls import reverse
+from telegram import Bot, TelegramError, Update
+from telegram.utils.request import Request
+
+from bot import telegrambot
+from bot.benchmark import ID_OFFSET, install_bot
+from bot.ingest import update_queue, update_workers
+from bot.models.promo_group import TelegramUser
+from bot.utils.fake_api import FakeBotApi, FakeBotApiServer
+
+COMMANDS = ['/start', '/help', '/mygroups']
+# Redelivered update ids are skipped by the webhook, so every run of the process posts new ones
+_update_ids = itertools.count(1)
+
+
+class _QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def percentile(values: List[float], percent: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))] if values else 0
+
+
+class LoadTest:
+    """Post webhook updates to the Django app over HTTP and measure how long it takes until the bot answers
+
+    The app is served by a local WSGI server, the bot talks to a `FakeBotApiServer` over HTTP, so the whole stack from
+    the webhook view to the outgoing Bot API requests is measured. The update queue uses a temporary file and the
+    generated users are deleted at the end.
+    """
+
+    def __init__(self, rate: float = 50, duration: float = 10, users: int = 100, pool_size: int = 8,
+                 concurrency: int = 32):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.rate = rate
+        self.duration = duration
+        self.users = users
+        self.pool_size = pool_size
+        self.concurrency = concurrency
+
+        self.api = FakeBotApi(on_call=self._on_call)
+        self.latencies: List[float] = []
+        self.ack_latencies: List[float] = []
+        self.errors: Counter = Counter()
+        self.posted = 0
+        self.elapsed = 0
+        self._waiting: Dict[int, Deque[float]] = defaultdict(deque)
+        self._lock = threading.Lock()
+
+    def _count_error(self, bot: Bot, update: Update, error: TelegramError):
+        self.errors[f'handler {type(error).__name__}'] += 1
+
+    def _on_call(self, method: str, data: dict):
+        if method != 'sendMessage':
+            return
+        with self._lock:
+            waiting = self._waiting.get(int(data['chat_id']))
+            if waiting:
+                self.latencies.append(time.perf_counter() - waiting.popleft())
+
+    @property
+    def unanswered(self) -> int:
+        with self._lock:
+            return sum(map(len, self._waiting.values()))
+
+    def update(self, number: int) -> dict:
+        user_id = ID_OFFSET + number % self.users
+        text = COMMANDS[number % len(COMMANDS)]
+        user = {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}'}
+        return {'update_id': next(_update_ids), 'message': {
+            'message_id': number, 'date': int(time.time()), 'from': user, 'chat': dict(user, type='private'),
+            'text': text, 'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text)}],
+        }}
+
+    def post(self, url: str, update: dict):
+        chat_id = update['message']['chat']['id']
+        request = urllib.request.Request(url, json.dumps(update).encode(), {'Content-Type': 'application/json'})
+        started = time.perf_counter()
+        with self._lock:
+            self.posted += 1
+            self._waiting[chat_id].append(started)
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                response.read()
+            self.ack_latencies.append(time.perf_counter() - started)
+        except (urllib.error.URLError, OSError) as error:
+            with self._lock:
+                self._waiting[chat_id].pop()
+            self.errors[type(error).__name__] += 1
+
+    def run(self):
+        api_server = FakeBotApiServer(self.api).start()
+        bot = Bot('123:loadtest', base_url=api_server.base_url, request=Request(con_pool_size=self.pool_size))
+        install_bot(bot)
+        telegrambot.my_bot.dispatcher.add_error_handler(self._count_error)
+
+        directory = tempfile.TemporaryDirectory()
+        update_queue._path = f'{directory.name}/update_queue.sqlite3'
+
+        app_server = ThreadedWSGIServer(('127.0.0.1', 0), _QuietRequestHandler)
+        app_server.set_app(get_internal_wsgi_application())
+        threading.Thread(target=app_server.serve_forever, name='LoadTestServer', daemon=True).start()
+        url = f'http://127.0.0.1:{app_server.server_address[1]}{reverse("update_queue_webhook", args=[bot.token])}'
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                started = time.perf_counter()
+                for number in range(int(self.rate * self.duration)):
+                    delay = started + number / self.rate - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                    executor.submit(self.post, url, self.update(number))
+            self.elapsed = time.perf_counter() - started
+
+            deadline = time.perf_counter() + 30
+            while self.unanswered and time.perf_counter() < deadline:
+                time.sleep(0.05)
+        finally:
+            telegrambot.my_bot.dispatcher.remove_error_handler(self._count_error)
+            update_workers.join(timeout=1)
+            app_server.shutdown()
+            api_server.shutdown()
+            update_queue._path = None
+            directory.cleanup()
+            TelegramUser.objects.filter(id__gte=ID_OFFSET, id__lt=ID_OFFSET + self.users).delete()
+
+    def report(self) -> Dict[str, object]:
+        calls = Counter(method for method, data in self.api.calls)
+        return {
+            'updates': self.posted,
+            'answered': len(self.latencies),
+            'unanswered': self.unanswered,
+            'errors': dict(self.errors),
+            'updates/s': self.posted / self.elapsed if self.elapsed else 0,
+            'ack p50 ms': percentile(self.ack_latencies, 50) * 1000,
+            'ack p99 ms': percentile(self.ack_latencies, 99) * 1000,
+            'end-to-end p50 ms': percentile(self.latencies, 50) * 1000,
+            'end-to-end p99 ms': percentile(self.latencies, 99) * 1000,
+            'api calls': dict(calls),
+        }
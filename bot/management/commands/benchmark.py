@@ -0,0 +1,26 @@
+from django.core.management import BaseCommand
+
+from bot.benchmark import ReplayBenchmark
+
+
+class Command(BaseCommand):
+    help = 'Replay synthetic updates through the dispatcher and report the performance of every handler'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=200, help='Updates replayed per scenario')
+        parser.add_argument('--users', type=int, default=20, help='Number of generated users')
+        parser.add_argument('--groups', type=int, default=3, help='Promotion groups per user')
+        parser.add_argument('--participants', type=int, default=10, help='Participants per group')
+        parser.add_argument('--scenario', action='append', dest='scenarios', help='Only run this scenario')
+
+    def handle(self, *args, iterations=200, users=20, groups=3, participants=10, scenarios=None, **options):
+        benchmark = ReplayBenchmark(users=users, groups=groups, participants=participants)
+        results = benchmark.run(iterations, scenarios)
+
+        self.stdout.write(f'{"Scenario":<24} {"Updates":>8} {"Updates/s":>10} {"p50 ms":>8} {"p99 ms":>8} '
+                          f'{"Queries":>8} {"Errors":>7}')
+        for result in results:
+            self.stdout.write(f'{result.name:<24} {result.count:>8} {result.throughput:>10.1f} '
+                              f'{result.percentile(50) * 1000:>8.2f} {result.percentile(99) * 1000:>8.2f} '
+                              f'{result.queries_per_update:>8.1f} {result.errors:>7}')
+        self.stdout.write(f'Bot API calls: {len(benchmark.api.calls)}')
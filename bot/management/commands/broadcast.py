@@ -0,0 +1,41 @@
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from django.utils import timezone
+from telegram import Bot
+
+from bot.models import PromoGroup
+from bot.promotion.engine import Broadcaster
+from bot.promotion.scheduler import PromotionScheduler
+
+
+class Command(BaseCommand):
+    help = 'Post the promotions of all due promotion groups'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--group', type=int, help='Post the promotion of this group now, even if it is not due')
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep running and post the promotions when they are due')
+        parser.add_argument('--base-url', help='Bot API url to use instead of telegram, eg. a local fake Bot API')
+
+    def handle(self, *args, group=None, loop=False, base_url=None, **options):
+        bot = None
+        if base_url:
+            bot = Bot(settings.DJANGO_TELEGRAMBOT['BOTS'][0]['TOKEN'], base_url=base_url)
+        broadcaster = Broadcaster(bot)
+
+        if group is not None:
+            try:
+                self.report(broadcaster.broadcast(PromoGroup.objects.get(id=group), timezone.now()))
+            except PromoGroup.DoesNotExist:
+                raise CommandError(f'Promotion group {group} does not exist')
+            return
+
+        if loop:
+            PromotionScheduler().run(broadcaster)
+            return
+
+        for result in broadcaster.run_due():
+            self.report(result)
+
+    def report(self, result):
+        self.stdout.write(f'{result.group.name}: {len(result.sent)} sent, {len(result.failed)} failed')
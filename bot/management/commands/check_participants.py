@@ -0,0 +1,29 @@
+import time
+
+from django.conf import settings
+from django.core.management import BaseCommand
+from telegram import Bot
+
+from bot.promotion.health import ParticipantHealthCheck
+
+
+class Command(BaseCommand):
+    help = 'Deactivate the participants whose channel the bot is no admin of or can not post in anymore'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep running and check the channels every HEALTH_CHECK_INTERVAL seconds')
+        parser.add_argument('--base-url', help='Bot API url to use instead of telegram, eg. a local fake Bot API')
+
+    def handle(self, *args, loop=False, base_url=None, **options):
+        bot = None
+        if base_url:
+            bot = Bot(settings.DJANGO_TELEGRAMBOT['BOTS'][0]['TOKEN'], base_url=base_url)
+        health_check = ParticipantHealthCheck(bot)
+
+        while True:
+            result = health_check.run()
+            self.stdout.write(f'Checked {result.checked} channels, deactivated {result.deactivated} participants')
+            if not loop:
+                return
+            time.sleep(getattr(settings, 'HEALTH_CHECK_INTERVAL', 3600))
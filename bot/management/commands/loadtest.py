@@ -0,0 +1,20 @@
+from django.core.management import BaseCommand
+
+from bot.loadtest import LoadTest
+
+
+class Command(BaseCommand):
+    help = 'Post webhook updates at a fixed rate against a local fake Bot API and report latencies and API calls'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rate', type=float, default=50, help='Updates posted per second')
+        parser.add_argument('--duration', type=float, default=10, help='Seconds to post updates')
+        parser.add_argument('--users', type=int, default=100, help='Number of users sending the updates')
+        parser.add_argument('--pool-size', type=int, default=8, help='Connection pool size of the bot')
+        parser.add_argument('--concurrency', type=int, default=32, help='Webhook requests open at the same time')
+
+    def handle(self, *args, rate=50, duration=10, users=100, pool_size=8, concurrency=32, **options):
+        load_test = LoadTest(rate=rate, duration=duration, users=users, pool_size=pool_size, concurrency=concurrency)
+        load_test.run()
+        for name, value in load_test.report().items():
+            self.stdout.write(f'{name:<20} {value:.2f}' if isinstance(value, float) else f'{name:<20} {value}')
@@ -0,0 +1,25 @@
+import json
+
+from django.core.management import BaseCommand
+
+from bot.commands import MANIFEST, discover_plugins
+
+
+class Command(BaseCommand):
+    help = 'Write the manifest of the command plugins which are loaded by the bot'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true', help='Fail if the manifest is not up to date')
+
+    def handle(self, *args, check=False, **options):
+        plugins = discover_plugins()
+        current = json.loads(MANIFEST.read_text()) if MANIFEST.is_file() else None
+
+        if check:
+            if current != plugins:
+                self.stderr.write(f'{MANIFEST.name} is not up to date, run "manage.py plugins"')
+                exit(1)
+            return
+
+        MANIFEST.write_text(json.dumps(plugins, indent=4) + '\n')
+        self.stdout.write(f'Wrote {len(plugins)} plugins to {MANIFEST}: {", ".join(plugins)}')
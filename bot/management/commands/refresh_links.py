@@ -0,0 +1,30 @@
+import time
+
+from django.conf import settings
+from django.core.management import BaseCommand
+from telegram import Bot
+
+from bot.promotion.invite_links import InviteLinkRefresher
+
+
+class Command(BaseCommand):
+    help = 'Fetch the invite links, usernames and titles of the participating channels which are out of date'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, help='Fetch at most this many channels')
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep running and refresh the links every INVITE_LINK_REFRESH_INTERVAL seconds')
+        parser.add_argument('--base-url', help='Bot API url to use instead of telegram, eg. a local fake Bot API')
+
+    def handle(self, *args, limit=None, loop=False, base_url=None, **options):
+        bot = None
+        if base_url:
+            bot = Bot(settings.DJANGO_TELEGRAMBOT['BOTS'][0]['TOKEN'], base_url=base_url)
+        refresher = InviteLinkRefresher(bot)
+
+        while True:
+            count = refresher.refresh(limit)
+            self.stdout.write(f'Refreshed {count} channels')
+            if not loop:
+                return
+            time.sleep(getattr(settings, 'INVITE_LINK_REFRESH_INTERVAL', 300))
@@ -0,0 +1,30 @@
+import time
+
+from django.conf import settings
+from django.core.management import BaseCommand
+from telegram import Bot
+
+from bot.promotion.channel_admins import ChannelAdminSync
+
+
+class Command(BaseCommand):
+    help = 'Sync the admins of all channels with the administrators telegram lists for them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep running and sync the admins every ADMIN_SYNC_INTERVAL seconds')
+        parser.add_argument('--base-url', help='Bot API url to use instead of telegram, eg. a local fake Bot API')
+
+    def handle(self, *args, loop=False, base_url=None, **options):
+        bot = None
+        if base_url:
+            bot = Bot(settings.DJANGO_TELEGRAMBOT['BOTS'][0]['TOKEN'], base_url=base_url)
+        admin_sync = ChannelAdminSync(bot)
+
+        while True:
+            result = admin_sync.sync()
+            self.stdout.write(f'Synced {result.synced} channels, {result.added} admins added, '
+                              f'{result.removed} removed')
+            if not loop:
+                return
+            time.sleep(getattr(settings, 'ADMIN_SYNC_INTERVAL', 3600))
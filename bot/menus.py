@@ -6,6 +6,8 @@ menus = {
     'EDIT_NAME': 'edit name',
     'DELETE_GROUP': 'delete group',
     'ADD_PARTICIPANT': 'add participant',
+    'EDIT_TEMPLATE': 'edit template',
+    'SET_DATETIME': 'set date time',
 }
 
 locals().update(menus)
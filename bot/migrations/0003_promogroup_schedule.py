@@ -0,0 +1,28 @@
+# Generated by Django 3.0.2 on 2026-10-18 12:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0002_auto_20200206_0937'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='promogroup',
+            name='post_at',
+            field=models.DateTimeField(blank=True, help_text='Time of the next promotion post', null=True),
+        ),
+        migrations.AddField(
+            model_name='promogroup',
+            name='post_interval',
+            field=models.DurationField(blank=True, help_text='Time between the promotion posts, empty to post once', null=True),
+        ),
+        migrations.AlterField(
+            model_name='telegramuser',
+            name='menu',
+            field=models.CharField(default='main', help_text='main, new promo group question 1, manage groups, manage group, edit name, delete group, add participant, edit template, set date time', max_length=100, verbose_name='Menu'),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 3.0.2 on 2026-10-18 12:50
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django_extensions.db.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0003_promogroup_schedule'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BroadcastRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', django_extensions.db.fields.CreationDateTimeField(auto_now_add=True, verbose_name='created')),
+                ('modified', django_extensions.db.fields.ModificationDateTimeField(auto_now=True, verbose_name='modified')),
+                ('scheduled_for', models.DateTimeField()),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('promo_group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='runs', to='bot.PromoGroup')),
+            ],
+            options={
+                'ordering': ('-scheduled_for',),
+                'unique_together': {('promo_group', 'scheduled_for')},
+            },
+        ),
+        migrations.CreateModel(
+            name='Delivery',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', django_extensions.db.fields.CreationDateTimeField(auto_now_add=True, verbose_name='created')),
+                ('modified', django_extensions.db.fields.ModificationDateTimeField(auto_now=True, verbose_name='modified')),
+                ('status', models.CharField(choices=[('sent', 'Sent'), ('failed', 'Failed')], max_length=10)),
+                ('message_id', models.BigIntegerField(blank=True, null=True)),
+                ('error', models.TextField(blank=True, default='')),
+                ('participant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='deliveries', to='bot.Participant')),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='deliveries', to='bot.BroadcastRun')),
+            ],
+            options={
+                'verbose_name_plural': 'deliveries',
+                'unique_together': {('run', 'participant')},
+            },
+        ),
+    ]
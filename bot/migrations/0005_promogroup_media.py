@@ -0,0 +1,28 @@
+# Generated by Django 3.0.2 on 2026-10-18 12:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0004_broadcast_delivery_log'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='promogroup',
+            name='media_file',
+            field=models.FileField(blank=True, help_text='Media sent with the promotion', upload_to='promotion/'),
+        ),
+        migrations.AddField(
+            model_name='promogroup',
+            name='media_file_id',
+            field=models.CharField(blank=True, default='', help_text='Telegram file id of the media once it was uploaded', max_length=200),
+        ),
+        migrations.AddField(
+            model_name='promogroup',
+            name='media_type',
+            field=models.CharField(blank=True, choices=[('photo', 'Photo'), ('video', 'Video'), ('animation', 'Animation'), ('document', 'Document')], default='', max_length=20),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.0.2 on 2026-10-18 13:12
+
+import django.core.validators
+from django.db import migrations, models
+import django_extensions.db.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0005_promogroup_media'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Profiling',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', django_extensions.db.fields.CreationDateTimeField(auto_now_add=True, verbose_name='created')),
+                ('modified', django_extensions.db.fields.ModificationDateTimeField(auto_now=True, verbose_name='modified')),
+                ('active', models.BooleanField(default=False)),
+                ('sample_rate', models.FloatField(default=0.01, help_text='Fraction of the handler calls which are profiled', validators=[django.core.validators.MinValueValidator(0), django.core.validators.MaxValueValidator(1)])),
+                ('output', models.CharField(choices=[('collapsed', 'Collapsed stacks'), ('pstats', 'pstats')], default='collapsed', max_length=20)),
+            ],
+            options={
+                'verbose_name_plural': 'profiling',
+            },
+        ),
+    ]
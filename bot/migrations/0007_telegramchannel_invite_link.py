@@ -0,0 +1,23 @@
+# Generated by Django 3.0.2 on 2026-10-18 13:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0006_profiling'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='telegramchannel',
+            name='invite_link',
+            field=models.CharField(blank=True, default='', max_length=200),
+        ),
+        migrations.AddField(
+            model_name='telegramchannel',
+            name='invite_link_fetched',
+            field=models.DateTimeField(blank=True, help_text='When the invite link was last fetched from telegram', null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.2 on 2026-10-18 13:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0007_telegramchannel_invite_link'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='telegramchannel',
+            name='admins_synced',
+            field=models.DateTimeField(blank=True, help_text='When the admins were last synced from telegram', null=True),
+        ),
+    ]
@@ -3,3 +3,6 @@ from bot.models.promo_group import Participant
 from bot.models.promo_group import TelegramUser
 from bot.models.promo_group import TelegramChannel
 from bot.models.promo_group import Topic
+from bot.models.broadcast import BroadcastRun
+from bot.models.broadcast import Delivery
+from bot.models.profiling import Profiling
@@ -0,0 +1,36 @@
+from django.db import models
+from django_extensions.db.models import TimeStampedModel
+
+
+class BroadcastRun(TimeStampedModel):
+    """A single promotion post of a group to all its participants"""
+    promo_group = models.ForeignKey('PromoGroup', on_delete=models.CASCADE, related_name='runs')
+    scheduled_for = models.fields.DateTimeField()
+    finished = models.fields.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        unique_together = ['promo_group', 'scheduled_for']
+        ordering = ('-scheduled_for', )
+
+    def __str__(self):
+        return f'{self.promo_group.name} - {self.scheduled_for:%Y-%m-%d %H:%M}'
+
+
+class Delivery(TimeStampedModel):
+    """The post of a run to a single participant"""
+    SENT = 'sent'
+    FAILED = 'failed'
+
+    run = models.ForeignKey('BroadcastRun', on_delete=models.CASCADE, related_name='deliveries')
+    participant = models.ForeignKey('Participant', on_delete=models.CASCADE, related_name='deliveries')
+
+    status = models.fields.CharField(max_length=10, choices=[(SENT, 'Sent'), (FAILED, 'Failed')])
+    message_id = models.fields.BigIntegerField(blank=True, null=True)
+    error = models.fields.TextField(blank=True, default='')
+
+    class Meta:
+        unique_together = ['run', 'participant']
+        verbose_name_plural = 'deliveries'
+
+    def __str__(self):
+        return f'{self.run} - {self.participant.channel.title}'
@@ -0,0 +1,21 @@
+from django.core.validators import MaxValueValidator, MinValueValidator
+from django.db import models
+from django_extensions.db.models import TimeStampedModel
+
+
+class Profiling(TimeStampedModel):
+    """Switch of the profiler of the command handlers, only the first row is used"""
+    COLLAPSED = 'collapsed'
+    PSTATS = 'pstats'
+
+    active = models.fields.BooleanField(default=False)
+    sample_rate = models.fields.FloatField(default=0.01, validators=[MinValueValidator(0), MaxValueValidator(1)],
+                                           help_text='Fraction of the handler calls which are profiled')
+    output = models.fields.CharField(max_length=20, default=COLLAPSED,
+                                     choices=[(COLLAPSED, 'Collapsed stacks'), (PSTATS, 'pstats')])
+
+    class Meta:
+        verbose_name_plural = 'profiling'
+
+    def __str__(self):
+        return f'Profiling {"active" if self.active else "inactive"}'
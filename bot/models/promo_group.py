@@ -1,54 +1,181 @@
+import atexit
+import logging
+import threading
+from collections import defaultdict
+from typing import Dict, List, Tuple, Type
+
+from django.conf import settings
 from django.db import models
+from django.utils import timezone
 from django_extensions.db.models import TimeStampedModel
 from telegram import Chat
 
+from bot.utils.cache import ChatInfo, chat_cache
+from bot.utils.db import connection_limiter
 from bot.utils.internal import bot_not_running_protect
 from bot import menus, MAIN
 
 
+class DeferredUpdates:
+    """Buffer of changed chat fields written in one bulk update per model
+
+    With `PROFILE_REFRESH_INTERVAL` set to a number of seconds, changes are collected and written by a timer once per
+    interval and when the process exits. Without it they are written right away. The changed values are kept per
+    chat, so changes of different instances of the same chat are all written.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self._lock = threading.Lock()
+        self._pending: Dict[Type['TelegramChat'], Dict[int, Tuple['TelegramChat', dict]]] = defaultdict(dict)
+        self._timer: threading.Timer or None = None
+        self._flush_at_exit = False
+
+    @property
+    def interval(self) -> float:
+        return getattr(settings, 'PROFILE_REFRESH_INTERVAL', 0)
+
+    def add(self, instance: 'TelegramChat', fields: List[str]):
+        if not self.interval:
+            instance.save(update_fields=fields)
+            return
+
+        with self._lock:
+            pending = self._pending[instance.__class__]
+            _, values = pending.get(instance.pk, (instance, {}))
+            pending[instance.pk] = instance, {**values, **{field: getattr(instance, field) for field in fields}}
+
+            if not self._flush_at_exit:
+                atexit.register(self.flush)
+                self._flush_at_exit = True
+            if not self._timer:
+                self._timer = threading.Timer(self.interval, self._flush_in_thread)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _flush_in_thread(self):
+        with connection_limiter.connection(keep=False):
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(dict)
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+
+        now = timezone.now()
+        for model, instances in pending.items():
+            fields = set().union(*(values for _, values in instances.values()))
+            objs = []
+            for instance, values in instances.values():
+                for field, value in values.items():
+                    setattr(instance, field, value)
+                instance.modified = now
+                objs.append(instance)
+
+            self.logger.debug(f'Write {len(objs)} deferred {model.__name__} updates: {fields}')
+            model.objects.bulk_update(objs, list(fields | {'modified'}))
+            for instance in objs:
+                instance._mark_saved(fields | {'modified'})
+
+
+deferred_updates = DeferredUpdates()
+
+
 class TelegramChat(TimeStampedModel):
     class Meta:
         abstract = True
 
-    _chat = None
+    _loaded_values: dict = None
 
     auto_update = []
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
     @property
     @bot_not_running_protect
-    def chat(self):
-        if not self._chat:
-            from bot.telegrambot import my_bot
-            self._chat = my_bot.bot.get_chat(self.id)
-        return self._chat
+    def chat(self) -> ChatInfo:
+        return chat_cache.get(self.id)
+
+    @property
+    def changed_fields(self) -> List[str]:
+        """Fields changed since the instance was loaded or saved"""
+        fields = [field.attname for field in self._meta.concrete_fields]
+        if self._loaded_values is None:
+            return fields
+        return [name for name in fields
+                if name not in self._loaded_values or self._loaded_values[name] != getattr(self, name)]
+
+    def _mark_saved(self, fields=None):
+        if self._loaded_values is None:
+            self._loaded_values = {}
+        for field in self._meta.concrete_fields:
+            if fields is None or field.attname in fields or field.name in fields:
+                self._loaded_values[field.attname] = getattr(self, field.attname)
 
     def save(self, **kwargs):
         if kwargs.get('auto_update', False):
             self.auto_update_values(save=False)
             kwargs.pop('auto_update')
         super().save(**kwargs)
+        self._mark_saved(kwargs.get('update_fields'))
+
+    def auto_update_values(self, chat: Chat or ChatInfo = None, save=True, defer=False) -> bool:
+        """Update the values from the chat
 
-    def auto_update_values(self, chat: Chat = None, save=True) -> bool:
+        Only the changed fields are written, if nothing changed no query is made. With `defer` the write is collected
+        and done in bulk with other changed chats, see `DeferredUpdates`.
+        """
         chat = chat or self.chat
         if chat:
             for name in self.auto_update:
                 setattr(self, name, getattr(chat, name))
 
-            if save:
-                self.save()
+            changed_fields = self.changed_fields
+            changed = [name for name in self.auto_update if name in changed_fields]
+            if save and changed:
+                if defer:
+                    deferred_updates.add(self, changed + ['modified'])
+                else:
+                    self.save(update_fields=changed + ['modified'])
             return True
 
 
 class PromoGroup(TimeStampedModel):
+    PHOTO = 'photo'
+    VIDEO = 'video'
+    ANIMATION = 'animation'
+    DOCUMENT = 'document'
+
     admins = models.ManyToManyField('TelegramUser', related_name='admins_at')
     name = models.fields.CharField(max_length=200)
     active = models.fields.BooleanField(default=False)
 
     template = models.fields.TextField(blank=True, default='')
 
+    media_type = models.fields.CharField(max_length=20, blank=True, default='',
+                                         choices=[(PHOTO, 'Photo'), (VIDEO, 'Video'), (ANIMATION, 'Animation'),
+                                                  (DOCUMENT, 'Document')])
+    media_file = models.FileField(upload_to='promotion/', blank=True, help_text='Media sent with the promotion')
+    media_file_id = models.fields.CharField(max_length=200, blank=True, default='',
+                                            help_text='Telegram file id of the media once it was uploaded')
+
+    post_at = models.fields.DateTimeField(blank=True, null=True, help_text='Time of the next promotion post')
+    post_interval = models.fields.DurationField(blank=True, null=True,
+                                                help_text='Time between the promotion posts, empty to post once')
+
     def __str__(self):
         return self.name
 
+    @property
+    def has_media(self) -> bool:
+        return bool(self.media_type and (self.media_file_id or self.media_file))
+
 
 class Participant(TimeStampedModel):
     channel = models.ForeignKey('TelegramChannel', on_delete=models.CASCADE, related_name='participating')
@@ -91,8 +218,23 @@ class TelegramUser(TelegramChat):
         return self.at_username or self.full_name
 
     def set_menu(self, menu):
-        self.menu = menu
-        self.save(update_fields=['menu'])
+        self.set_state(menu=menu)
+
+    def set_state(self, **values):
+        """Change the conversation state (`menu`, `current_group`, `tmp_data`)
+
+        During an update the changes are saved once the update is done, see `bot.utils.state`.
+        """
+        from bot.utils.context import UpdateContext
+        from bot.utils.state import state_backend
+
+        for field, value in values.items():
+            setattr(self, field, value)
+
+        context = UpdateContext.current()
+        if context and context.defer_state(self, values):
+            return
+        state_backend().save(self, values)
 
     @property
     def at_username(self) -> str:
@@ -105,8 +247,26 @@ class TelegramChannel(TelegramChat):
     id = models.fields.BigIntegerField(primary_key=True)
     username = models.fields.CharField(max_length=200, blank=True, null=True)
     title = models.fields.CharField(max_length=200, blank=True, null=True)
+    invite_link = models.fields.CharField(max_length=200, blank=True, default='')
+    invite_link_fetched = models.fields.DateTimeField(blank=True, null=True,
+                                                      help_text='When the invite link was last fetched from telegram')
 
     admins = models.ManyToManyField('TelegramUser', related_name='channels')
+    admins_synced = models.fields.DateTimeField(blank=True, null=True,
+                                                help_text='When the admins were last synced from telegram')
+
+    @property
+    def link(self) -> str or None:
+        """Public link of the channel or its stored invite link, no request is made"""
+        if self.username:
+            return f'https://t.me/{self.username}'
+        return self.invite_link or None
+
+    def set_invite_link(self, invite_link: str or None, save: bool = True):
+        self.invite_link = invite_link or self.invite_link
+        self.invite_link_fetched = timezone.now()
+        if save:
+            self.save(update_fields=['invite_link', 'invite_link_fetched', 'modified'])
 
     def username_or_title(self):
         return self.at_username or self.title
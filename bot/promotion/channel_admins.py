@@ -0,0 +1,94 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from telegram import Bot, TelegramError, User
+
+from bot.models.promo_group import TelegramChannel, TelegramUser
+from bot.utils.cache import chat_cache
+
+
+class AdminSyncResult(NamedTuple):
+    synced: int
+    added: int
+    removed: int
+    failed: List[int]
+
+
+class ChannelAdminSync:
+    """Keep `TelegramChannel.admins` in line with the administrators telegram lists for the channels
+
+    The administrators of all channels are fetched in batches of `ADMIN_SYNC_BATCH_SIZE` concurrent requests, with
+    `ADMIN_SYNC_BATCH_INTERVAL` seconds between the batches. Every batch is diffed against the stored rows, only the
+    missing users and the added and removed admin rows are written, an unchanged batch only updates the sync time.
+    Bots are not synced, channels which can not be fetched keep their admins.
+    """
+
+    def __init__(self, bot: Bot = None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self._bot = bot
+
+    @property
+    def bot(self) -> Bot:
+        return self._bot or chat_cache.default_bot()
+
+    def fetch(self, channel_id: int) -> Dict[int, User] or None:
+        """The users administrating the channel by id, None if they can not be fetched"""
+        try:
+            members = self.bot.get_chat_administrators(channel_id)
+        except TelegramError as error:
+            self.logger.info(f'Could not fetch the admins of {channel_id}: {error}')
+            return None
+        return {member.user.id: member.user for member in members if not member.user.is_bot}
+
+    def sync_batch(self, channel_ids: List[int]) -> AdminSyncResult:
+        with ThreadPoolExecutor(max_workers=len(channel_ids)) as executor:
+            fetched = dict(zip(channel_ids, executor.map(self.fetch, channel_ids)))
+        admins = {channel_id: users for channel_id, users in fetched.items() if users is not None}
+        failed = [channel_id for channel_id, users in fetched.items() if users is None]
+
+        through = TelegramChannel.admins.through
+        with transaction.atomic():
+            users = {user.id: user for channel_users in admins.values() for user in channel_users.values()}
+            existing = set(TelegramUser.objects.filter(id__in=list(users)).values_list('id', flat=True))
+            # A user starting the bot in the meantime is created by its handler as well
+            TelegramUser.objects.bulk_create([TelegramUser(id=user.id, username=user.username,
+                                                           full_name=user.full_name)
+                                              for user_id, user in users.items() if user_id not in existing],
+                                             ignore_conflicts=True)
+
+            rows = through.objects.filter(telegramchannel_id__in=list(admins)) \
+                .values_list('id', 'telegramchannel_id', 'telegramuser_id')
+            current = {(channel_id, user_id): row_id for row_id, channel_id, user_id in rows}
+            wanted = {(channel_id, user_id)
+                      for channel_id, channel_users in admins.items() for user_id in channel_users}
+
+            removed = [row_id for pair, row_id in current.items() if pair not in wanted]
+            if removed:
+                through.objects.filter(id__in=removed).delete()
+            added = [through(telegramchannel_id=channel_id, telegramuser_id=user_id)
+                     for channel_id, user_id in wanted - set(current)]
+            through.objects.bulk_create(added)
+            TelegramChannel.objects.filter(id__in=list(admins)).update(admins_synced=timezone.now())
+        return AdminSyncResult(len(admins), len(added), len(removed), failed)
+
+    def sync(self, channel_ids: List[int] = None) -> AdminSyncResult:
+        """Sync the admins of the channels, all by default"""
+        if channel_ids is None:
+            channel_ids = list(TelegramChannel.objects.order_by('id').values_list('id', flat=True))
+        batch_size = getattr(settings, 'ADMIN_SYNC_BATCH_SIZE', 20)
+        synced, added, removed, failed = 0, 0, 0, []
+        for start in range(0, len(channel_ids), batch_size):
+            if start:
+                time.sleep(getattr(settings, 'ADMIN_SYNC_BATCH_INTERVAL', 1))
+            result = self.sync_batch(channel_ids[start:start + batch_size])
+            synced, added, removed = synced + result.synced, added + result.added, removed + result.removed
+            failed.extend(result.failed)
+
+        self.logger.info(f'Synced the admins of {synced} channels, {added} added, {removed} removed, '
+                         f'{len(failed)} channels failed')
+        return AdminSyncResult(synced, added, removed, failed)
@@ -0,0 +1,220 @@
+import logging
+import time
+from collections import defaultdict, deque
+from datetime import datetime
+from typing import Dict, Iterable, List, NamedTuple
+
+from django.conf import settings
+from django.db.models import QuerySet
+from django.utils import timezone
+from telegram import Bot, Message, ParseMode, TelegramError
+from telegram.utils.promise import Promise
+
+from bot.models.broadcast import BroadcastRun, Delivery
+from bot.models.promo_group import Participant, PromoGroup
+from bot.promotion.media import PromotionMedia
+from bot.promotion.renderer import PostBuilder
+
+
+class BroadcastResult(NamedTuple):
+    group: PromoGroup
+    run: BroadcastRun
+    sent: List[int]
+    failed: Dict[int, TelegramError]
+
+
+class DeliveryLog:
+    """Write the deliveries of a run in batches of `BROADCAST_CHECKPOINT_SIZE`"""
+
+    def __init__(self, run: BroadcastRun):
+        self.run = run
+        self.size = getattr(settings, 'BROADCAST_CHECKPOINT_SIZE', 50)
+        self._pending: List[Delivery] = []
+
+    def add(self, participant: Participant, message: Message = None, error: TelegramError = None):
+        self._pending.append(Delivery(run=self.run, participant=participant,
+                                      status=Delivery.FAILED if error else Delivery.SENT,
+                                      message_id=message.message_id if isinstance(message, Message) else None,
+                                      error=str(error or '')))
+        if len(self._pending) >= self.size:
+            self.flush()
+
+    def flush(self):
+        if self._pending:
+            Delivery.objects.bulk_create(self._pending, ignore_conflicts=True)
+            self._pending = []
+
+
+class Broadcaster:
+    """Post the promotion of the due `PromoGroup`s to all their active participants
+
+    Messages are sent through the `MessageQueue` of the bot if it has one (`MESSAGEQUEUE_ENABLED`). The bot of
+    `MyBot` waits for the shared `rate_limiter`, which keeps the sends of all processes within the flood limits, other
+    bots without a queue send at most `BROADCAST_RATE` messages per second.
+
+    The media of a group is uploaded with the first post only, see `PromotionMedia`.
+    """
+
+    def __init__(self, bot: Bot = None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self._bot = bot
+        self._last_send = 0
+
+    @property
+    def bot(self) -> Bot:
+        if self._bot:
+            return self._bot
+        from bot.telegrambot import my_bot
+        return my_bot.bot
+
+    @property
+    def queued(self) -> bool:
+        return hasattr(self.bot, '_msg_queue')
+
+    @staticmethod
+    def due(now: datetime = None) -> QuerySet:
+        return PromoGroup.objects.filter(active=True, post_at__lte=now or timezone.now())
+
+    def run_due(self, now: datetime = None) -> List[BroadcastResult]:
+        now = now or timezone.now()
+        results = []
+        for group in self.due(now):
+            results.append(self.broadcast(group))
+            self.reschedule(group, now)
+        return results
+
+    @staticmethod
+    def reschedule(group: PromoGroup, now: datetime = None):
+        now = now or timezone.now()
+        if group.post_interval:
+            while group.post_at <= now:
+                group.post_at += group.post_interval
+        else:
+            group.post_at = None
+        group.save(update_fields=['post_at', 'modified'])
+
+    def broadcast(self, group: PromoGroup, scheduled_for: datetime = None) -> BroadcastResult:
+        """Post the promotion of the group to all its active participants
+
+        Every post is logged as a `Delivery` of the `BroadcastRun` of the group and `scheduled_for` (the current
+        `post_at` by default). Broadcasting the same run again only posts to the participants without a delivery, so
+        an interrupted run is resumed from the last written batch.
+        """
+        run = BroadcastRun.objects.get_or_create(promo_group=group,
+                                                 scheduled_for=scheduled_for or group.post_at or timezone.now())[0]
+        if run.finished:
+            self.logger.info(f'Promotion of "{group.name}" for {run.scheduled_for} was already posted')
+            return BroadcastResult(group, run, [], {})
+
+        participants = list(group.participants.filter(active=True).select_related('channel'))
+        delivered = set(run.deliveries.values_list('participant_id', flat=True))
+        targets = {participant.channel_id: participant for participant in participants
+                   if participant.id not in delivered}
+
+        media = PromotionMedia(group) if group.has_media else None
+        posts = {chat_id: media.prepare(messages) if media else [(text, False) for text in messages]
+                 for chat_id, messages in self.render_posts(group, participants, targets.values()).items()}
+        self.logger.info(f'Broadcast promotion of "{group.name}" to {len(posts)} channels '
+                         f'({len(delivered)} already done)')
+
+        log = DeliveryLog(run)
+        pending, failed, sent = defaultdict(list), {}, []
+
+        def finish(chat_id):
+            """Wait for the messages of the post to the chat and log its delivery"""
+            try:
+                if chat_id in failed:
+                    raise failed[chat_id]
+                results = [self.result(chat_id, result, media if with_media else None, text, file_id)
+                           for (text, with_media), (result, file_id) in zip(posts[chat_id], pending[chat_id])]
+                sent.append(chat_id)
+                log.add(targets[chat_id], message=results[0] if results else None)
+            except TelegramError as error:
+                failed[chat_id] = error
+                log.add(targets[chat_id], error=error)
+
+        # Send the first message of every post first, then the second ones and so on. This way the messages of a post
+        # are as far apart as possible. A post is logged as soon as its last message was sent, queued messages once
+        # they were sent by the queue, so an interrupted run is resumed after the last written batch.
+        waiting = deque()
+        for part in range(max(map(len, posts.values()), default=0)):
+            for chat_id, messages in posts.items():
+                if part >= len(messages) or chat_id in failed:
+                    continue
+                text, with_media = messages[part]
+                try:
+                    result = self.send(chat_id, text, media if with_media else None)
+                    pending[chat_id].append((result, media.file_id if with_media else None))
+                except TelegramError as error:
+                    failed[chat_id] = error
+                if chat_id in failed or part == len(messages) - 1:
+                    waiting.append(chat_id)
+
+                while waiting and all(not isinstance(promise, Promise) or promise.done.is_set()
+                                      for promise, _ in pending[waiting[0]]):
+                    finish(waiting.popleft())
+
+        while waiting:
+            finish(waiting.popleft())
+        log.flush()
+
+        run.finished = timezone.now()
+        run.save(update_fields=['finished', 'modified'])
+
+        for chat_id, error in failed.items():
+            self.logger.warning(f'Could not post promotion of "{group.name}" to {chat_id}: {error}')
+        return BroadcastResult(group, run, sent, failed)
+
+    @staticmethod
+    def links(participants: List[Participant]) -> Dict[int, str or None]:
+        """The stored links of the channels, see `InviteLinkRefresher`"""
+        return {participant.channel_id: participant.channel.link for participant in participants}
+
+    def render_posts(self, group: PromoGroup, participants: List[Participant],
+                     targets: Iterable[Participant] = None) -> Dict[int, List[str]]:
+        """Render the messages of the post for every target (all participants by default)
+
+        Every post lists all the other participants and is split into multiple messages if it is too long.
+        """
+        return PostBuilder(group, participants, self.links(participants)).build_all(targets)
+
+    def _wait(self):
+        if getattr(self.bot._request, '_rate_limited', False):
+            return
+        delay = self._last_send + 1 / getattr(settings, 'BROADCAST_RATE', 30) - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        self._last_send = time.monotonic()
+
+    def send(self, chat_id: int, text: str or None, media: PromotionMedia = None) -> Message or Promise:
+        """Send a message, or the media with `text` as caption
+
+        Without a file id the media is uploaded right away, so the following posts can use the id.
+        """
+        if media and not media.file_id:
+            if not self.queued:
+                self._wait()
+            return media.send(self.bot, chat_id, text)
+
+        if media:
+            method, kwargs = media.method(self.bot), media.kwargs(text)
+            if self.queued:
+                return self.bot._msg_queue(Promise(method, (chat_id,), kwargs), False)
+            self._wait()
+            return self.result(chat_id, lambda: method(chat_id, **kwargs), media, text, media.file_id)
+
+        kwargs = {'parse_mode': ParseMode.HTML, 'disable_web_page_preview': True}
+        if self.queued:
+            return self.bot.send_message(chat_id, text, queued=True, isgroup=False, **kwargs)
+        self._wait()
+        return self.bot.send_message(chat_id, text, **kwargs)
+
+    def result(self, chat_id: int, result, media: PromotionMedia = None, text: str = None,
+               file_id: str = None) -> Message:
+        """Wait for the result of a send, the media is sent again if the file id it was sent with was rejected"""
+        try:
+            return result.result() if isinstance(result, Promise) else result() if callable(result) else result
+        except TelegramError as error:
+            if not (media and media.rejected(error)):
+                raise
+            return media.resend(self.bot, chat_id, text, error, file_id)
@@ -0,0 +1,85 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple
+
+from django.conf import settings
+from django.utils import timezone
+from telegram import Bot, TelegramError
+from telegram.error import BadRequest, ChatMigrated, RetryAfter, Unauthorized
+
+from bot.models.promo_group import Participant
+from bot.utils.cache import chat_cache
+from bot.utils.chat import bot_permission_problem
+
+
+class HealthCheckResult(NamedTuple):
+    checked: int
+    # Reason per channel id
+    failing: Dict[int, str]
+    unknown: List[int]
+    deactivated: int
+
+
+class ParticipantHealthCheck:
+    """Deactivate the participants whose channel the bot can not post in anymore, so broadcasts skip them
+
+    The bot's membership and rights are checked in all channels with an active participant, with
+    `HEALTH_CHECK_WORKERS` concurrent requests. Network errors are retried up to `HEALTH_CHECK_RETRIES` times with
+    an exponential backoff starting at `HEALTH_CHECK_BACKOFF` seconds, a channel which still can not be checked is
+    left as it is. The failing participants are deactivated with a single query.
+    """
+
+    def __init__(self, bot: Bot = None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self._bot = bot
+
+    @property
+    def bot(self) -> Bot:
+        return self._bot or chat_cache.default_bot()
+
+    def check(self, channel_id: int) -> str or None:
+        """Why the bot can not post in the channel, None if it can, raises a `TelegramError` if it is unknown"""
+        retries = getattr(settings, 'HEALTH_CHECK_RETRIES', 3)
+        backoff = getattr(settings, 'HEALTH_CHECK_BACKOFF', 1)
+        for attempt in range(retries + 1):
+            try:
+                return bot_permission_problem(self.bot, channel_id)
+            except (Unauthorized, BadRequest, ChatMigrated) as error:
+                return error.message
+            except RetryAfter as error:
+                if attempt == retries:
+                    raise
+                time.sleep(error.retry_after)
+            except TelegramError as error:
+                if attempt == retries:
+                    raise
+                self.logger.debug(f'Could not check {channel_id}, retry in {backoff * 2 ** attempt}s: {error}')
+                time.sleep(backoff * 2 ** attempt)
+
+    def run(self) -> HealthCheckResult:
+        channel_ids = list(Participant.objects.filter(active=True).order_by('channel_id')
+                           .values_list('channel_id', flat=True).distinct())
+
+        def check(channel_id):
+            try:
+                return self.check(channel_id)
+            except TelegramError as error:
+                self.logger.warning(f'Could not check {channel_id}: {error}')
+                return error
+
+        workers = getattr(settings, 'HEALTH_CHECK_WORKERS', 8)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = dict(zip(channel_ids, executor.map(check, channel_ids)))
+
+        failing = {channel_id: result for channel_id, result in results.items() if isinstance(result, str)}
+        unknown = [channel_id for channel_id, result in results.items() if isinstance(result, TelegramError)]
+        deactivated = 0
+        if failing:
+            deactivated = Participant.objects.filter(channel_id__in=list(failing), active=True) \
+                .update(active=False, modified=timezone.now())
+            for channel_id, reason in failing.items():
+                self.logger.info(f'Deactivated the participants of {channel_id}: {reason}')
+        self.logger.info(f'Checked {len(channel_ids)} channels, deactivated {deactivated} participants, '
+                         f'{len(unknown)} channels could not be checked')
+        return HealthCheckResult(len(channel_ids), failing, unknown, deactivated)
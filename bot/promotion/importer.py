@@ -0,0 +1,139 @@
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from telegram import Bot, Chat, TelegramError
+
+from bot.models.promo_group import Participant, PromoGroup, TelegramChannel
+from bot.utils.cache import ChatInfo, chat_cache
+from bot.utils.chat import bot_permission_problem
+
+REFERENCE = re.compile(r'^(?:(?:https?://)?(?:t\.me|telegram\.me)/|@)?([A-Za-z]\w{3,31}|-?\d+)$')
+
+
+class ImportResult(NamedTuple):
+    added: List[TelegramChannel]
+    # Inactive participants which were activated again
+    reactivated: List[TelegramChannel]
+    existing: List[TelegramChannel]
+    failed: Dict[str, str]
+
+
+class ParticipantImporter:
+    """Add many channels given by @username, t.me link or id to a `PromoGroup` at once
+
+    The channels are fetched and checked (the bot has to be an admin) with `PARTICIPANT_IMPORT_WORKERS` concurrent
+    requests, then all new `TelegramChannel`s and `Participant`s are inserted with one query each. Inactive
+    participants of the group are activated again.
+    """
+
+    def __init__(self, group: PromoGroup, bot: Bot = None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.group = group
+        self._bot = bot
+
+    @property
+    def bot(self) -> Bot:
+        return self._bot or chat_cache.default_bot()
+
+    @staticmethod
+    def parse(text: str) -> List[str]:
+        """The channel references in the text, separated by whitespace or commas, invalid ones are kept as they are
+
+        Ids are kept as numbers in the result, usernames get an "@".
+        """
+        references = []
+        for part in filter(None, re.split(r'[\s,;]+', text)):
+            match = REFERENCE.match(part)
+            if not match:
+                references.append(part)
+            elif match.group(1).lstrip('-').isdigit():
+                references.append(int(match.group(1)))
+            else:
+                references.append(f'@{match.group(1)}')
+        return list(dict.fromkeys(references))
+
+    def check(self, reference: str or int) -> ChatInfo:
+        """Fetch the channel, raises a `ValueError` if it can not be added"""
+        if isinstance(reference, str) and not reference.startswith('@'):
+            raise ValueError('not a @username, link or id')
+        try:
+            chat = self.bot.get_chat(reference)
+            if chat.type != Chat.CHANNEL:
+                raise ValueError('not a channel')
+
+            problem = bot_permission_problem(self.bot, chat.id)
+            if problem:
+                raise ValueError(problem)
+            if not chat.username and not chat.invite_link:
+                # Private channels are linked by their invite link
+                chat.invite_link = self.bot.export_chat_invite_link(chat.id)
+        except TelegramError as error:
+            raise ValueError(error.message)
+        return chat_cache.put(chat)
+
+    def resolve(self, references: List[str or int]) -> Dict[str or int, ChatInfo or str]:
+        """The chat info of every reference or the reason why it can not be added"""
+        def check(reference):
+            try:
+                return self.check(reference)
+            except ValueError as error:
+                return str(error)
+
+        workers = getattr(settings, 'PARTICIPANT_IMPORT_WORKERS', 8)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return dict(zip(references, executor.map(check, references)))
+
+    def run(self, text: str) -> ImportResult:
+        resolved = self.resolve(self.parse(text))
+        failed = {str(reference): result for reference, result in resolved.items() if isinstance(result, str)}
+        chats = {info.id: info for info in resolved.values() if isinstance(info, ChatInfo)}
+
+        with transaction.atomic():
+            channels = TelegramChannel.objects.in_bulk(list(chats))
+            for channel in channels.values():
+                channel.auto_update_values(chats[channel.id], save=False)
+                channel.set_invite_link(chats[channel.id].invite_link, save=False)
+                channel.modified = timezone.now()
+            TelegramChannel.objects.bulk_update(
+                channels.values(), TelegramChannel.auto_update + ['invite_link', 'invite_link_fetched', 'modified'])
+
+            now = timezone.now()
+            new_channels = [TelegramChannel(id=info.id, username=info.username, title=info.title,
+                                            invite_link=info.invite_link or '', invite_link_fetched=now)
+                            for chat_id, info in chats.items() if chat_id not in channels]
+            TelegramChannel.objects.bulk_create(new_channels)
+            channels.update({channel.id: channel for channel in new_channels})
+
+            # Active state by channel id
+            participating = dict(Participant.objects.filter(promo_group=self.group, channel_id__in=list(chats))
+                                 .values_list('channel_id', 'active'))
+            added = [channels[chat_id] for chat_id in chats if chat_id not in participating]
+            Participant.objects.bulk_create(Participant(channel=channel, promo_group=self.group, active=True)
+                                            for channel in added)
+            reactivated = [channels[chat_id] for chat_id in chats if participating.get(chat_id) is False]
+            if reactivated:
+                Participant.objects.filter(promo_group=self.group, channel__in=reactivated) \
+                    .update(active=True, modified=now)
+
+        existing = [channels[chat_id] for chat_id in chats if participating.get(chat_id)]
+        self.logger.info(f'Imported {len(added)} participants to "{self.group.name}", reactivated '
+                         f'{len(reactivated)}, {len(existing)} already participated, {len(failed)} failed')
+        return ImportResult(added, reactivated, existing, failed)
+
+    def report(self, result: ImportResult) -> str:
+        lines = [f'Added {len(result.added)} participants to "{self.group.name}".']
+        if result.reactivated:
+            names = ', '.join(channel.username_or_title() for channel in result.reactivated)
+            lines.append(f'Reactivated: {names}')
+        if result.existing:
+            names = ', '.join(channel.username_or_title() for channel in result.existing)
+            lines.append(f'Already participating: {names}')
+        if result.failed:
+            lines.append('Could not add:')
+            lines.extend(f'{reference}: {reason}' for reference, reason in result.failed.items())
+        return '\n'.join(lines)
@@ -0,0 +1,75 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import List
+
+from django.conf import settings
+from django.db.models import F, QuerySet
+from django.utils import timezone
+from telegram import Bot, TelegramError
+
+from bot.models.promo_group import TelegramChannel
+from bot.utils.cache import chat_cache
+
+
+class InviteLinkRefresher:
+    """Keep the stored links, usernames and titles of the participating channels up to date
+
+    Posts and the admin only read the stored values. Channels whose values were fetched more than
+    `INVITE_LINK_MAX_AGE` seconds ago are fetched again in batches of `INVITE_LINK_BATCH_SIZE` concurrent requests,
+    with `INVITE_LINK_BATCH_INTERVAL` seconds between the batches. A new invite link is only exported for private
+    channels without one, exporting revokes the previous link which is still in older posts.
+    """
+
+    def __init__(self, bot: Bot = None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self._bot = bot
+
+    @property
+    def bot(self) -> Bot:
+        return self._bot or chat_cache.default_bot()
+
+    @staticmethod
+    def stale(now=None) -> QuerySet:
+        max_age = timedelta(seconds=getattr(settings, 'INVITE_LINK_MAX_AGE', 24 * 3600))
+        fetched_before = (now or timezone.now()) - max_age
+        return (TelegramChannel.objects.filter(participating__isnull=False).distinct()
+                .exclude(invite_link_fetched__gt=fetched_before)
+                .order_by(F('invite_link_fetched').asc(nulls_first=True)))
+
+    def fetch(self, channel: TelegramChannel) -> TelegramChannel:
+        try:
+            chat = self.bot.get_chat(channel.id)
+            channel.auto_update_values(chat_cache.put(chat), save=False)
+            invite_link = chat.invite_link
+            if not chat.username and not invite_link and not channel.invite_link:
+                invite_link = self.bot.export_chat_invite_link(channel.id)
+            channel.set_invite_link(invite_link, save=False)
+        except TelegramError as error:
+            # The stored values are kept and fetched again after INVITE_LINK_MAX_AGE
+            self.logger.info(f'Could not fetch the link of {channel.id}: {error}')
+            channel.set_invite_link(None, save=False)
+        return channel
+
+    def refresh_batch(self, channels: List[TelegramChannel]):
+        with ThreadPoolExecutor(max_workers=len(channels)) as executor:
+            channels = list(executor.map(self.fetch, channels))
+        now = timezone.now()
+        for channel in channels:
+            channel.modified = now
+        TelegramChannel.objects.bulk_update(
+            channels, TelegramChannel.auto_update + ['invite_link', 'invite_link_fetched', 'modified'])
+
+    def refresh(self, limit: int = None) -> int:
+        """Fetch the stale channels, at most `limit`, returns the number of fetched channels"""
+        channels = list(self.stale()[:limit] if limit else self.stale())
+        batch_size = getattr(settings, 'INVITE_LINK_BATCH_SIZE', 20)
+        for start in range(0, len(channels), batch_size):
+            if start:
+                time.sleep(getattr(settings, 'INVITE_LINK_BATCH_INTERVAL', 1))
+            self.refresh_batch(channels[start:start + batch_size])
+
+        if channels:
+            self.logger.info(f'Refreshed the links of {len(channels)} channels')
+        return len(channels)
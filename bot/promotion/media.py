@@ -0,0 +1,96 @@
+import logging
+import threading
+from typing import Callable, List, Tuple
+
+from telegram import Bot, Message, ParseMode
+from telegram.error import BadRequest, TelegramError
+
+from bot.models.promo_group import PromoGroup
+from bot.promotion.renderer import text_length
+
+CAPTION_LIMIT = 1024
+
+
+class PromotionMedia:
+    """The media of a promotion, uploaded once and then sent by its telegram `file_id`
+
+    The first post of a group uploads the media file and stores the returned `file_id` on the group, every later post,
+    also in later runs, only sends that id. A new upload is only made if telegram rejects the stored id.
+    """
+
+    METHODS = {
+        PromoGroup.PHOTO: 'send_photo',
+        PromoGroup.VIDEO: 'send_video',
+        PromoGroup.ANIMATION: 'send_animation',
+        PromoGroup.DOCUMENT: 'send_document',
+    }
+
+    def __init__(self, group: PromoGroup):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.group = group
+        self.lock = threading.Lock()
+
+    @property
+    def file_id(self) -> str or None:
+        return self.group.media_file_id or None
+
+    @property
+    def can_upload(self) -> bool:
+        return bool(self.group.media_file)
+
+    def method(self, bot: Bot) -> Callable:
+        return getattr(bot, self.METHODS[self.group.media_type])
+
+    def kwargs(self, caption: str or None) -> dict:
+        """Arguments of the send method, the media is uploaded if there is no file id yet"""
+        if self.file_id:
+            media = self.file_id
+        else:
+            self.group.media_file.open('rb')
+            self.group.media_file.seek(0)
+            media = self.group.media_file.file
+        return {self.group.media_type: media, 'caption': caption, 'parse_mode': ParseMode.HTML if caption else None}
+
+    @staticmethod
+    def prepare(messages: List[str]) -> List[Tuple[str or None, bool]]:
+        """The (text, with media) messages of a post, the first message is the caption if it is short enough"""
+        if messages and text_length(messages[0]) <= CAPTION_LIMIT:
+            return [(messages[0], True)] + [(text, False) for text in messages[1:]]
+        return [(None, True)] + [(text, False) for text in messages]
+
+    def remember(self, message: Message):
+        """Store the file id of the media sent with `message`"""
+        media = getattr(message, self.group.media_type, None)
+        if isinstance(media, list):
+            media = media[-1] if media else None
+        if media and media.file_id != self.group.media_file_id:
+            self.group.media_file_id = media.file_id
+            self.group.save(update_fields=['media_file_id', 'modified'])
+
+    @staticmethod
+    def rejected(error: TelegramError) -> bool:
+        """Whether the error means the file id is not valid (anymore)"""
+        return isinstance(error, BadRequest) and 'file' in error.message.lower()
+
+    def send(self, bot: Bot, chat_id: int, caption: str or None) -> Message:
+        """Send the media right away, uploading it and storing the new file id if there is none"""
+        with self.lock:
+            try:
+                message = self.method(bot)(chat_id, **self.kwargs(caption))
+            finally:
+                if self.group.media_file:
+                    self.group.media_file.close()
+            if not self.file_id:
+                self.remember(message)
+            return message
+
+    def resend(self, bot: Bot, chat_id: int, caption: str or None, error: TelegramError,
+               rejected_id: str) -> Message:
+        """Send the media again after its file id was rejected, it is uploaded again once per rejected id"""
+        if not self.can_upload:
+            raise error
+        with self.lock:
+            if self.file_id == rejected_id:
+                self.logger.info(f'File id of the media of "{self.group.name}" was rejected, uploading it again')
+                self.group.media_file_id = ''
+        return self.send(bot, chat_id, caption)
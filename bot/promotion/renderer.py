@@ -0,0 +1,142 @@
+import html
+import re
+from typing import Dict, Iterable, List, Tuple
+
+from django.template.loader import get_template
+from django.utils.safestring import mark_safe
+
+from bot.models.promo_group import Participant, PromoGroup
+
+MESSAGE_LIMIT = 4096
+SEPARATOR = '\n'
+_MARKER = '\x00participants\x00'
+_TAG = re.compile(r'<[^>]+>')
+_TAG_NAME = re.compile(r'<(/?)([a-zA-Z][\w-]*)[^>]*>')
+PLACEHOLDER = re.compile(r'{{\s*([\w.]+)\s*}}')
+PLACEHOLDERS = ['participants', 'group.name', 'group']
+
+
+def text_length(text: str) -> int:
+    """Length of a HTML message like telegram counts it, the text without tags in UTF-16 code units"""
+    return len(html.unescape(_TAG.sub('', text)).encode('utf-16-le')) // 2
+
+
+def open_tags(text: str) -> List[Tuple[str, str]]:
+    """The (name, start tag) of the HTML tags still open at the end of the text, outermost first"""
+    tags = []
+    for match in _TAG_NAME.finditer(text):
+        closing, name = match.group(1), match.group(2).lower()
+        if not closing:
+            tags.append((name, match.group(0)))
+            continue
+        for position in range(len(tags) - 1, -1, -1):
+            if tags[position][0] == name:
+                del tags[position:]
+                break
+    return tags
+
+
+def template_problem(template: str) -> str or None:
+    """Why the template of a group can not be used, None if it can"""
+    if '{%' in template:
+        return 'tags like "{% ... %}" are not supported'
+    unknown = [name for name in PLACEHOLDER.findall(template) if name not in PLACEHOLDERS]
+    if unknown:
+        return f'unknown placeholder "{{{{ {unknown[0]} }}}}", use "{{{{ participants }}}}" or "{{{{ group.name }}}}"'
+    return None
+
+
+def render_group_template(template: str, values: Dict[str, str]) -> str:
+    """Fill the "{{ name }}" placeholders of a template written by a group admin
+
+    The template is written through the bot, so it is not rendered as a Django template. Only the placeholders in
+    `values` are filled, all other ones are left empty.
+    """
+    return PLACEHOLDER.sub(lambda match: values.get(match.group(1), ''), template)
+
+
+class PostBuilder:
+    """Build the promotion posts of a group for every participant
+
+    The template and the link of every participant are only rendered once. The links are then split into chunks which
+    fit into a message together with the text before and after the list. The post of a participant is made of these
+    chunks, only the chunk containing its own link is rebuilt without it. Everything else is shared between the
+    posts, so building the posts of large groups takes roughly linear time.
+
+    The template of the group only has the `PLACEHOLDERS`, see `render_group_template`, the trusted default template
+    `promotion/post.html` is a Django template. If the template contains the participants list more than once, only
+    the first one is filled. Tags around the list, like "<b>{{ participants }}</b>", are closed at the end of every
+    message and opened again at the start of the next one.
+    """
+
+    def __init__(self, group: PromoGroup, participants: List[Participant], links: Dict[int, str or None],
+                 limit: int = MESSAGE_LIMIT):
+        self.limit = limit
+        self.participants = participants
+
+        if group.template.strip():
+            name = html.escape(group.name)
+            rendered = render_group_template(group.template, {'participants': _MARKER, 'group.name': name,
+                                                              'group': name})
+        else:
+            rendered = get_template('promotion/post.html').render({'group': group, 'participants': mark_safe(_MARKER)})
+        rendered = rendered.strip()
+        self.head, _, tail = rendered.partition(_MARKER)
+        self.tail = tail.replace(_MARKER, '')
+        self.has_list = _MARKER in rendered
+        tags = open_tags(self.head)
+        self._reopen = ''.join(tag for _, tag in tags)
+        self._close = ''.join(f'</{name}>' for name, _ in reversed(tags))
+
+        fragment = get_template('promotion/participant.html')
+        self.fragments = [fragment.render({'channel': participant.channel,
+                                           'link': links.get(participant.channel_id)}).strip()
+                          for participant in participants]
+        self.lengths = [text_length(text) for text in self.fragments]
+
+        self.chunks = self._plan()
+        self._chunk_of = {index: number for number, chunk in enumerate(self.chunks) for index in range(*chunk)}
+        self._texts = [self._join(chunk) for chunk in self.chunks]
+
+    def _plan(self) -> List[Tuple[int, int]]:
+        """Split the fragments into (start, end) chunks fitting into a message, the first one after the head"""
+        chunks = []
+        start, size = 0, text_length(self.head)
+        for index, length in enumerate(self.lengths):
+            added = length + (len(SEPARATOR) if index > start else 0)
+            if index > start and size + added > self.limit:
+                chunks.append((start, index))
+                start, size, added = index, 0, length
+            size += added
+        if start < len(self.fragments):
+            chunks.append((start, len(self.fragments)))
+        return chunks
+
+    def _join(self, chunk: Tuple[int, int], exclude: int = None) -> str:
+        return SEPARATOR.join(self.fragments[index] for index in range(*chunk) if index != exclude)
+
+    def _messages(self, texts: List[str]) -> List[str]:
+        if not self.has_list or not texts:
+            return [f'{self.head}{self.tail}'.strip()]
+
+        messages = [f'{self.head}{texts[0]}'] + [f'{self._reopen}{text}' for text in texts[1:]]
+        if text_length(messages[-1]) + text_length(self.tail) <= self.limit:
+            messages = [f'{message}{self._close}' for message in messages[:-1]] + [messages[-1] + self.tail]
+        else:
+            messages = [f'{message}{self._close}' for message in messages] + [f'{self._reopen}{self.tail}']
+        # Messages with nothing but tags, eg. a chunk of only the own channel, are left out
+        return [message.strip() for message in messages if html.unescape(_TAG.sub('', message)).strip()]
+
+    def build(self, index: int) -> List[str]:
+        """The messages of the post for the participant at `index`"""
+        number = self._chunk_of.get(index)
+        texts = list(self._texts)
+        if number is not None:
+            texts[number] = self._join(self.chunks[number], exclude=index)
+        return self._messages(texts)
+
+    def build_all(self, targets: Iterable[Participant] = None) -> Dict[int, List[str]]:
+        """The messages of the posts for every target (all participants by default) by channel id"""
+        indexes = {participant.channel_id: index for index, participant in enumerate(self.participants)}
+        targets = self.participants if targets is None else targets
+        return {participant.channel_id: self.build(indexes[participant.channel_id]) for participant in targets}
@@ -0,0 +1,239 @@
+import heapq
+import logging
+import queue
+import select
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Set, Tuple
+
+from django.conf import settings
+from django.db import DatabaseError, connection, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from bot.models.promo_group import PromoGroup
+
+CHANNEL = 'promo_group_schedule'
+
+
+class ScheduleListener:
+    """Get notified about changed `PromoGroup` schedules
+
+    LISTEN/NOTIFY only works on PostgreSQL. There the changes are sent with NOTIFY, so a scheduler in another process
+    (`manage.py broadcast --loop`) sees the changes made by the bot. On other databases only changes made in the same
+    process are seen, the scheduler picks up the others with its periodic reload.
+    """
+
+    @property
+    def errors(self) -> tuple:
+        """The errors of a lost connection"""
+        return OSError, ValueError, DatabaseError, connection.Database.Error
+
+    def __init__(self):
+        self._changes = queue.Queue()
+        self._connection = None
+
+    @property
+    def postgres(self) -> bool:
+        return connection.vendor == 'postgresql'
+
+    @property
+    def lost(self) -> bool:
+        """Whether the LISTEN connection of PostgreSQL is missing, changes are not reported without it"""
+        return self.postgres and not self._connection
+
+    def notify(self, group_id: int):
+        if self.postgres:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_notify(%s, %s)', [CHANNEL, str(group_id)])
+        else:
+            self._changes.put(group_id)
+
+    def listen(self):
+        if self.postgres and not self._connection:
+            self._connection = connection.get_new_connection(connection.get_connection_params())
+            self._connection.autocommit = True
+            with self._connection.cursor() as cursor:
+                cursor.execute(f'LISTEN {CHANNEL}')
+
+    def close(self):
+        if self._connection:
+            self._connection.close()
+            self._connection = None
+
+    def wait(self, timeout: float = None) -> Set[int]:
+        """Wait at most `timeout` seconds for changes and return the ids of the changed groups"""
+        changed = set()
+        if self._connection:
+            if select.select([self._connection], [], [], timeout)[0]:
+                self._connection.poll()
+                while self._connection.notifies:
+                    changed.add(int(self._connection.notifies.pop(0).payload))
+            return changed
+
+        try:
+            changed.add(self._changes.get(timeout=timeout))
+            while True:
+                changed.add(self._changes.get_nowait())
+        except queue.Empty:
+            pass
+        return changed
+
+
+listener = ScheduleListener()
+
+
+@receiver(post_save, sender=PromoGroup)
+@receiver(post_delete, sender=PromoGroup)
+def promo_group_changed(sender, instance: PromoGroup, update_fields=None, **kwargs):
+    if update_fields and not {'post_at', 'active'} & set(update_fields):
+        return
+    transaction.on_commit(lambda: listener.notify(instance.id))
+
+
+class PromotionScheduler:
+    """In memory index of the upcoming promotion posts
+
+    The send times are kept in a heap built from the database at startup and updated with the changes reported by the
+    `ScheduleListener`. Between the posts the scheduler sleeps until the next one is due or a schedule changes.
+    Replaced schedules are left in the heap and skipped when they come up, the heap is rebuilt once more than half of
+    it are such stale entries.
+
+    Without PostgreSQL the changes of other processes are not reported, all schedules are read again every
+    `SCHEDULER_RELOAD_INTERVAL` seconds. With PostgreSQL they are only read again after the LISTEN connection was
+    lost and connected again.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self._heap: List[Tuple[float, int]] = []
+        self._schedule: Dict[int, float] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._schedule)
+
+    def load(self):
+        with self._lock:
+            self._heap, self._schedule = [], {}
+        self.reload(None)
+
+    def reload(self, group_ids: Iterable[int] or None):
+        """Read the schedules of the given groups or all groups from the database"""
+        groups = PromoGroup.objects.all() if group_ids is None else PromoGroup.objects.filter(id__in=group_ids)
+        found = set()
+        for group_id, post_at, active in groups.values_list('id', 'post_at', 'active').iterator():
+            found.add(group_id)
+            self.update(group_id, post_at if active else None)
+
+        for group_id in set(group_ids or ()) - found:
+            self.update(group_id, None)
+
+    def update(self, group_id: int, post_at=None):
+        with self._lock:
+            if post_at is None:
+                self._schedule.pop(group_id, None)
+            else:
+                timestamp = post_at.timestamp()
+                if self._schedule.get(group_id) != timestamp:
+                    self._schedule[group_id] = timestamp
+                    heapq.heappush(self._heap, (timestamp, group_id))
+
+            if len(self._heap) > 2 * len(self._schedule) + 64:
+                self._heap = [(timestamp, group_id) for group_id, timestamp in self._schedule.items()]
+                heapq.heapify(self._heap)
+
+    def next_due(self) -> float or None:
+        """Timestamp of the next post"""
+        with self._lock:
+            while self._heap and self._schedule.get(self._heap[0][1]) != self._heap[0][0]:
+                heapq.heappop(self._heap)
+            return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: float = None) -> List[int]:
+        now = now or time.time()
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                timestamp, group_id = heapq.heappop(self._heap)
+                if self._schedule.get(group_id) == timestamp:
+                    del self._schedule[group_id]
+                    due.append(group_id)
+        return due
+
+    def post_due(self, broadcaster, now: datetime = None) -> List[int]:
+        """Post the due promotions, returns the ids of the posted groups"""
+        now = now or timezone.now()
+        due = self.pop_due(now.timestamp())
+        if not due:
+            return []
+
+        retry_delay = getattr(settings, 'SCHEDULER_RETRY_DELAY', 60)
+        posted, failed = [], []
+        for group in broadcaster.due(now).filter(id__in=due):
+            try:
+                broadcaster.broadcast(group)
+                broadcaster.reschedule(group, now)
+            except Exception:
+                # Tried again later, the broadcast resumes where it stopped
+                self.logger.exception(f'Could not post the promotion of {group.id}, retry in {retry_delay}s')
+                self.update(group.id, now + timedelta(seconds=retry_delay))
+                failed.append(group.id)
+                continue
+            self.update(group.id, group.post_at)
+            posted.append(group.id)
+
+        # The schedule of the other groups changed in the meantime, they get their current one
+        missed = set(due) - set(posted) - set(failed)
+        if missed:
+            self.reload(missed)
+        return posted
+
+    def run(self, broadcaster, stop: threading.Event = None):
+        """Post the promotions when they are due until `stop` is set"""
+        listener.listen()
+        self.load()
+        self.logger.info(f'Scheduler started with {len(self)} scheduled promotions')
+        reload_interval = 0 if listener.postgres else getattr(settings, 'SCHEDULER_RELOAD_INTERVAL', 300)
+        retry_delay = getattr(settings, 'SCHEDULER_RETRY_DELAY', 60)
+        loaded = time.monotonic()
+
+        try:
+            while not (stop and stop.is_set()):
+                if listener.lost:
+                    try:
+                        listener.listen()
+                        # Changes made without the connection were not reported
+                        self.load()
+                        self.logger.info('Listening for schedule changes again')
+                    except listener.errors as error:
+                        listener.close()
+                        self.logger.warning(f'Could not listen for schedule changes, retry in {retry_delay}s: {error}')
+
+                next_due = self.next_due()
+                timeout = None if next_due is None else max(0, next_due - time.time())
+                if reload_interval:
+                    until_reload = max(0, loaded + reload_interval - time.monotonic())
+                    timeout = until_reload if timeout is None else min(timeout, until_reload)
+                if listener.lost:
+                    timeout = retry_delay if timeout is None else min(timeout, retry_delay)
+                if stop:
+                    timeout = 1 if timeout is None else min(timeout, 1)
+
+                try:
+                    changed = listener.wait(timeout)
+                except listener.errors as error:
+                    self.logger.warning(f'Lost the connection listening for schedule changes: {error}')
+                    listener.close()
+                    continue
+                if reload_interval and time.monotonic() - loaded >= reload_interval:
+                    self.load()
+                    loaded = time.monotonic()
+                elif changed:
+                    self.reload(changed)
+
+                self.post_due(broadcaster)
+        finally:
+            listener.close()
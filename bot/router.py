@@ -0,0 +1,174 @@
+import bisect
+import heapq
+import itertools
+import logging
+import math
+import time
+from collections import defaultdict
+from typing import Dict, Iterable, List, Set, Tuple
+
+from telegram import MessageEntity, Update
+from telegram.ext import BaseFilter, CommandHandler, DispatcherHandlerStop, Handler, MessageHandler
+from telegram.ext.filters import MergedFilter
+
+from bot.utils import metrics
+from bot.utils.context import UpdateContext
+
+ANY = None
+
+Key = Tuple[str or None, str or None]
+
+
+def index_keys(filters: BaseFilter) -> Set[Tuple[str or None, str or None, bool]] or None:
+    """Get the (menu, text, lower) keys a filter can match at most
+
+    `None` means that the filter cannot be indexed, `ANY` in a key means that the filter does not restrict that value.
+    The keys only narrow down the candidates, the filter itself must still be checked.
+    """
+    if isinstance(filters, MergedFilter):
+        base = index_keys(filters.base_filter)
+        if filters.and_filter is not None:
+            other = index_keys(filters.and_filter)
+            if base is None or other is None:
+                return base if other is None else other
+
+            keys = set()
+            for (menu, text, lower), (other_menu, other_text, other_lower) in itertools.product(base, other):
+                if ANY not in (menu, other_menu) and menu != other_menu:
+                    continue
+                if ANY not in (text, other_text) and (text != other_text or lower != other_lower):
+                    continue
+                keys.add((menu if menu is not ANY else other_menu,
+                          text if text is not ANY else other_text,
+                          lower if text is not ANY else other_lower))
+            return keys
+
+        other = index_keys(filters.or_filter)
+        if base is None or other is None:
+            return None
+        return base | other
+
+    menus = getattr(filters, 'menus', None)
+    if menus is not None:
+        return {(menu, ANY, False) for menu in menus}
+
+    texts = getattr(filters, 'texts', None)
+    if texts is not None:
+        lower = getattr(filters, 'lower', False)
+        return {(ANY, text, lower) for text in texts}
+    return None
+
+
+class Router(Handler):
+    """Single dispatcher handler routing updates to the plugin handlers
+
+    Instead of letting the dispatcher check every handler of every group, the menu and text filters of the
+    `MessageHandler`s and the names of the `CommandHandler`s are put into lookup tables at registration time. An
+    update is only checked against the handlers found in these tables and the handlers which can not be indexed
+    (channel messages, callback queries etc.). These are kept in registration order and merged lazily with the found
+    handlers, so they are only checked up to the first handler which matches.
+
+    Like with the dispatcher groups, at most one handler per group handles an update and every group is checked
+    after the previous groups handled the update, with the menu they left the user in.
+    """
+
+    def __init__(self):
+        super().__init__(callback=None)
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self._counter = itertools.count()
+        self._order: Dict[Handler, Tuple[int, int]] = {}
+
+        self._index: Dict[bool, Dict[Key, List[Handler]]] = {False: defaultdict(list), True: defaultdict(list)}
+        self._commands: Dict[str, List[Handler]] = defaultdict(list)
+        # The handlers which can not be indexed, sorted by their order
+        self._generic: List[Handler] = []
+        self._generic_order: List[Tuple[int, int]] = []
+
+    @property
+    def handlers(self) -> Iterable[Handler]:
+        return sorted(self._order, key=self._order.get)
+
+    def add_handler(self, handler: Handler, group: int = 0):
+        self._order[handler] = (group, next(self._counter))
+
+        if isinstance(handler, CommandHandler):
+            for command in handler.command:
+                self._commands[command.lower()].append(handler)
+            return
+
+        keys = index_keys(handler.filters) if isinstance(handler, MessageHandler) else None
+        if not keys:
+            self.logger.debug(f'Handler {handler.callback} can not be indexed')
+            position = bisect.bisect(self._generic_order, self._order[handler])
+            self._generic_order.insert(position, self._order[handler])
+            self._generic.insert(position, handler)
+            return
+
+        for menu, text, lower in keys:
+            self._index[lower][(menu, text.lower() if lower and text else text)].append(handler)
+
+    def candidates(self, update: Update) -> List[Handler]:
+        message = update.effective_message
+        if not message:
+            return []
+
+        candidates = set()
+        text = message.text
+        if (text and message.entities and message.entities[0].type == MessageEntity.BOT_COMMAND
+                and message.entities[0].offset == 0):
+            command = text[1:message.entities[0].length].split('@')[0].lower()
+            candidates.update(self._commands.get(command, ()))
+
+        menu = ANY
+        if message.from_user:
+            user = UpdateContext.get_telegram_user(message.from_user)
+            menu = user.menu if user else ANY
+
+        # Messages without text (media) can only match the handlers of the menu which accept any text
+        for lower, value in ((False, text), (True, text.lower() if text else None)):
+            index = self._index[lower]
+            for key in ((menu, value), (menu, ANY), (ANY, value)) if text else ((menu, ANY),):
+                if key in index:
+                    candidates.update(index[key])
+
+        return sorted(candidates, key=self._order.get)
+
+    def _next_match(self, update: Update, after: int = None) -> Tuple[Handler, object] or None:
+        """The first handler matching the update in the lowest group after `after`
+
+        The candidates are looked up with the current menu of the user, which the handlers of the previous groups may
+        have changed.
+        """
+        measure = metrics.enabled()
+        candidates = self.candidates(update)
+        generic = self._generic
+        if after is not None:
+            candidates = [handler for handler in candidates if self._order[handler][0] > after]
+            generic = itertools.islice(generic, bisect.bisect(self._generic_order, (after, math.inf)), None)
+        for handler in heapq.merge(candidates, generic, key=self._order.get):
+            started = time.perf_counter() if measure else 0
+            check = handler.check_update(update)
+            if measure:
+                metrics.metrics.observe('bot_filter_seconds', time.perf_counter() - started,
+                                        handler=getattr(handler.callback, '__qualname__', type(handler).__name__))
+            if check is not None and check is not False:
+                return handler, check
+        return None
+
+    def check_update(self, update: Update):
+        if not isinstance(update, Update):
+            return None
+        return self._next_match(update)
+
+    def handle_update(self, update: Update, dispatcher, check_result: Tuple[Handler, object], context=None):
+        match = check_result
+        while match:
+            handler, check = match
+            try:
+                handler.handle_update(update, dispatcher, check, context)
+            except DispatcherHandlerStop:
+                raise
+            except Exception as e:
+                dispatcher.dispatch_error(update, e)
+            # Like the dispatcher, the next groups are only checked after this handler ran
+            match = self._next_match(update, after=self._order[handler][0])
@@ -91,6 +91,103 @@ class Base(Configuration):
     MEDIA_ROOT = (BASE_PATH / 'media').as_posix()
     MEDIA_URL = '/media/'
 
+    # Seconds to collect changed Telegram user profiles before writing them in one bulk update, 0 writes right away
+    PROFILE_REFRESH_INTERVAL = 0
+
+    # Cache of chat infos fetched from telegram
+    CHAT_CACHE_TTL = 300
+    CHAT_CACHE_SIZE = 10000
+    CHAT_CACHE_PREFETCH_WORKERS = 8
+    # Channels fetched and checked at once when participants are imported from a list
+    PARTICIPANT_IMPORT_WORKERS = 8
+    # Seconds until the stored invite link, username and title of a channel are fetched again by "refresh_links",
+    # they are fetched in batches of concurrent requests with a pause between the batches
+    INVITE_LINK_MAX_AGE = 24 * 3600
+    INVITE_LINK_BATCH_SIZE = 20
+    INVITE_LINK_BATCH_INTERVAL = 1
+    # Seconds between the refreshes of "refresh_links --loop"
+    INVITE_LINK_REFRESH_INTERVAL = 300
+    # Channels checked at once by "check_participants", network errors are retried with an exponential backoff
+    HEALTH_CHECK_WORKERS = 8
+    HEALTH_CHECK_RETRIES = 3
+    HEALTH_CHECK_BACKOFF = 1
+    # Seconds between the checks of "check_participants --loop"
+    HEALTH_CHECK_INTERVAL = 3600
+    # The admins of the channels are fetched by "sync_admins" in batches of concurrent requests with a pause between
+    # the batches, "sync_admins --loop" syncs them every ADMIN_SYNC_INTERVAL seconds. Permission checks only use the
+    # stored admins for two intervals after a sync.
+    ADMIN_SYNC_BATCH_SIZE = 20
+    ADMIN_SYNC_BATCH_INTERVAL = 1
+    ADMIN_SYNC_INTERVAL = 3600
+
+    # Promotion posts sent per second if the bot has no message queue
+    BROADCAST_RATE = 30
+    # Seconds between the full reloads of the schedules by "broadcast --loop" without PostgreSQL, changes are only
+    # reported right away with PostgreSQL (LISTEN/NOTIFY) or when they are made in the same process. With PostgreSQL
+    # the schedules are only reloaded after the LISTEN connection was lost.
+    SCHEDULER_RELOAD_INTERVAL = 300
+    # Seconds until a failed promotion post or a lost LISTEN connection is tried again
+    SCHEDULER_RETRY_DELAY = 60
+    # Number of promotion deliveries written to the database at once
+    BROADCAST_CHECKPOINT_SIZE = 50
+
+    # Bot API sends per second shared by all processes: in total, per private chat and per group or channel. A chat
+    # telegram answered with a RetryAfter is paused and the send retried up to RATE_LIMIT_RETRIES times. Up to
+    # RATE_LIMIT_BURST sends are allowed at once before they are spread at the rate.
+    RATE_LIMIT_ENABLED = True
+    RATE_LIMIT_PATH = (BASE_PATH / 'rate_limit.sqlite3').as_posix()
+    RATE_LIMIT_GLOBAL = 30
+    RATE_LIMIT_CHAT = 1
+    RATE_LIMIT_GROUP = 20 / 60
+    RATE_LIMIT_BURST = 3
+    RATE_LIMIT_RETRIES = 3
+
+    # Webhook updates are stored in this file and handled by one worker thread per shard, 0 handles them in the request
+    UPDATE_QUEUE_PATH = (BASE_PATH / 'update_queue.sqlite3').as_posix()
+    UPDATE_QUEUE_WORKERS = 8
+    # Seconds between checks for updates queued by other processes
+    UPDATE_QUEUE_POLL_INTERVAL = 1
+    # Updates with an id seen in the last seconds are skipped, 0 disables it
+    UPDATE_DEDUPE_WINDOW = 600
+    # Number of update ids remembered in memory, the others are looked up in the update queue file
+    UPDATE_DEDUPE_SIZE = 10000
+
+    # Threads running the async command handlers, the handlers of a chat run one after the other
+    COMMAND_EXECUTOR_WORKERS = 8
+    # Seconds an async handler may wait before it is skipped, it is logged if it runs longer
+    COMMAND_EXECUTOR_TIMEOUT = 60
+
+    # Database connections open at once in the worker threads (update workers, async handlers), a worker keeps its
+    # connection between tasks for up to DB_WORKER_CONNECTION_MAX_AGE seconds and closes it when it becomes idle
+    DB_WORKER_CONNECTIONS = 10
+    DB_WORKER_CONNECTION_MAX_AGE = 300
+    # Seconds a worker waits for a free connection before it opens one anyway
+    DB_WORKER_CONNECTION_TIMEOUT = 30
+
+    # Storage of the menu, current group and scratch data of the users, bot.utils.state.MemoryStateBackend keeps them
+    # in memory and only writes the least recently used ones to the database
+    CONVERSATION_STATE_BACKEND = 'bot.utils.state.DatabaseStateBackend'
+    CONVERSATION_STATE_CACHE_SIZE = 10000
+
+    # Load the command plugins with the first update instead of at startup, so processes which never handle updates
+    # (eg. management commands) do not load them at all
+    LAZY_PLUGINS = False
+
+    # Measure the handlers, database queries and Bot API calls of every update, served on /metrics/
+    METRICS_ENABLED = True
+    # /metrics/ only answers requests from these addresses or with an "Authorization: Bearer <METRICS_TOKEN>" header
+    METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+    # Fraction of the command handler calls which are profiled, 0 leaves it to the Profiling switch in the admin
+    PROFILER_SAMPLE_RATE = float(os.environ.get('PROFILER_SAMPLE_RATE', 0))
+    # "collapsed" samples the stacks every PROFILER_INTERVAL seconds, "pstats" runs the calls under cProfile
+    PROFILER_OUTPUT = os.environ.get('PROFILER_OUTPUT', 'collapsed')
+    PROFILER_INTERVAL = 0.005
+    # Seconds between writing the collected profiles to media/profiles/ and between reading the admin switch
+    PROFILER_FLUSH_INTERVAL = 60
+    PROFILER_REFRESH_INTERVAL = 10
+
 
 class Production(Base):
     DEBUG = False
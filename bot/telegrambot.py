@@ -1,10 +1,19 @@
 import logging
 from typing import Callable, List, Type
 
+from django.conf import settings
 from django_telegrambot.apps import DjangoTelegramBot
 from telegram import Bot, TelegramError, Update, User
 from telegram.ext import CallbackQueryHandler, CommandHandler, Filters, Handler, MessageHandler
 
+from bot.ingest import update_deduplicator
+from bot.router import Router
+from bot.utils.cache import chat_cache
+from bot.utils import metrics
+from bot.utils.context import UpdateContext
+from bot.utils.executor import command_executor
+from bot.utils import ratelimit
+
 
 class MyBot:
     def __init__(self):
@@ -14,14 +23,55 @@ class MyBot:
 
         self.dispatcher = DjangoTelegramBot.dispatcher
         self.bot = self.dispatcher.bot
+        if ratelimit.enabled():
+            ratelimit.rate_limiter.instrument_request(self.bot._request)
+
+        self._process_update = self.dispatcher.process_update
+        self.dispatcher.process_update = self.process_update
+
+        self.router = Router()
+        self.dispatcher.add_handler(self.router)
 
         self.add_command(func=self.error, is_error=True)
 
     def error(self, bot: Bot, update: Update, error: TelegramError):
         self.logger.warning(f'Update "{update}" caused error "{error}"')
 
+    def process_update(self, update: Update or TelegramError):
+        # With polling, the dispatcher running, updates telegram delivers again are skipped here. The webhook skips them
+        # before they are queued, the queued updates are handled by the `UpdateWorkers` even if they were started before
+        if self.dispatcher.running and isinstance(update, Update) \
+                and update_deduplicator.is_duplicate(self.bot.token, update.update_id):
+            self.logger.info(f'Skipped redelivered update {update.update_id}')
+            return
+
+        if getattr(settings, 'LAZY_PLUGINS', False):
+            from bot.commands import load_plugins
+            load_plugins()
+
+        if isinstance(update, Update):
+            message = update.effective_message
+            chats = [update.effective_chat, update.effective_user, message.forward_from_chat if message else None]
+            chat_cache.invalidate(*{chat.id for chat in chats if chat})
+
+            # The handlers of the update only run once the async handlers of the previous updates of the chat are
+            # done, so they see the menu these left the user in
+            chat = update.effective_chat or update.effective_user
+            if chat and not command_executor.wait(chat.id):
+                self.logger.warning(f'The async handlers of {chat.id} are still running, update {update.update_id} '
+                                    f'is handled anyway')
+
+        if not metrics.enabled():
+            with UpdateContext(update if isinstance(update, Update) else None):
+                self._process_update(update)
+            return
+
+        metrics.instrument_request(self.bot._request)
+        with metrics.UpdateMetrics(), UpdateContext(update if isinstance(update, Update) else None):
+            self._process_update(update)
+
     def me(self) -> User:
-        return self.bot.get_me()
+        return chat_cache.me()
 
     def add_command(self, handler: Type[Handler] or Handler = None, names: str or List[str] = None,
                     func: Callable = None, is_error: bool = False, group: int = 0, **kwargs):
@@ -37,11 +87,11 @@ class MyBot:
         handler = handler or CommandHandler
 
         if isinstance(handler, Handler):
-            self.dispatcher.add_handler(handler=handler, group=group)
+            self.router.add_handler(handler=handler, group=group)
         elif handler == MessageHandler:
-            self.dispatcher.add_handler(handler=handler(kwargs.get('filters', Filters.all), func), group=group)
+            self.router.add_handler(handler=handler(kwargs.get('filters', Filters.all), func), group=group)
         elif handler == CallbackQueryHandler:
-            self.dispatcher.add_handler(handler=handler(func, **kwargs), group=group)
+            self.router.add_handler(handler=handler(func, **kwargs), group=group)
         else:
             if not names:
                 names = [func.__name__]
@@ -49,7 +99,7 @@ class MyBot:
                 names = [names]
 
             for name in names:
-                self.dispatcher.add_handler(handler=handler(name, func, **kwargs), group=group)
+                self.router.add_handler(handler=handler(name, func, **kwargs), group=group)
 
 
 # noinspection PyTypeChecker
@@ -61,3 +111,6 @@ def main():
     my_bot = MyBot()
     # noinspection PyUnresolvedReferences
     from . import commands
+    # With LAZY_PLUGINS the plugins are loaded with the first update instead
+    if not getattr(settings, 'LAZY_PLUGINS', False):
+        commands.load_plugins()
@@ -1 +1,1311 @@
-# Create your tests here.
+import json
+import os
+import pstats
+import random
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from contextlib import nullcontext
+from datetime import timedelta
+from typing import Dict, List
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from telegram import Bot, Chat, Message, Update, User as TgUser
+from telegram.error import RetryAfter, TimedOut, Unauthorized
+from telegram.ext import BaseFilter, MessageHandler
+
+from bot import EDIT_NAME, MAIN, NEW_PG_Q_1, SET_DATETIME, telegrambot
+from bot.benchmark import ReplayBenchmark
+from bot.commands import MANIFEST, BaseCommand, discover_plugins
+from bot.filters import Filters as OF
+from bot.ingest import UpdateDeduplicator, UpdateQueue, UpdateWorkers, process_update
+from bot.loadtest import LoadTest
+from bot.models import BroadcastRun, Delivery, Participant, Profiling, PromoGroup, TelegramChannel, TelegramUser, Topic
+from bot.models.promo_group import DeferredUpdates
+from bot.promotion import scheduler
+from bot.promotion.channel_admins import ChannelAdminSync
+from bot.promotion.engine import Broadcaster
+from bot.promotion.health import ParticipantHealthCheck
+from bot.promotion.importer import ParticipantImporter
+from bot.promotion.invite_links import InviteLinkRefresher
+from bot.promotion.renderer import MESSAGE_LIMIT, PostBuilder, open_tags, template_problem, text_length
+from bot.promotion.scheduler import PromotionScheduler
+from bot.router import Router
+from bot.utils.cache import ChatCache, chat_cache
+from bot.utils.chat import check_user_permissions
+from bot.utils.context import UpdateContext
+from bot.utils.db import ConnectionLimiter
+from bot.utils import executor
+from bot.utils.executor import ChatExecutor
+from bot.utils.fake_api import FakeBotApi
+from bot.utils.metrics import metrics
+from bot.utils.profiler import COLLAPSED, PSTATS, Profiler
+from bot.utils.ratelimit import RateLimiter
+from bot.utils.state import MemoryStateBackend
+
+
+class AdminQueryCountTest(TestCase):
+    """The admin pages must use the same number of queries no matter how many rows they show"""
+
+    @classmethod
+    def setUpTestData(cls):
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+
+    def setUp(self):
+        self.client.login(username='admin', password='admin')
+
+    @staticmethod
+    def create_data(size: int, offset: int = 0):
+        """Create `size` users, channels and groups with `size` participants and topics per group"""
+        ids = range(offset + 1, offset + size + 1)
+        users = TelegramUser.objects.bulk_create(TelegramUser(id=i, full_name=f'User {i}') for i in ids)
+        channels = TelegramChannel.objects.bulk_create(TelegramChannel(id=-i, title=f'Channel {i}') for i in ids)
+        groups = PromoGroup.objects.bulk_create(PromoGroup(id=i, name=f'Group {i}') for i in ids)
+
+        TelegramChannel.admins.through.objects.bulk_create(
+            TelegramChannel.admins.through(telegramchannel=channel, telegramuser=user)
+            for channel, user in zip(channels, users))
+        PromoGroup.admins.through.objects.bulk_create(
+            PromoGroup.admins.through(promogroup=group, telegramuser=user)
+            for group, user in zip(groups, users))
+        for user, group in zip(users, groups):
+            user.current_group = group
+        TelegramUser.objects.bulk_update(users, ['current_group'])
+
+        for group in groups:
+            topics = Topic.objects.bulk_create(Topic(id=group.id * 1000 + i, name=f'Topic {i}', promo_group=group)
+                                               for i in range(size))
+            Participant.objects.bulk_create(Participant(channel=channel, promo_group=group, topic=topic)
+                                            for channel, topic in zip(channels, topics))
+
+            run = BroadcastRun.objects.create(promo_group=group, scheduled_for=timezone.now())
+            Delivery.objects.bulk_create(Delivery(run=run, participant=participant, status=Delivery.SENT)
+                                         for participant in group.participants.all())
+
+    def count_queries(self, url: str) -> int:
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def assertConstantQueries(self, url_name: str, detail_model=None):
+        def url():
+            if detail_model:
+                return reverse(url_name, args=(detail_model.objects.order_by('pk').first().pk,))
+            return reverse(url_name)
+
+        self.create_data(5)
+        self.count_queries(url())  # Warm up caches like the content types
+        small = self.count_queries(url())
+
+        self.create_data(40, offset=5)
+        large = self.count_queries(url())
+
+        self.assertEqual(small, large)
+        self.assertLess(large, 20)
+
+    def test_telegramuser_changelist(self):
+        self.assertConstantQueries('admin:bot_telegramuser_changelist')
+
+    def test_telegramuser_change(self):
+        self.assertConstantQueries('admin:bot_telegramuser_change', TelegramUser)
+
+    def test_telegramchannel_changelist(self):
+        self.assertConstantQueries('admin:bot_telegramchannel_changelist')
+
+    def test_telegramchannel_change(self):
+        self.assertConstantQueries('admin:bot_telegramchannel_change', TelegramChannel)
+
+    def test_promogroup_changelist(self):
+        self.assertConstantQueries('admin:bot_promogroup_changelist')
+
+    def test_promogroup_change(self):
+        self.assertConstantQueries('admin:bot_promogroup_change', PromoGroup)
+
+    def test_participant_changelist(self):
+        self.assertConstantQueries('admin:bot_participant_changelist')
+
+    def test_participant_change(self):
+        self.assertConstantQueries('admin:bot_participant_change', Participant)
+
+    def test_topic_changelist(self):
+        self.assertConstantQueries('admin:bot_topic_changelist')
+
+    def test_topic_change(self):
+        self.assertConstantQueries('admin:bot_topic_change', Topic)
+
+    def test_broadcastrun_changelist(self):
+        self.assertConstantQueries('admin:bot_broadcastrun_changelist')
+
+    def test_broadcastrun_change(self):
+        self.assertConstantQueries('admin:bot_broadcastrun_change', BroadcastRun)
+
+    def test_delivery_changelist(self):
+        self.assertConstantQueries('admin:bot_delivery_changelist')
+
+    def test_delivery_change(self):
+        self.assertConstantQueries('admin:bot_delivery_change', Delivery)
+
+
+class BroadcastTest(TestCase):
+    def setUp(self):
+        chat_cache.clear()
+        self.api = FakeBotApi(blocked=[-3])
+        self.broadcaster = Broadcaster(Bot('123:token', request=self.api))
+
+        self.group = PromoGroup.objects.create(name='Group', active=True, template='Promo {{ participants }}',
+                                               post_at=timezone.now() - timedelta(minutes=1),
+                                               post_interval=timedelta(hours=24))
+        for i in range(1, 5):
+            channel = TelegramChannel.objects.create(id=-i, title=f'Channel {i}', username=f'channel{i}')
+            Participant.objects.create(channel=channel, promo_group=self.group, active=i != 4)
+
+    def test_run_due(self):
+        results = self.broadcaster.run_due()
+
+        self.assertEqual(len(results), 1)
+        self.assertCountEqual(results[0].sent, [-1, -2])
+        self.assertEqual(list(results[0].failed), [-3])
+
+        sent = self.api.sent()
+        self.assertCountEqual(sent, [-1, -2])
+        self.assertTrue(sent[-1]['text'].startswith('Promo '))
+        self.assertIn('https://t.me/channel2', sent[-1]['text'])
+        self.assertIn('Channel 3', sent[-1]['text'])
+        self.assertNotIn('Channel 1', sent[-1]['text'])
+        self.assertNotIn('Channel 4', sent[-1]['text'])
+
+        self.group.refresh_from_db()
+        self.assertGreater(self.group.post_at, timezone.now())
+        self.assertFalse(self.broadcaster.run_due())
+
+    def test_resume(self):
+        run = BroadcastRun.objects.create(promo_group=self.group, scheduled_for=self.group.post_at)
+        Delivery.objects.create(run=run, participant=Participant.objects.get(channel_id=-1), status=Delivery.SENT)
+
+        result = self.broadcaster.run_due()[0]
+
+        self.assertEqual(result.run, run)
+        self.assertEqual(result.sent, [-2])
+        self.assertCountEqual(self.api.sent(), [-2])
+        self.assertEqual(dict(run.deliveries.values_list('participant__channel_id', 'status')),
+                         {-1: Delivery.SENT, -2: Delivery.SENT, -3: Delivery.FAILED})
+
+        run.refresh_from_db()
+        self.assertIsNotNone(run.finished)
+        self.assertFalse(self.broadcaster.broadcast(self.group, run.scheduled_for).sent)
+
+    @override_settings(BROADCAST_CHECKPOINT_SIZE=1)
+    def test_resume_interrupted(self):
+        sends = []
+
+        def crash(method, data):
+            sends.append(int(data['chat_id']))
+            if len(sends) == 2:
+                raise SystemExit()
+
+        self.api.on_call = crash
+        self.api.blocked.clear()
+        with self.assertRaises(SystemExit):
+            self.broadcaster.run_due()
+        # The post sent before the crash was logged right away
+        self.assertEqual(list(Delivery.objects.values_list('participant__channel_id', flat=True)), sends[:1])
+
+        api = FakeBotApi()
+        result = Broadcaster(Bot('123:token', request=api)).run_due()[0]
+        self.assertCountEqual(result.sent, {-1, -2, -3} - {sends[0]})
+        self.assertCountEqual(api.sent(), result.sent)
+        self.assertEqual(dict(result.run.deliveries.values_list('participant__channel_id', 'status')),
+                         {-1: Delivery.SENT, -2: Delivery.SENT, -3: Delivery.SENT})
+
+    def test_not_due(self):
+        PromoGroup.objects.update(post_at=timezone.now() + timedelta(minutes=1))
+        self.assertFalse(self.broadcaster.run_due())
+
+        PromoGroup.objects.update(post_at=timezone.now() - timedelta(minutes=1), active=False)
+        self.assertFalse(self.broadcaster.run_due())
+        self.assertFalse(self.api.sent())
+
+    def test_media(self):
+        self.group.media_type = PromoGroup.PHOTO
+        self.group.media_file.save('promo.jpg', ContentFile(b'image'), save=True)
+        self.addCleanup(self.group.media_file.delete, save=False)
+
+        result = self.broadcaster.run_due()[0]
+
+        self.assertCountEqual(result.sent, [-1, -2])
+        self.assertEqual(self.api.uploads, 1)
+        self.assertFalse(self.api.sent())
+        self.assertTrue(all(data['caption'].startswith('Promo ') for data in self.api.sent('sendPhoto').values()))
+        self.group.refresh_from_db()
+        self.assertEqual(self.group.media_file_id, 'file1')
+
+        # The next run only sends the stored file id
+        self.broadcaster.broadcast(self.group)
+        self.assertEqual(self.api.uploads, 1)
+
+        # A rejected file id is uploaded again once
+        self.api.invalid_files.add('file1')
+        result = self.broadcaster.broadcast(self.group, timezone.now())
+        self.assertCountEqual(result.sent, [-1, -2])
+        self.assertEqual(self.api.uploads, 2)
+        self.group.refresh_from_db()
+        self.assertEqual(self.group.media_file_id, 'file2')
+
+
+class PromotionSchedulerTest(TestCase):
+    def setUp(self):
+        self.api = FakeBotApi()
+        self.broadcaster = Broadcaster(Bot('123:token', request=self.api))
+        self.scheduler = PromotionScheduler()
+        self.now = timezone.now()
+        self.groups = [PromoGroup.objects.create(name=f'Group {i}', active=True, template='Promo {{ participants }}',
+                                                 post_at=self.now + timedelta(minutes=i),
+                                                 post_interval=timedelta(hours=1))
+                       for i in range(3)]
+        channel = TelegramChannel.objects.create(id=-1, title='Channel', username='channel1')
+        for group in self.groups:
+            Participant.objects.create(channel=channel, promo_group=group)
+
+    def test_heap(self):
+        first, second, third = self.groups
+        self.scheduler.load()
+        self.assertEqual(len(self.scheduler), 3)
+        self.assertEqual(self.scheduler.next_due(), first.post_at.timestamp())
+
+        # The replaced and removed schedules are skipped
+        self.scheduler.update(first.id, self.now + timedelta(minutes=5))
+        self.scheduler.update(second.id, None)
+        self.assertEqual(self.scheduler.next_due(), third.post_at.timestamp())
+        self.assertEqual(self.scheduler.pop_due((self.now + timedelta(minutes=4)).timestamp()), [third.id])
+        self.assertEqual(self.scheduler.pop_due((self.now + timedelta(minutes=10)).timestamp()), [first.id])
+        self.assertIsNone(self.scheduler.next_due())
+
+    def test_reschedule_missed(self):
+        first, second, third = self.groups
+        self.scheduler.load()
+        # Changed without a notification, the second one is not due anymore and the third one inactive
+        PromoGroup.objects.filter(id=second.id).update(post_at=self.now + timedelta(minutes=30))
+        PromoGroup.objects.filter(id=third.id).update(active=False)
+
+        posted = self.scheduler.post_due(self.broadcaster, self.now + timedelta(minutes=3))
+
+        self.assertEqual(posted, [first.id])
+        self.assertEqual(list(self.api.sent()), [-1])
+        first.refresh_from_db()
+        self.assertEqual(self.scheduler._schedule, {first.id: first.post_at.timestamp(),
+                                                    second.id: (self.now + timedelta(minutes=30)).timestamp()})
+
+    @override_settings(SCHEDULER_RELOAD_INTERVAL=0.01)
+    def test_periodic_reload(self):
+        PromoGroup.objects.update(active=False)
+        stop = threading.Event()
+        calls = []
+
+        def wait(timeout):
+            calls.append(timeout)
+            if len(calls) == 1:
+                # A change of another process, without PostgreSQL it is not reported
+                PromoGroup.objects.filter(id=self.groups[0].id).update(active=True, post_at=self.now)
+                time.sleep(0.01)
+            else:
+                stop.set()
+            return set()
+
+        with mock.patch.object(scheduler.listener, 'wait', wait):
+            self.scheduler.run(self.broadcaster, stop)
+
+        self.assertLessEqual(calls[0], 0.01)
+        self.assertEqual(list(self.api.sent()), [-1])
+
+    def test_failed_broadcast(self):
+        first, second, third = self.groups
+        self.scheduler.load()
+        broadcast = self.broadcaster.broadcast
+
+        def failing(group, *args, **kwargs):
+            if group.id == first.id:
+                raise TimedOut()
+            return broadcast(group, *args, **kwargs)
+
+        with mock.patch.object(self.broadcaster, 'broadcast', failing):
+            posted = self.scheduler.post_due(self.broadcaster, self.now + timedelta(minutes=1))
+
+        # The other groups are posted, the failed one is tried again later
+        self.assertEqual(posted, [second.id])
+        self.assertEqual(self.scheduler._schedule[first.id], (self.now + timedelta(minutes=2)).timestamp())
+        first.refresh_from_db()
+        self.assertEqual(first.post_at, self.now)
+
+    @override_settings(SCHEDULER_RELOAD_INTERVAL=0.01, SCHEDULER_RETRY_DELAY=0)
+    def test_postgres_reconnect(self):
+        PromoGroup.objects.update(active=False)
+        stop = threading.Event()
+        calls = []
+
+        def listen():
+            scheduler.listener._connection = mock.Mock()
+
+        def wait(timeout):
+            calls.append(timeout)
+            if len(calls) == 1:
+                raise OSError('connection lost')
+            if len(calls) == 3:
+                stop.set()
+            return set()
+
+        with mock.patch.object(type(scheduler.listener), 'postgres', new_callable=mock.PropertyMock,
+                               return_value=True), \
+                mock.patch.object(scheduler.listener, 'listen', side_effect=listen), \
+                mock.patch.object(scheduler.listener, 'wait', wait), \
+                mock.patch.object(self.scheduler, 'load', wraps=self.scheduler.load) as load:
+            self.scheduler.run(self.broadcaster, stop)
+
+        # No periodic reload, only at the start and after the connection was lost
+        self.assertEqual(load.call_count, 2)
+        self.assertEqual(calls, [1, 1, 1])
+        self.assertIsNone(scheduler.listener._connection)
+
+
+class PostBuilderTest(TestCase):
+    def setUp(self):
+        self.group = PromoGroup.objects.create(name='<Group>')
+        self.participants = []
+        for i in range(1, 4):
+            channel = TelegramChannel.objects.create(id=-i, title=f'Channel {i}')
+            self.participants.append(Participant.objects.create(channel=channel, promo_group=self.group))
+
+    def build(self, template: str, **kwargs) -> Dict[int, List[str]]:
+        self.group.template = template
+        return PostBuilder(self.group, self.participants, {}, **kwargs).build_all()
+
+    def test_group_template_is_not_a_django_template(self):
+        template = ('{{ group.name }} {{group}} {{ group.admins.all }} {{ participants.__class__ }}\n'
+                    '{% debug %}{% load static %}{% include "promotion/post.html" %}{{ participants }}')
+        self.assertEqual(template_problem(template), 'tags like "{% ... %}" are not supported')
+        self.assertIn('unknown placeholder "{{ group.admins.all }}"', template_problem(template.split('\n')[0]))
+        self.assertIsNone(template_problem('<b>{{ group.name }}</b> {{participants}}'))
+
+        message = self.build(template)[-1][0]
+        self.assertTrue(message.startswith('&lt;Group&gt; &lt;Group&gt;  \n{% debug %}{% load static %}'))
+        self.assertTrue(message.endswith('{% include "promotion/post.html" %}Channel 2\nChannel 3'))
+
+    def test_default_template(self):
+        self.assertEqual(self.build('')[-1], ['<strong>&lt;Group&gt;</strong>\n\nChannel 2\nChannel 3'])
+
+    @staticmethod
+    def long_participants(count: int, title_length: int) -> List[Participant]:
+        return [Participant(channel=TelegramChannel(id=-i, title=f'{i:05d}'.ljust(title_length, 'x')))
+                for i in range(1, count + 1)]
+
+    def test_split(self):
+        self.group.template = 'Promo {{ participants }} End'
+        self.participants = self.long_participants(100, 100)
+        posts = PostBuilder(self.group, self.participants, {}).build_all()
+
+        self.assertEqual(len(posts), 100)
+        for chat_id, messages in posts.items():
+            self.assertEqual(len(messages), 3)
+            self.assertTrue(all(text_length(message) <= MESSAGE_LIMIT for message in messages))
+            self.assertTrue(messages[0].startswith('Promo '))
+            self.assertTrue(messages[-1].endswith(' End'))
+            # Every other channel is listed once, the own channel is left out
+            lines = '\n'.join(messages)[len('Promo '):-len(' End')].split('\n')
+            self.assertEqual(lines, [participant.channel.title for participant in self.participants
+                                     if participant.channel_id != chat_id])
+
+    def test_split_wrapped_list(self):
+        self.participants = self.long_participants(100, 100)
+        posts = self.build('<b>Promo <a href="https://t.me/promo">{{ participants }}</a></b> <i>End</i>')
+
+        for chat_id, messages in posts.items():
+            self.assertEqual(len(messages), 3)
+            # Every message is valid HTML on its own
+            self.assertTrue(all(open_tags(message) == [] for message in messages))
+            self.assertTrue(messages[0].startswith('<b>Promo <a href="https://t.me/promo">'))
+            self.assertTrue(messages[0].endswith('</a></b>'))
+            self.assertTrue(messages[1].startswith('<b><a href="https://t.me/promo">'))
+            self.assertTrue(messages[2].endswith('</a></b> <i>End</i>'))
+
+    def test_exact_fit(self):
+        self.participants = self.long_participants(4, 1000)
+        # The head and all four channels are exactly one message long
+        head = 'x' * (MESSAGE_LIMIT - 4 * 1000 - 3 - 1)
+        posts = self.build(f'{head} {{{{ participants }}}}')
+        self.assertEqual({len(messages) for messages in posts.values()}, {1})
+        self.assertEqual(len(posts[-4][0]), MESSAGE_LIMIT - 1001)
+
+        # One character more and the last channel goes into its own message
+        posts = self.build(f'{head}x {{{{ participants }}}}')
+        self.assertEqual([len(messages) for messages in posts.values()], [2, 2, 2, 1])
+        self.assertTrue(all(text_length(message) <= MESSAGE_LIMIT
+                            for messages in posts.values() for message in messages))
+
+
+class UpdateQueueTest(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.queue = UpdateQueue(f'{directory.name}/queue.sqlite3', shards=4)
+
+        self.handled = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def process(self, token, data):
+        key, number = map(int, data.split(':'))
+        time.sleep(random.random() / 1000)
+        with self.lock:
+            self.handled[key].append(number)
+
+    def test_order_per_key(self):
+        # Updates queued before the workers started are handled as well
+        for number in range(20):
+            for key in range(10):
+                self.queue.put('token', f'{key}:{number}', key)
+
+        workers = UpdateWorkers(self.queue, self.process)
+        workers.start()
+        for number in range(20, 40):
+            for key in range(10):
+                self.queue.put('token', f'{key}:{number}', key)
+
+        deadline = time.monotonic() + 10
+        while self.queue.depth() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        workers.join()
+
+        self.assertFalse(self.queue.depth())
+        self.assertEqual(dict(self.handled), {key: list(range(40)) for key in range(10)})
+
+    def test_deduplicate(self):
+        deduplicator = UpdateDeduplicator(self.queue.path, window=60, max_size=2)
+        other_process = UpdateDeduplicator(self.queue.path, window=60, max_size=2)
+
+        self.assertFalse(deduplicator.is_duplicate('token', 1))
+        self.assertTrue(deduplicator.is_duplicate('token', 1))
+        self.assertFalse(deduplicator.is_duplicate('other', 1))
+        self.assertTrue(other_process.is_duplicate('token', 1))
+
+        # Ids dropped from memory are still found in the shared table
+        for update_id in range(2, 10):
+            self.assertFalse(deduplicator.is_duplicate('token', update_id))
+        self.assertLessEqual(len(deduplicator._seen), 2)
+        self.assertTrue(deduplicator.is_duplicate('token', 2))
+
+        expired = UpdateDeduplicator(self.queue.path, window=0.01)
+        time.sleep(0.02)
+        self.assertFalse(expired.is_duplicate('token', 3))
+
+
+class RedeliveredUpdateTest(TestCase):
+    def setUp(self):
+        self.benchmark = ReplayBenchmark(users=1, groups=1, participants=1)
+        self.benchmark.setup_bot()
+        self.addCleanup(telegrambot.my_bot.dispatcher.remove_error_handler, self.benchmark._count_error)
+        self.benchmark.generate()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.deduplicator = UpdateDeduplicator(f'{directory.name}/queue.sqlite3')
+
+    def sent(self) -> int:
+        return [method for method, _ in self.benchmark.api.calls].count('sendMessage')
+
+    def test_polling(self):
+        # Polling calls process_update of the running dispatcher directly, without the webhook
+        update = self.benchmark.command(self.benchmark.users[0], '/help')
+        with mock.patch('bot.telegrambot.update_deduplicator', self.deduplicator), \
+                mock.patch.object(telegrambot.my_bot.dispatcher, 'running', True):
+            for _ in range(2):
+                telegrambot.my_bot.dispatcher.process_update(update)
+            telegrambot.my_bot.dispatcher.process_update(self.benchmark.command(self.benchmark.users[0], '/help'))
+
+        self.assertEqual(self.sent(), 2)
+
+    @override_settings(UPDATE_QUEUE_WORKERS=0)
+    def test_webhook(self):
+        update = self.benchmark.command(self.benchmark.users[0], '/help')
+        url = reverse('update_queue_webhook', args=[self.benchmark.bot.token])
+        with mock.patch('bot.views.update_deduplicator', self.deduplicator):
+            for _ in range(2):
+                self.client.post(url, update.to_json(), content_type='application/json', HTTP_HOST='localhost')
+
+        self.assertEqual(self.sent(), 1)
+
+    def test_queue_replay(self):
+        # An update still queued after a crash is handled again by the workers
+        data = self.benchmark.command(self.benchmark.users[0], '/help').to_json()
+        with mock.patch('bot.telegrambot.update_deduplicator', self.deduplicator):
+            for _ in range(2):
+                process_update(self.benchmark.bot.token, data)
+
+        self.assertEqual(self.sent(), 2)
+
+
+class ChatExecutorTest(SimpleTestCase):
+    def wait(self, executor: ChatExecutor):
+        deadline = time.monotonic() + 10
+        while (executor.depth or executor.busy) and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_order_per_chat(self):
+        executor = ChatExecutor(workers=4, timeout=0)
+        handled, running, overlaps = defaultdict(list), set(), []
+        lock = threading.Lock()
+
+        def task(chat_id, number):
+            with lock:
+                if chat_id in running:
+                    overlaps.append(chat_id)
+                running.add(chat_id)
+            time.sleep(random.random() / 1000)
+            with lock:
+                running.remove(chat_id)
+                handled[chat_id].append(number)
+
+        for number in range(30):
+            for chat_id in range(8):
+                executor.submit(chat_id, task, chat_id, number)
+        self.assertGreater(executor.depth, 0)
+        self.wait(executor)
+
+        self.assertEqual(dict(handled), {chat_id: list(range(30)) for chat_id in range(8)})
+        self.assertFalse(overlaps)
+        self.assertEqual(executor.depth, 0)
+
+    def test_wait(self):
+        executor = ChatExecutor(workers=2)
+        executor.submit(1, time.sleep, 0.1)
+        executor.submit(2, time.sleep, 1)
+
+        started = time.monotonic()
+        self.assertTrue(executor.wait(1))
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertFalse(executor.wait(2, timeout=0.05))
+        self.assertTrue(executor.wait(3))
+
+    def test_timeout(self):
+        executor = ChatExecutor(workers=1)
+        handled = []
+        executor.submit(1, time.sleep, 0.1)
+        executor.submit(1, handled.append, 'skipped', timeout=0.05)
+        executor.submit(1, handled.append, 'run', timeout=1)
+        self.wait(executor)
+
+        self.assertEqual(handled, ['run'])
+
+
+class ChatCacheTest(SimpleTestCase):
+    def setUp(self):
+        self.api = FakeBotApi()
+        self.bot = Bot('123:test', request=self.api)
+
+    def fetched(self) -> List[int]:
+        return [int(data['chat_id']) for method, data in self.api.calls if method == 'getChat']
+
+    def test_ttl(self):
+        cache = ChatCache(ttl=10)
+        with mock.patch('bot.utils.cache.time.monotonic', return_value=100):
+            self.assertEqual(cache.get(-1, self.bot).title, 'Channel -1')
+            cache.get(-1, self.bot)
+        with mock.patch('bot.utils.cache.time.monotonic', return_value=109):
+            cache.get(-1, self.bot)
+        self.assertEqual(self.fetched(), [-1])
+
+        with mock.patch('bot.utils.cache.time.monotonic', return_value=111):
+            cache.get(-1, self.bot)
+        self.assertEqual(self.fetched(), [-1, -1])
+
+    def test_lru_eviction(self):
+        cache = ChatCache(ttl=60, max_size=2)
+        cache.get(-1, self.bot)
+        cache.get(-2, self.bot)
+        # Using -1 makes -2 the least recently used entry
+        cache.get(-1, self.bot)
+        cache.get(-3, self.bot)
+        self.assertEqual(len(cache), 2)
+
+        self.assertEqual(set(cache.prefetch([-1, -2, -3], self.bot)), {-1, -2, -3})
+        self.assertEqual(self.fetched(), [-1, -2, -3, -2])
+        self.assertEqual(len(cache), 2)
+
+
+class UpdateContextTest(TestCase):
+    @staticmethod
+    def update(user_id: int) -> Update:
+        return Update(user_id, message=Message(1, TgUser(user_id, 'User', False), 0, Chat(user_id, Chat.PRIVATE),
+                                               text='text'))
+
+    def test_thread_isolation(self):
+        entered, release, seen = threading.Event(), threading.Event(), {}
+
+        def other_thread():
+            with UpdateContext(self.update(2)) as context:
+                seen['entered'] = UpdateContext.current() is context
+                entered.set()
+                release.wait(5)
+            seen['left'] = UpdateContext.current()
+
+        with UpdateContext(self.update(1)) as context:
+            thread = threading.Thread(target=other_thread)
+            thread.start()
+            entered.wait(5)
+            # The context of the other thread is not visible here and does not replace this one
+            self.assertIs(UpdateContext.current(), context)
+            self.assertEqual(context.telegram_user.id, 1)
+            release.set()
+            thread.join()
+            self.assertIs(UpdateContext.current(), context)
+
+        self.assertEqual(seen, {'entered': True, 'left': None})
+        self.assertIsNone(UpdateContext.current())
+
+    def test_shared_objects(self):
+        update = self.update(1)
+        with UpdateContext(update) as context:
+            self.assertIs(UpdateContext.for_update(update), context)
+            self.assertIsNot(UpdateContext.for_update(self.update(1)), context)
+            telegram_user = context.telegram_user
+            with self.assertNumQueries(0):
+                self.assertIs(UpdateContext.get_telegram_user(update.effective_user), telegram_user)
+
+    def test_cleanup(self):
+        with UpdateContext(self.update(1)) as outer:
+            with UpdateContext(self.update(2)):
+                pass
+            self.assertIs(UpdateContext.current(), outer)
+        self.assertIsNone(UpdateContext.current())
+        self.assertFalse(hasattr(outer, '_previous'))
+
+        with self.assertRaises(ValueError):
+            with UpdateContext(self.update(1)) as context:
+                context.telegram_user.set_menu('edit name')
+                raise ValueError()
+        self.assertIsNone(UpdateContext.current())
+        # The state changed before the error is still saved
+        self.assertEqual(TelegramUser.objects.get(id=1).menu, 'edit name')
+
+
+class RouterTest(TestCase):
+    def setUp(self):
+        self.benchmark = ReplayBenchmark(users=1, groups=1, participants=1)
+        self.benchmark.setup_bot()
+        self.addCleanup(telegrambot.my_bot.dispatcher.remove_error_handler, self.benchmark._count_error)
+        self.benchmark.generate()
+        self.user = self.benchmark.users[0]
+        self.group = self.benchmark.groups[self.user.id][0]
+
+    def dispatch(self, update: Update, menu: str):
+        TelegramUser.objects.filter(id=self.user.id).update(menu=menu, current_group=self.group)
+        telegrambot.my_bot.dispatcher.process_update(update)
+        self.assertEqual(self.benchmark._errors, 0)
+        return TelegramUser.objects.get(id=self.user.id)
+
+    def test_command_leaves_question(self):
+        user = self.dispatch(self.benchmark.command(self.user, '/start'), NEW_PG_Q_1)
+
+        self.assertEqual(user.menu, MAIN)
+        self.assertFalse(PromoGroup.objects.filter(name='/start').exists())
+
+    def test_home_leaves_edit_name(self):
+        name = self.group.name
+        user = self.dispatch(self.benchmark.text(self.user, 'home'), EDIT_NAME)
+
+        self.assertEqual(user.menu, MAIN)
+        self.group.refresh_from_db()
+        self.assertEqual(self.group.name, name)
+
+    def test_groups_see_new_menu(self):
+        router, handled = Router(), []
+
+        def handler(name, menu=None):
+            def callback(bot, update):
+                handled.append(name)
+                if menu:
+                    UpdateContext.current().telegram_user.set_menu(menu)
+            return callback
+
+        router.add_handler(MessageHandler(OF.menu('first'), handler('first', menu='second')), group=1)
+        router.add_handler(MessageHandler(OF.menu('first'), handler('stale')), group=2)
+        router.add_handler(MessageHandler(OF.menu('second'), handler('second', menu='third')), group=2)
+        router.add_handler(MessageHandler(OF.menu('second'), handler('same group')), group=2)
+        router.add_handler(MessageHandler(OF.menu('third'), handler('third')), group=3)
+
+        TelegramUser.objects.filter(id=self.user.id).update(menu='first')
+        update = self.benchmark.text(self.user, 'text')
+        with UpdateContext(update):
+            router.handle_update(update, telegrambot.my_bot.dispatcher, router.check_update(update))
+
+        self.assertEqual(handled, ['first', 'second', 'third'])
+        self.assertEqual(TelegramUser.objects.get(id=self.user.id).menu, 'third')
+
+    def test_generic_order(self):
+        router, handled, checked = Router(), [], []
+
+        class Counting(BaseFilter):
+            def __init__(self, name):
+                self.name = name
+
+            def filter(self, message):
+                checked.append(self.name)
+                return True
+
+        def handler(name):
+            return lambda bot, update: handled.append(name)
+
+        # The handlers which can not be indexed are registered out of group order
+        router.add_handler(MessageHandler(Counting('generic 3'), handler('generic 3')), group=3)
+        router.add_handler(MessageHandler(OF.menu(MAIN), handler('indexed 2')), group=2)
+        router.add_handler(MessageHandler(Counting('generic 1'), handler('generic 1')), group=1)
+        router.add_handler(MessageHandler(Counting('generic 2'), handler('generic 2')), group=2)
+
+        TelegramUser.objects.filter(id=self.user.id).update(menu=MAIN)
+        update = self.benchmark.text(self.user, 'text')
+        with UpdateContext(update):
+            router.handle_update(update, telegrambot.my_bot.dispatcher, router.check_update(update))
+
+        self.assertEqual(handled, ['generic 1', 'indexed 2', 'generic 3'])
+        # The handlers after the match of a group are not checked
+        self.assertEqual(checked, ['generic 1', 'generic 3'])
+
+
+class GroupEditorTest(TestCase):
+    def setUp(self):
+        self.benchmark = ReplayBenchmark(users=1, groups=1, participants=1)
+        self.benchmark.setup_bot()
+        self.addCleanup(telegrambot.my_bot.dispatcher.remove_error_handler, self.benchmark._count_error)
+        self.benchmark.generate()
+        self.user = self.benchmark.users[0]
+        self.group = self.benchmark.groups[self.user.id][0]
+
+    def test_set_datetime(self):
+        for interval in ['nan', 'inf', '1e12', '-1e400']:
+            TelegramUser.objects.filter(id=self.user.id).update(menu=SET_DATETIME, current_group=self.group)
+            telegrambot.my_bot.dispatcher.process_update(self.benchmark.text(self.user, f'2099-01-01 10:00 {interval}'))
+            self.assertEqual(self.benchmark._errors, 0)
+            self.assertIn('Please use the format', self.benchmark.api.calls[-1][1]['text'])
+
+        telegrambot.my_bot.dispatcher.process_update(self.benchmark.text(self.user, '2099-01-01 10:00 1.5'))
+        self.group.refresh_from_db()
+        self.assertEqual(self.group.post_interval, timedelta(hours=1.5))
+
+
+@override_settings(PROFILE_REFRESH_INTERVAL=60)
+class DeferredUpdatesTest(TestCase):
+    def setUp(self):
+        self.deferred = DeferredUpdates()
+        self.addCleanup(self.deferred.flush)
+        TelegramUser.objects.bulk_create(TelegramUser(id=i, full_name='User') for i in range(1, 4))
+        TelegramChannel.objects.create(id=-1, title='Channel')
+
+    def test_coalesce(self):
+        first, second = TelegramUser.objects.get(id=1), TelegramUser.objects.get(id=1)
+        with CaptureQueriesContext(connection) as queries, \
+                mock.patch('bot.models.promo_group.deferred_updates', self.deferred):
+            for number in range(3):
+                self.assertTrue(first.auto_update_values(TgUser(1, f'Name {number}', False), defer=True))
+            # Another instance of the same user does not undo the changes of the first one
+            second.auto_update_values(TgUser(1, 'Name 2', False, username='user'), defer=True)
+            TelegramUser.objects.get(id=2).auto_update_values(TgUser(2, 'Other', False), defer=True)
+            TelegramUser.objects.get(id=3).auto_update_values(TgUser(3, 'User', False), defer=True)
+            channel = TelegramChannel.objects.get(id=-1)
+            channel.auto_update_values(Chat(-1, Chat.CHANNEL, title='New title'), defer=True)
+            reads = len(queries)
+
+            self.deferred.flush()
+
+        # One bulk update per model, the unchanged user is not written
+        writes = [query['sql'] for query in queries[reads:] if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len(writes), 2)
+        self.assertEqual(dict(TelegramUser.objects.values_list('id', 'full_name')),
+                         {1: 'Name 2', 2: 'Other', 3: 'User'})
+        self.assertEqual(TelegramUser.objects.get(id=1).username, 'user')
+        self.assertEqual(TelegramChannel.objects.get(id=-1).title, 'New title')
+        self.assertEqual(second.changed_fields, [])
+
+    def test_flush(self):
+        user = TelegramUser.objects.get(id=1)
+        user.full_name = 'Changed'
+        with mock.patch('atexit.register') as register:
+            self.deferred.add(user, ['full_name'])
+            self.deferred.add(TelegramUser.objects.get(id=2), ['full_name'])
+        # Nothing is lost when the process exits before the timer
+        register.assert_called_once_with(self.deferred.flush)
+        self.assertIsNotNone(self.deferred._timer)
+        self.assertEqual(TelegramUser.objects.get(id=1).full_name, 'User')
+
+        self.deferred.flush()
+        self.assertIsNone(self.deferred._timer)
+        self.assertEqual(TelegramUser.objects.get(id=1).full_name, 'Changed')
+        with self.assertNumQueries(0):
+            self.deferred.flush()
+
+    @override_settings(PROFILE_REFRESH_INTERVAL=0)
+    def test_without_interval(self):
+        user = TelegramUser.objects.get(id=1)
+        user.full_name = 'Changed'
+        with self.assertNumQueries(1):
+            self.deferred.add(user, ['full_name', 'modified'])
+        self.assertIsNone(self.deferred._timer)
+        self.assertEqual(TelegramUser.objects.get(id=1).full_name, 'Changed')
+
+
+class ConversationStateTest(TestCase):
+    def setUp(self):
+        self.group = PromoGroup.objects.create(name='Group')
+        for i in range(1, 4):
+            TelegramUser.objects.create(id=i, full_name='User')
+
+    @staticmethod
+    def update(user_id: int) -> Update:
+        return Update(user_id, message=Message(1, TgUser(user_id, 'User', False), 0, Chat(user_id, Chat.PRIVATE),
+                                               text='text'))
+
+    def test_coalesce_writes(self):
+        with CaptureQueriesContext(connection) as queries:
+            with UpdateContext(self.update(1)) as context:
+                context.telegram_user.set_menu('edit name')
+                context.telegram_user.set_state(current_group=self.group)
+                context.telegram_user.set_menu('manage group')
+                writes = len(queries)
+
+        self.assertEqual(len([query for query in queries if query['sql'].startswith('UPDATE')]), 1)
+        self.assertEqual(writes, len(queries) - 1)
+        user = TelegramUser.objects.get(id=1)
+        self.assertEqual((user.menu, user.current_group), ('manage group', self.group))
+
+    def test_memory_backend(self):
+        backend = MemoryStateBackend(max_size=2)
+        for user in TelegramUser.objects.order_by('id'):
+            user.menu, user.current_group = f'menu {user.id}', self.group
+            backend.save(user, ['menu', 'current_group'])
+
+        # Only the evicted user was written to the database
+        self.assertEqual(dict(TelegramUser.objects.values_list('id', 'menu')), {1: 'menu 1', 2: 'main', 3: 'main'})
+
+        user = backend.load(TelegramUser.objects.get(id=2))
+        self.assertEqual((user.menu, user.current_group), ('menu 2', self.group))
+
+        backend.flush()
+        self.assertEqual(dict(TelegramUser.objects.values_list('id', 'menu')),
+                         {1: 'menu 1', 2: 'menu 2', 3: 'menu 3'})
+
+
+class AsyncCommandTest(TransactionTestCase):
+    def setUp(self):
+        TelegramUser.objects.create(id=1, full_name='User')
+        self.executor = ChatExecutor(workers=2)
+        patcher = mock.patch('bot.commands.command_executor', self.executor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def wait(self):
+        deadline = time.monotonic() + 10
+        while (self.executor.depth or self.executor.busy) and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_sees_new_menu(self):
+        menus = []
+
+        def record(bot, update):
+            menus.append(UpdateContext.current().telegram_user.menu)
+
+        with mock.patch.object(telegrambot, 'my_bot'):
+            handler = BaseCommand.command_wrapper(MessageHandler, is_async=True)(record)
+
+        bot = Bot('123:token')
+        for number, menu in enumerate(['edit name', 'manage group'], start=1):
+            update = Update(number, message=Message(number, TgUser(1, 'User', False), 0, Chat(1, Chat.PRIVATE),
+                                                    text='text'))
+            with UpdateContext(update) as context:
+                context.telegram_user.set_menu(menu)
+                handler(bot, update)
+                # The handler runs before the update is done
+                self.wait()
+
+        self.assertEqual(menus, ['edit name', 'manage group'])
+
+    def test_next_update_waits(self):
+        benchmark = ReplayBenchmark(users=1, groups=1, participants=1)
+        benchmark.setup_bot()
+        self.addCleanup(telegrambot.my_bot.dispatcher.remove_error_handler, benchmark._count_error)
+        benchmark.generate()
+        user = benchmark.users[0]
+        group = benchmark.groups[user.id][0]
+        TelegramUser.objects.filter(id=user.id).update(current_group=group)
+
+        def slow_handler():
+            time.sleep(0.2)
+            TelegramUser.objects.filter(id=user.id).update(menu=EDIT_NAME)
+
+        with mock.patch('bot.telegrambot.command_executor', self.executor):
+            self.executor.submit(user.id, slow_handler)
+            # Handled with the menu the async handler left the user in
+            telegrambot.my_bot.dispatcher.process_update(benchmark.text(user, 'Renamed'))
+
+        self.assertEqual(PromoGroup.objects.get(id=group.id).name, 'Renamed')
+        self.assertEqual(benchmark._errors, 0)
+
+
+class PluginManifestTest(SimpleTestCase):
+    def test_manifest_up_to_date(self):
+        self.assertEqual(json.loads(MANIFEST.read_text()), discover_plugins(), 'Run "manage.py plugins"')
+
+
+class LazyPluginsTest(TestCase):
+    def setUp(self):
+        self.benchmark = ReplayBenchmark(users=1, groups=1, participants=1)
+        self.benchmark.setup_bot()
+        self.addCleanup(telegrambot.my_bot.dispatcher.remove_error_handler, self.benchmark._count_error)
+        self.benchmark.generate()
+
+    def process_update(self):
+        with mock.patch('bot.commands.load_plugins') as load_plugins:
+            telegrambot.my_bot.process_update(self.benchmark.command(self.benchmark.users[0], '/help'))
+        return load_plugins
+
+    @override_settings(LAZY_PLUGINS=True)
+    def test_lazy(self):
+        self.process_update().assert_called_once_with()
+
+    def test_loaded_at_startup(self):
+        self.process_update().assert_not_called()
+
+
+class ReplayBenchmarkTest(TestCase):
+    def test_scenarios(self):
+        benchmark = ReplayBenchmark(users=2, groups=2, participants=2)
+        results = benchmark.run(iterations=4)
+
+        self.assertEqual([result.name for result in results], [scenario.name for scenario in benchmark.scenarios])
+        for result in results:
+            self.assertEqual((result.count, result.errors), (4, 0), result.name)
+        self.assertTrue(benchmark.api.sent())
+        self.assertFalse(TelegramUser.objects.exists())
+
+
+class LoadTestTest(TransactionTestCase):
+    def test_run(self):
+        load_test = LoadTest(rate=20, duration=0.5, users=3, concurrency=4)
+        load_test.run()
+        report = load_test.report()
+
+        self.assertEqual((report['updates'], report['answered'], report['unanswered']), (10, 10, 0))
+        self.assertEqual(report['errors'], {})
+        self.assertEqual(report['api calls']['sendMessage'], 10)
+        self.assertGreater(report['end-to-end p99 ms'], 0)
+        # The generated users are removed again
+        self.assertFalse(TelegramUser.objects.exists())
+
+
+class MetricsTest(TestCase):
+    def test_handler_metrics(self):
+        metrics.clear()
+        ReplayBenchmark(users=1, groups=1, participants=1).run(iterations=3, names=['help', 'manage_group'])
+
+        response = self.client.get(reverse('metrics'), HTTP_HOST='localhost')
+        self.assertEqual(response.status_code, 200)
+        text = response.content.decode()
+        self.assertIn('bot_handler_seconds_count{handler="Builtins.help"} 3', text)
+        self.assertIn('bot_handler_seconds_count{handler="GroupEditor.manage_group"} 3', text)
+        self.assertIn('bot_update_db_queries_count{handler="Builtins.help"} 3', text)
+        self.assertIn('bot_update_api_calls_bucket{handler="Builtins.help",le="2"} 3', text)
+        self.assertIn('bot_api_calls_total{method="sendMessage"} 6', text)
+        self.assertIn('bot_command_executor_depth 0', text)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_access(self):
+        url = reverse('metrics')
+        self.assertEqual(self.client.get(url, HTTP_HOST='localhost', REMOTE_ADDR='10.0.0.1').status_code, 403)
+        self.assertEqual(self.client.get(url, HTTP_HOST='localhost', REMOTE_ADDR='10.0.0.1',
+                                         HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        self.assertEqual(self.client.get(url, HTTP_HOST='localhost', REMOTE_ADDR='10.0.0.1',
+                                         HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+
+        with override_settings(METRICS_TOKEN=None, METRICS_ALLOWED_IPS=['10.0.0.1']):
+            self.assertEqual(self.client.get(url, HTTP_HOST='localhost', REMOTE_ADDR='10.0.0.1').status_code, 200)
+            self.assertEqual(self.client.get(url, HTTP_HOST='localhost').status_code, 403)
+
+
+class ProfilerTest(TestCase):
+    @staticmethod
+    def busy(seconds: float):
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            pass
+
+    def test_admin_switch(self):
+        self.assertEqual(Profiler().config()[0], 0)
+        Profiling.objects.create(active=True, sample_rate=0.5, output=PSTATS)
+        self.assertEqual(Profiler().config(), (0.5, PSTATS))
+
+    def test_profiles(self):
+        with tempfile.TemporaryDirectory() as directory, override_settings(MEDIA_ROOT=directory):
+            for output in (COLLAPSED, PSTATS):
+                profiler = Profiler(sample_rate=1, output=output)
+                for _ in range(3):
+                    with profiler.profile('Plugin.handler'):
+                        self.busy(0.02)
+                profiler.flush()
+
+            stats, collapsed = sorted(os.listdir(f'{directory}/profiles'), key=lambda name: name.endswith('collapsed'))
+            with open(f'{directory}/profiles/{collapsed}') as file:
+                stacks = [line.rsplit(' ', 1)[0] for line in file]
+            self.assertTrue(stacks)
+            self.assertTrue(all(stack.startswith('Plugin.handler;bot.tests.busy') for stack in stacks), stacks)
+
+            self.assertTrue(stats.endswith('-Plugin.handler.pstats'))
+            functions = [function for _, _, function in pstats.Stats(f'{directory}/profiles/{stats}').stats]
+            self.assertIn('busy', functions)
+
+    def test_nested(self):
+        for output in (COLLAPSED, PSTATS):
+            profiler = Profiler(sample_rate=1, output=output)
+            outer = profiler.profile('Outer.handler')
+            with mock.patch.object(profiler, 'flush'), outer:
+                inner = profiler.profile('Inner.handler')
+                with inner:
+                    self.busy(0.01)
+                # The outer sample goes on after the inner call
+                self.assertNotIsInstance(outer, nullcontext)
+                self.assertIsInstance(inner, nullcontext)
+                if output == COLLAPSED:
+                    self.assertEqual(profiler._active[threading.get_ident()][0], 'Outer.handler')
+                else:
+                    self.assertIsNotNone(outer.profile)
+                self.busy(0.01)
+
+            self.assertEqual(profiler._active, {})
+            self.assertEqual(list(profiler._stats), ['Outer.handler'] if output == PSTATS else [])
+
+
+class ConnectionLimiterTest(TransactionTestCase):
+    def test_concurrent_handlers(self):
+        limiter = ConnectionLimiter(max_connections=3, timeout=10)
+        open_counts, users = [], []
+
+        def handler(number):
+            users.append(TelegramUser.objects.filter(id=number).exists())
+            open_counts.append(limiter.open)
+            time.sleep(0.01)
+
+        with mock.patch.object(executor, 'connection_limiter', limiter):
+            chat_executor = ChatExecutor(workers=20)
+            for number in range(100):
+                chat_executor.submit(number % 30, handler, number)
+
+            deadline = time.monotonic() + 10
+            while (chat_executor.depth or chat_executor.busy) and time.monotonic() < deadline:
+                time.sleep(0.01)
+            # The idle workers close their connections
+            while limiter.open and time.monotonic() < deadline:
+                time.sleep(0.01)
+
+        self.assertEqual(len(users), 100)
+        self.assertLessEqual(max(open_counts), 3)
+        self.assertEqual(limiter.open, 0)
+
+    def test_reuse_and_max_age(self):
+        limiter = ConnectionLimiter(max_connections=1, max_age=0.05)
+        with limiter.connection():
+            TelegramUser.objects.exists()
+        self.assertTrue(limiter.holding)
+
+        time.sleep(0.05)
+        with limiter.connection():
+            TelegramUser.objects.exists()
+        self.assertFalse(limiter.holding)
+        self.assertEqual(limiter.open, 0)
+
+
+class RateLimiterTest(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = f'{self.directory.name}/rate_limit.sqlite3'
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_shared_between_processes(self):
+        # Two limiters on the same file act like two processes
+        limiters = [RateLimiter(self.path, global_rate=1000, chat_rate=50, burst=1) for _ in range(2)]
+        sent = []
+
+        def send(limiter):
+            for _ in range(10):
+                limiter.acquire(1)
+                sent.append(time.monotonic())
+
+        threads = [threading.Thread(target=send, args=(limiter,)) for limiter in limiters]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # The sends of both are spread at 50 per second
+        self.assertEqual(len(sent), 20)
+        self.assertGreaterEqual(max(sent) - min(sent), 18 / 50)
+        self.assertEqual(limiters[0].reserve(2), 0)
+
+    def test_burst(self):
+        limiter = RateLimiter(self.path, global_rate=1000, chat_rate=1, burst=3)
+        # A handler sending a few replies to a private chat does not wait
+        self.assertEqual([limiter.reserve(1) for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(limiter.reserve(1), 1, delta=0.1)
+        self.assertLess(limiter.reserve(2), 0.01)
+
+    def test_retry_after(self):
+        limiter = RateLimiter(self.path, global_rate=1000, chat_rate=1000)
+        api = FakeBotApi()
+        answer, attempts = api.answer, []
+
+        def flood_limited(method, data):
+            attempts.append(method)
+            if len(attempts) == 1:
+                raise RetryAfter(0.2)
+            return answer(method, data)
+
+        api.answer = flood_limited
+        bot = Bot('123:test', request=limiter.instrument_request(api))
+
+        started = time.monotonic()
+        bot.send_message(5, 'text')
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+        self.assertEqual((len(attempts), list(api.sent())), (2, [5]))
+
+        # Only the chat is paused
+        limiter.pause(5, 10)
+        self.assertEqual(limiter.reserve(6), 0)
+        self.assertGreater(limiter.reserve(5), 9)
+
+
+class ParticipantImporterTest(TestCase):
+    def test_parse(self):
+        self.assertEqual(ParticipantImporter.parse('@channel1, https://t.me/channel2\n-1003 t.me/channel2 no!'),
+                         ['@channel1', '@channel2', -1003, 'no!'])
+
+    def test_import(self):
+        group = PromoGroup.objects.create(name='Group')
+        TelegramChannel.objects.bulk_create(TelegramChannel(id=-i, title='Old') for i in (2, 3))
+        Participant.objects.create(channel_id=-2, promo_group=group, active=True)
+        Participant.objects.create(channel_id=-3, promo_group=group, active=False)
+
+        api = FakeBotApi(blocked={-7})
+        importer = ParticipantImporter(group, Bot('123:test', request=api))
+        with CaptureQueriesContext(connection) as queries:
+            result = importer.run('-2 -3 -4 @channel5 https://t.me/channel6 -7 invalid!')
+
+        self.assertEqual(sorted(channel.id for channel in result.added), [-6, -5, -4])
+        self.assertEqual([channel.id for channel in result.reactivated], [-3])
+        self.assertEqual([channel.id for channel in result.existing], [-2])
+        self.assertEqual(set(result.failed), {'-7', 'invalid!'})
+        self.assertEqual(set(group.participants.filter(active=True).values_list('channel_id', flat=True)),
+                         {-2, -3, -4, -5, -6})
+        self.assertEqual(TelegramChannel.objects.get(id=-3).title, 'Channel -3')
+        # Select and bulk update the channels, insert them, select, insert and reactivate the participants
+        self.assertLessEqual(len([query for query in queries if 'SAVEPOINT' not in query['sql']]), 6)
+        self.assertIn('Reactivated: @channel3', importer.report(result))
+
+
+class InviteLinkRefresherTest(TestCase):
+    def test_refresh(self):
+        group = PromoGroup.objects.create(name='Group')
+        TelegramChannel.objects.bulk_create([
+            TelegramChannel(id=-1, title='Private'),
+            TelegramChannel(id=-2, title='Public'),
+            TelegramChannel(id=-3, title='Fresh', invite_link='https://t.me/joinchat/fresh',
+                            invite_link_fetched=timezone.now()),
+            TelegramChannel(id=-4, title='Not participating'),
+        ])
+        Participant.objects.bulk_create(Participant(channel_id=-i, promo_group=group) for i in range(1, 4))
+
+        api = FakeBotApi(private={-1, -3})
+        refresher = InviteLinkRefresher(Bot('123:test', request=api))
+        self.assertEqual(refresher.refresh(), 2)
+        self.assertEqual(refresher.refresh(), 0)
+
+        links = {channel.id: channel.link for channel in TelegramChannel.objects.all()}
+        self.assertEqual(links, {-1: 'https://t.me/joinchat/1', -2: 'https://t.me/channel2',
+                                 -3: 'https://t.me/joinchat/fresh', -4: None})
+        self.assertEqual([method for method, _ in api.calls].count('exportChatInviteLink'), 1)
+
+
+class ParticipantHealthCheckTest(TestCase):
+    @override_settings(HEALTH_CHECK_BACKOFF=0)
+    def test_run(self):
+        groups = [PromoGroup.objects.create(name='First'), PromoGroup.objects.create(name='Second')]
+        TelegramChannel.objects.bulk_create(TelegramChannel(id=-i, title=f'Channel {i}') for i in range(1, 5))
+        Participant.objects.bulk_create(Participant(channel_id=-i, promo_group=group)
+                                        for i in range(1, 5) for group in groups)
+
+        timeouts = {-3: 2, -4: 10}
+
+        def on_call(method, data):
+            chat_id = int(data.get('chat_id', 0))
+            if timeouts.get(chat_id):
+                timeouts[chat_id] -= 1
+                raise TimedOut()
+
+        api = FakeBotApi(blocked={-1}, demoted={-2}, on_call=on_call)
+        result = ParticipantHealthCheck(Bot('123:test', request=api)).run()
+
+        self.assertEqual(result.checked, 4)
+        self.assertEqual(set(result.failing), {-1, -2})
+        self.assertEqual(result.unknown, [-4])
+        self.assertEqual(result.deactivated, 4)
+        inactive = Participant.objects.filter(active=False).values_list('channel_id', flat=True)
+        self.assertEqual(sorted(inactive), [-2, -2, -1, -1])
+
+        # Inactive participants are not checked again
+        self.assertEqual(ParticipantHealthCheck(Bot('123:test', request=FakeBotApi())).run().checked, 2)
+
+
+class ChannelAdminSyncTest(TestCase):
+    def test_sync(self):
+        TelegramChannel.objects.bulk_create(TelegramChannel(id=-i, title=f'Channel {i}') for i in range(1, 4))
+        TelegramUser.objects.bulk_create(TelegramUser(id=i, full_name=f'User {i}') for i in (10, 13))
+        TelegramChannel.objects.get(id=-1).admins.add(10, 13)
+        TelegramChannel.objects.get(id=-3).admins.add(10)
+
+        api = FakeBotApi(blocked={-3}, admins={-1: [10, 11], -2: [11, 12]})
+        admin_sync = ChannelAdminSync(Bot('123:test', request=api))
+        self.assertEqual(admin_sync.sync(), (2, 3, 1, [-3]))
+
+        admins = {channel.id: sorted(channel.admins.values_list('id', flat=True))
+                  for channel in TelegramChannel.objects.all()}
+        self.assertEqual(admins, {-1: [10, 11], -2: [11, 12], -3: [10]})
+        self.assertEqual(TelegramUser.objects.get(id=12).full_name, 'User 12')
+
+        # Nothing changed, only the sync time is written
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(admin_sync.sync(), (2, 0, 0, [-3]))
+        writes = [query['sql'] for query in queries if query['sql'].startswith(('INSERT', 'UPDATE', 'DELETE'))]
+        self.assertEqual(len(writes), 1)
+
+    def test_check_user_permissions(self):
+        channel = TelegramChannel.objects.create(id=-1, title='Channel', admins_synced=timezone.now())
+        TelegramUser.objects.create(id=10, full_name='User')
+        channel.admins.add(10)
+
+        api = FakeBotApi()
+        chat = Chat(-1, Chat.CHANNEL, bot=Bot('123:test', request=api))
+        self.assertTrue(check_user_permissions(TgUser(10, 'User', False), chat))
+        with self.assertRaises(Unauthorized):
+            check_user_permissions(TgUser(11, 'User', False), chat)
+        self.assertEqual(api.calls, [])
+
+        # Channels which were never synced or not for a long time are asked
+        TelegramChannel.objects.filter(id=-1).update(admins_synced=None)
+        self.assertTrue(check_user_permissions(TgUser(11, 'User', False), chat))
+        TelegramChannel.objects.filter(id=-1).update(admins_synced=timezone.now() - timedelta(hours=3))
+        with override_settings(ADMIN_SYNC_INTERVAL=3600):
+            self.assertTrue(check_user_permissions(TgUser(11, 'User', False), chat))
+        self.assertEqual([method for method, _ in api.calls], ['getChatMember', 'getChatMember'])
+
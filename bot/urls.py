@@ -1,12 +1,18 @@
+from django.conf import settings
 from django.conf.urls import url
 from django.contrib import admin
 from django.shortcuts import redirect
 from django.urls import include, path
 
-from bot.views import redirec_to_admin_view
+from bot.views import metrics_view, redirec_to_admin_view, webhook
+
+webhook_base = settings.DJANGO_TELEGRAMBOT.get('WEBHOOK_PREFIX', '/').strip('/')
+webhook_base = f'{webhook_base}/' if webhook_base else ''
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('', redirec_to_admin_view),
+    path('metrics/', metrics_view, name='metrics'),
+    url(rf'^{webhook_base}(?P<bot_token>.+?)/$', webhook, name='update_queue_webhook'),
     url(r'^', include('django_telegrambot.urls')),
 ]
@@ -0,0 +1,142 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, NamedTuple
+
+from django.conf import settings
+from telegram import Bot, Chat, TelegramError, User
+
+logger = logging.getLogger('ChatCache')
+
+
+class ChatInfo(NamedTuple):
+    """Compact snapshot of a `telegram.Chat`"""
+    id: int
+    type: str
+    title: str or None = None
+    username: str or None = None
+    first_name: str or None = None
+    last_name: str or None = None
+    invite_link: str or None = None
+
+    @classmethod
+    def from_chat(cls, chat: Chat) -> 'ChatInfo':
+        return cls(chat.id, chat.type, chat.title, chat.username, chat.first_name, chat.last_name, chat.invite_link)
+
+    @property
+    def full_name(self) -> str or None:
+        if self.first_name:
+            return f'{self.first_name} {self.last_name}' if self.last_name else self.first_name
+        return self.title
+
+    @property
+    def link(self) -> str or None:
+        return f'https://t.me/{self.username}' if self.username else None
+
+
+class ChatCache:
+    """Process wide cache of chat infos and the bot user
+
+    Entries expire after `CHAT_CACHE_TTL` seconds and the least recently used entries are evicted once more than
+    `CHAT_CACHE_SIZE` chats are cached.
+    """
+
+    def __init__(self, ttl: float = None, max_size: int = None):
+        self._ttl = ttl
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._entries: Dict[int, tuple] = OrderedDict()
+        self._me: tuple = None
+
+    @property
+    def ttl(self) -> float:
+        return self._ttl if self._ttl is not None else getattr(settings, 'CHAT_CACHE_TTL', 300)
+
+    @property
+    def max_size(self) -> int:
+        return self._max_size if self._max_size is not None else getattr(settings, 'CHAT_CACHE_SIZE', 10000)
+
+    @staticmethod
+    def default_bot() -> Bot:
+        from bot.telegrambot import my_bot
+        return my_bot.bot
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _cached(self, chat_id: int) -> ChatInfo or None:
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            if not entry:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[chat_id]
+                return None
+            self._entries.move_to_end(chat_id)
+            return entry[1]
+
+    def put(self, chat: Chat or ChatInfo) -> ChatInfo:
+        info = chat if isinstance(chat, ChatInfo) else ChatInfo.from_chat(chat)
+        with self._lock:
+            self._entries[info.id] = time.monotonic() + self.ttl, info
+            self._entries.move_to_end(info.id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return info
+
+    def get(self, chat_id: int, bot: Bot = None) -> ChatInfo:
+        """Get the chat info, fetches it from telegram if it is not cached"""
+        return self._cached(chat_id) or self.put((bot or self.default_bot()).get_chat(chat_id))
+
+    def prefetch(self, chat_ids: Iterable[int], bot: Bot = None) -> Dict[int, ChatInfo]:
+        """Get the chat infos of multiple chats, the missing chats are fetched concurrently
+
+        Chats which can not be fetched are left out.
+        """
+        result = {}
+        missing = []
+        for chat_id in set(chat_ids):
+            info = self._cached(chat_id)
+            if info:
+                result[chat_id] = info
+            else:
+                missing.append(chat_id)
+
+        if not missing:
+            return result
+
+        bot = bot or self.default_bot()
+
+        def fetch(chat_id):
+            try:
+                return self.put(bot.get_chat(chat_id))
+            except TelegramError as error:
+                logger.info(f'Could not fetch chat {chat_id}: {error}')
+
+        with ThreadPoolExecutor(max_workers=getattr(settings, 'CHAT_CACHE_PREFETCH_WORKERS', 8)) as executor:
+            for info in executor.map(fetch, missing):
+                if info:
+                    result[info.id] = info
+        return result
+
+    def invalidate(self, *chat_ids: int):
+        with self._lock:
+            for chat_id in chat_ids:
+                self._entries.pop(chat_id, None)
+
+    def me(self) -> User:
+        """Get the bot user"""
+        me = self._me
+        if not me or me[0] < time.monotonic():
+            me = self._me = time.monotonic() + self.ttl, self.default_bot().get_me()
+        return me[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._me = None
+
+
+chat_cache = ChatCache()
@@ -1,12 +1,14 @@
 import logging
+from datetime import timedelta
 from typing import List
 
-from telegram import Animation, Audio, Chat, ChatMember, Document, InlineKeyboardButton, InlineKeyboardMarkup, Message, PhotoSize, \
-    User, Video, Voice
+from django.conf import settings
+from django.utils import timezone
+from telegram import Animation, Audio, Bot, Chat, ChatMember, Document, InlineKeyboardButton, InlineKeyboardMarkup, \
+    Message, PhotoSize, User, Video, Voice
 from telegram.error import Unauthorized
 
-from bot.models.promo_group import TelegramUser
-from bot.telegrambot import my_bot
+from bot.models.promo_group import TelegramChannel, TelegramUser
 
 bot_not_running_protect_logger = logging.getLogger('bot_not_running_protect')
 
@@ -45,27 +47,39 @@ def is_media_message(msg: Message) -> bool:
 def channel_selector_menu(user: TelegramUser, prefix: str,
                           header_buttons: List[InlineKeyboardButton] = None,
                           footer_buttons: List[InlineKeyboardButton] = None) -> InlineKeyboardMarkup or None:
-    if not user.channels:
+    channels = list(user.channels.all())
+    if not channels:
         return
     buttons = []
-    for channel in user.channels.all():
+    for channel in channels:
         buttons.append(InlineKeyboardButton(channel.name, callback_data=f'{prefix}:{channel.id}'))
     return InlineKeyboardMarkup(build_menu(*buttons, header_buttons=header_buttons, footer_buttons=footer_buttons))
 
 
 def check_user_permissions(user: User, channel: Chat) -> bool:
-    user_member: ChatMember = channel.get_member(user.id)
+    """Uses the stored admins of channels synced by `ChannelAdminSync` recently, asks telegram for the others
 
-    if user_member.status not in [user_member.ADMINISTRATOR, user_member.CREATOR]:
+    The stored admins are trusted for two `ADMIN_SYNC_INTERVAL`s, so a removed admin loses the permissions even if the
+    sync stopped.
+    """
+    max_age = timedelta(seconds=2 * getattr(settings, 'ADMIN_SYNC_INTERVAL', 3600))
+    synced = TelegramChannel.objects.filter(id=channel.id, admins_synced__gte=timezone.now() - max_age)
+    if synced.exists():
+        is_admin = synced.filter(admins=user.id).exists()
+    else:
+        user_member: ChatMember = channel.get_member(user.id)
+        is_admin = user_member.status in [user_member.ADMINISTRATOR, user_member.CREATOR]
+
+    if not is_admin:
         raise Unauthorized('User is not an admin of the channel.')
     return True
 
 
-def check_bot_permissions(channel: Chat) -> bool:
-    try:
-        member = channel.get_member(my_bot.me().id)
-        if member.status == member.LEFT:
-            raise Unauthorized('Not a member')
-    except Unauthorized:
-        raise Unauthorized('Not a member')
-    return True
+def bot_permission_problem(bot: Bot, chat_id: int) -> str or None:
+    """Why the bot can not post in the channel, None if it can"""
+    member: ChatMember = bot.get_chat_member(chat_id, bot.id)
+    if member.status not in [member.ADMINISTRATOR, member.CREATOR]:
+        return 'the bot is not an admin of the channel'
+    if member.can_post_messages is False:
+        return 'the bot can not post messages in the channel'
+    return None
@@ -0,0 +1,91 @@
+import threading
+from typing import Iterable, Optional, Set
+
+from telegram import Update, User
+
+from bot.models.promo_group import TelegramChannel
+from bot.models.promo_group import TelegramUser
+from bot.utils.state import state_backend
+
+_local = threading.local()
+_unset = object()
+
+
+class UpdateContext:
+    """Objects loaded from the database for a single update
+
+    The context is created when the dispatcher starts processing an update and dropped as soon as it is done. Filters
+    and every `BaseCommand` instance created for the update share the same `TelegramUser` and `TelegramChannel`, so
+    they are only queried once per update. Changes of the conversation state of the user are saved together when the
+    context is left.
+    """
+
+    def __init__(self, update: Update = None):
+        self.update = update
+        self._telegram_user = _unset
+        self._telegram_channel = _unset
+        self._changed_state: Set[str] = set()
+
+    @staticmethod
+    def current() -> Optional['UpdateContext']:
+        return getattr(_local, 'context', None)
+
+    @staticmethod
+    def for_update(update: Update) -> 'UpdateContext':
+        """Get the context of the update being dispatched or a new one if it is not the current update"""
+        context = UpdateContext.current()
+        if context and context.update is update:
+            return context
+        return UpdateContext(update)
+
+    @staticmethod
+    def get_telegram_user(user: User) -> TelegramUser or None:
+        """Get the `TelegramUser` of the given user, from the current context if it belongs to it"""
+        context = UpdateContext.current()
+        if context and context.user and context.user.id == user.id:
+            return context.telegram_user
+        telegram_user = TelegramUser.objects.filter(id=user.id).first()
+        return state_backend().load(telegram_user) if telegram_user else None
+
+    def __enter__(self) -> 'UpdateContext':
+        self._previous = UpdateContext.current()
+        _local.context = self
+        return self
+
+    def __exit__(self, *exc_info):
+        _local.context = self._previous
+        del self._previous
+        self.save_state()
+
+    def defer_state(self, user: TelegramUser, fields: Iterable[str]) -> bool:
+        """Save the changed state fields of the user when the context is left, if it is the user of the context"""
+        if self._telegram_user is not user:
+            return False
+        self._changed_state.update(fields)
+        return True
+
+    def save_state(self):
+        if self._changed_state:
+            fields, self._changed_state = self._changed_state, set()
+            state_backend().save(self._telegram_user, fields)
+
+    @property
+    def user(self) -> User or None:
+        return self.update.effective_user if self.update else None
+
+    @property
+    def telegram_user(self) -> TelegramUser or None:
+        if self._telegram_user is _unset:
+            if not self.user:
+                self._telegram_user = None
+            else:
+                self._telegram_user = state_backend().load(TelegramUser.objects.get_or_create(id=self.user.id)[0])
+                self._telegram_user.auto_update_values(self.user, save=True, defer=True)
+        return self._telegram_user
+
+    @property
+    def telegram_channel(self) -> TelegramChannel or None:
+        if self._telegram_channel is _unset:
+            chat = self.update.effective_chat if self.update else None
+            self._telegram_channel = TelegramChannel.objects.filter(id=chat.id).first() if chat else None
+        return self._telegram_channel
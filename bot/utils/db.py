@@ -0,0 +1,112 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections
+
+
+class ConnectionLimiter:
+    """Limit and recycle the database connections of the worker threads
+
+    Django opens one connection per thread and database. A worker thread has to take a slot with `connection()`
+    before it uses the database, there are at most `DB_WORKER_CONNECTIONS` slots. The connections of a thread are
+    kept between its tasks, so a busy worker reuses them, until they are older than `DB_WORKER_CONNECTION_MAX_AGE`
+    seconds or broken. Workers call `release()` when they become idle or exit, which closes the connections and frees
+    the slot.
+
+    A thread waiting longer than `DB_WORKER_CONNECTION_TIMEOUT` seconds for a slot opens a connection anyway, so
+    handlers waiting on each other can not deadlock, this is logged.
+    """
+
+    def __init__(self, max_connections: int = None, max_age: float = None, timeout: float = None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self._max_connections = max_connections
+        self._max_age = max_age
+        self._timeout = timeout
+        self._condition = threading.Condition()
+        self._local = threading.local()
+        self.open = 0
+
+    @property
+    def max_connections(self) -> int:
+        if self._max_connections is not None:
+            return self._max_connections
+        return getattr(settings, 'DB_WORKER_CONNECTIONS', 10)
+
+    @property
+    def max_age(self) -> float:
+        return self._max_age if self._max_age is not None else getattr(settings, 'DB_WORKER_CONNECTION_MAX_AGE', 300)
+
+    @property
+    def timeout(self) -> float:
+        return self._timeout if self._timeout is not None else getattr(settings, 'DB_WORKER_CONNECTION_TIMEOUT', 30)
+
+    @property
+    def holding(self) -> bool:
+        """If the current thread has a slot"""
+        return getattr(self._local, 'opened', None) is not None
+
+    def acquire(self):
+        """Take a slot for the current thread, waits until one is free"""
+        if self.holding:
+            return
+        deadline = time.monotonic() + self.timeout
+        with self._condition:
+            while self.open >= self.max_connections:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.logger.warning(f'Waited {self.timeout}s for a database connection, opening one more than '
+                                        f'the {self.max_connections} allowed')
+                    break
+                self._condition.wait(remaining)
+            self.open += 1
+        self._local.opened = time.monotonic()
+
+    def release(self):
+        """Close the connections of the current thread and free its slot"""
+        connections.close_all()
+        if not self.holding:
+            return
+        self._local.opened = None
+        with self._condition:
+            self.open -= 1
+            self._condition.notify()
+
+    def recycle(self):
+        """Keep the connections of the current thread for its next task, unless they are too old or broken
+
+        Django's own `close_old_connections` would close them after every task without `CONN_MAX_AGE`.
+        """
+        if not self.holding:
+            return
+        if time.monotonic() - self._local.opened > self.max_age:
+            self.release()
+            return
+        for connection in connections.all():
+            if connection.connection is None:
+                continue
+            if connection.get_autocommit() != connection.settings_dict['AUTOCOMMIT'] \
+                    or (connection.errors_occurred and not connection.is_usable()):
+                connection.close()
+            else:
+                connection.errors_occurred = False
+        if all(connection.connection is None for connection in connections.all()):
+            # No connection is open, the slot is free for another thread
+            self.release()
+
+    @contextmanager
+    def connection(self, keep: bool = True):
+        """Hold a slot while running the code in it, with `keep` the connections are kept for the next task"""
+        self.acquire()
+        try:
+            yield
+        finally:
+            if keep:
+                self.recycle()
+            else:
+                self.release()
+
+
+connection_limiter = ConnectionLimiter()
@@ -0,0 +1,143 @@
+import logging
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, Hashable, List, NamedTuple
+
+from django.conf import settings
+
+from bot.utils.db import connection_limiter
+from bot.utils.metrics import metrics
+
+
+class Task(NamedTuple):
+    func: Callable
+    args: tuple
+    kwargs: dict
+    deadline: float or None
+    timeout: float or None
+
+
+class ChatExecutor:
+    """Thread pool running the tasks of a chat one after the other
+
+    Tasks are submitted with a key (the chat id), the tasks of a key run in the order they were submitted and never at
+    the same time, tasks of different keys run in parallel on `COMMAND_EXECUTOR_WORKERS` threads.
+
+    A task which could not start within its timeout (`COMMAND_EXECUTOR_TIMEOUT` by default) is skipped, a task
+    running longer than it is logged. Python threads can not be interrupted, so a running task is never aborted.
+    """
+
+    def __init__(self, workers: int = None, timeout: float = None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self._workers = workers
+        self._timeout = timeout
+        self._condition = threading.Condition()
+        self._tasks: Dict[Hashable, Deque[Task]] = {}
+        self._ready: Deque[Hashable] = deque()
+        self._threads: List[threading.Thread] = []
+        self.busy = 0
+
+    @property
+    def workers(self) -> int:
+        return self._workers if self._workers is not None else getattr(settings, 'COMMAND_EXECUTOR_WORKERS', 8)
+
+    @property
+    def timeout(self) -> float or None:
+        return self._timeout if self._timeout is not None else getattr(settings, 'COMMAND_EXECUTOR_TIMEOUT', 60)
+
+    @property
+    def depth(self) -> int:
+        """Number of tasks waiting to be run"""
+        with self._condition:
+            return sum(map(len, self._tasks.values()))
+
+    def depths(self) -> Dict[Hashable, int]:
+        """Number of waiting tasks per key"""
+        with self._condition:
+            return {key: len(tasks) for key, tasks in self._tasks.items() if tasks}
+
+    def wait(self, key: Hashable, timeout: float = None) -> bool:
+        """Wait until the key has no waiting or running tasks, returns False if they are not done within the timeout
+
+        A task waiting for its own key would never finish, so the workers do not wait.
+        """
+        if threading.current_thread() in self._threads:
+            return True
+        timeout = timeout if timeout is not None else self.timeout
+        deadline = time.monotonic() + timeout if timeout else None
+        with self._condition:
+            while key in self._tasks:
+                remaining = deadline - time.monotonic() if deadline else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def _start(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work, name=f'ChatExecutor-{len(self._threads)}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, key: Hashable, func: Callable, *args, timeout: float = None, **kwargs):
+        timeout = timeout if timeout is not None else self.timeout
+        task = Task(func, args, kwargs, time.monotonic() + timeout if timeout else None, timeout)
+        with self._condition:
+            self._start()
+            if key in self._tasks:
+                # A task of the key is running, this one is started once it is done
+                self._tasks[key].append(task)
+            else:
+                self._tasks[key] = deque([task])
+                self._ready.append(key)
+                self._condition.notify()
+
+    def _work(self):
+        while True:
+            with self._condition:
+                idle = not self._ready
+            if idle:
+                # Let the other workers use the database connection while this one waits
+                connection_limiter.release()
+            with self._condition:
+                while not self._ready:
+                    self._condition.wait()
+                key = self._ready.popleft()
+                task = self._tasks[key].popleft()
+                self.busy += 1
+
+            try:
+                with connection_limiter.connection():
+                    self._run(key, task)
+            finally:
+                with self._condition:
+                    self.busy -= 1
+                    if self._tasks[key]:
+                        self._ready.append(key)
+                        self._condition.notify()
+                    else:
+                        del self._tasks[key]
+                        # Wake up the threads waiting for the key
+                        self._condition.notify_all()
+
+    def _run(self, key: Hashable, task: Task):
+        name = getattr(task.func, '__qualname__', task.func)
+        started = time.monotonic()
+        if task.deadline and started > task.deadline:
+            self.logger.warning(f'Skipped {name} for {key}, it waited more than {task.timeout}s')
+            return
+
+        try:
+            task.func(*task.args, **task.kwargs)
+        except Exception:
+            self.logger.exception(f'{name} for {key} failed')
+
+        duration = time.monotonic() - started
+        if task.timeout and duration > task.timeout:
+            self.logger.warning(f'{name} for {key} took {duration:.1f}s, longer than its timeout of {task.timeout}s')
+
+
+command_executor = ChatExecutor()
+metrics.describe('bot_command_executor_depth', 'gauge', 'Async command handlers waiting to run')
+metrics.gauge('bot_command_executor_depth', lambda: {(): command_executor.depth})
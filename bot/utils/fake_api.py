@@ -0,0 +1,135 @@
+import itertools
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Tuple
+from urllib.parse import parse_qsl
+
+from telegram.error import BadRequest, TelegramError, Unauthorized
+
+
+class FakeBotApi:
+    """Stand-in for the `telegram.utils.request.Request` of a bot, answers like the Bot API would
+
+    Used by the tests and benchmarks, no request leaves the process. Chats in `blocked` answer like a channel the bot
+    was kicked from, chats in `private` have no username, in chats in `demoted` the bot is no admin, `admins` maps
+    chat ids to the ids of the users administrating them besides the bot, file ids in `invalid_files` are rejected.
+    """
+
+    def __init__(self, blocked=(), invalid_files=(), private=(), demoted=(), admins: Dict[int, List[int]] = None,
+                 on_call: Callable[[str, dict], None] = None):
+        self.calls: List[Tuple[str, dict]] = []
+        self.on_call = on_call
+        self.blocked = set(blocked)
+        self.private = set(private)
+        self.demoted = set(demoted)
+        self.admins = admins or {}
+        self.invalid_files = set(invalid_files)
+        self.uploads = 0
+        self.con_pool_size = 1
+        self._message_ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def answer(self, method: str, data: dict):
+        """The result of an API call, raises the `TelegramError` the API would answer with"""
+        chat_id = data.get('chat_id', 0)
+        # Channels are found by their username "@channel<id>" as well
+        chat_id = -int(chat_id[8:]) if str(chat_id).startswith('@channel') else int(chat_id)
+        if chat_id in self.blocked:
+            raise Unauthorized('Forbidden: bot was kicked from the channel chat')
+        with self._lock:
+            self.calls.append((method, data))
+        if self.on_call:
+            self.on_call(method, data)
+
+        chat = {'id': chat_id, 'type': 'channel' if chat_id < 0 else 'private'}
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Bot', 'username': 'bot'}
+        elif method == 'getChat':
+            if chat_id in self.private:
+                return dict(chat, title=f'Channel {chat_id}')
+            return dict(chat, title=f'Channel {chat_id}', username=f'channel{-chat_id}')
+        elif method == 'getChatMember':
+            return {'user': {'id': int(data['user_id']), 'is_bot': False, 'first_name': 'User'},
+                    'status': 'member' if chat_id in self.demoted else 'administrator'}
+        elif method == 'getChatAdministrators':
+            return [{'user': {'id': 1, 'is_bot': True, 'first_name': 'Bot'}, 'status': 'administrator'}] + [
+                {'user': {'id': user_id, 'is_bot': False, 'first_name': 'User', 'last_name': str(user_id)},
+                 'status': 'administrator'} for user_id in self.admins.get(chat_id, [])]
+        elif method == 'exportChatInviteLink':
+            return f'https://t.me/joinchat/{-chat_id}'
+        elif method == 'sendMessage':
+            return {'message_id': next(self._message_ids), 'date': 0, 'chat': chat, 'text': data['text']}
+        elif method == 'sendPhoto':
+            file_id = data['photo']
+            if not isinstance(file_id, str):
+                with self._lock:
+                    self.uploads += 1
+                    file_id = f'file{self.uploads}'
+            elif file_id in self.invalid_files:
+                raise BadRequest('Wrong file identifier/http url specified')
+            return {'message_id': next(self._message_ids), 'date': 0, 'chat': chat,
+                    'caption': data.get('caption'), 'photo': [{'file_id': file_id, 'width': 1, 'height': 1}]}
+        return True
+
+    def post(self, url, data, timeout=None):
+        return self.answer(url.rsplit('/', 1)[1], data)
+
+    def get(self, url, timeout=None):
+        return self.post(url, {}, timeout)
+
+    def stop(self):
+        pass
+
+    def sent(self, method='sendMessage') -> Dict[int, dict]:
+        return {int(data['chat_id']): data for name, data in self.calls if name == method}
+
+
+class FakeBotApiServer(ThreadingHTTPServer):
+    """Local HTTP server answering Bot API requests with a `FakeBotApi`
+
+    Point a bot at it with `Bot(token, base_url=server.base_url)`.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, api: FakeBotApi, host: str = '127.0.0.1', port: int = 0):
+        self.api = api
+        super().__init__((host, port), _FakeBotApiHandler)
+
+    @property
+    def base_url(self) -> str:
+        return f'http://{self.server_address[0]}:{self.server_address[1]}/bot'
+
+    def start(self) -> 'FakeBotApiServer':
+        threading.Thread(target=self.serve_forever, name='FakeBotApiServer', daemon=True).start()
+        return self
+
+
+class _FakeBotApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            data = json.loads(body or '{}')
+        else:
+            data = dict(parse_qsl(body))
+
+        try:
+            response = {'ok': True, 'result': self.server.api.answer(self.path.rsplit('/', 1)[1], data)}
+        except TelegramError as error:
+            response = {'ok': False, 'error_code': 403 if isinstance(error, Unauthorized) else 400,
+                        'description': error.message}
+
+        content = json.dumps(response).encode()
+        self.send_response(200 if response['ok'] else response['error_code'])
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = do_POST
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,177 @@
+import bisect
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Dict, List, Tuple
+
+from django.conf import settings
+from django.db import connection
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Metrics:
+    """Process wide counters and histograms, rendered in the Prometheus text format
+
+    Every process has its own values, with multiple processes each one has to be scraped.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help: Dict[str, Tuple[str, str]] = {}
+        self._counters: Dict[str, Dict[Labels, float]] = defaultdict(lambda: defaultdict(float))
+        self._histograms: Dict[str, Dict[Labels, Histogram]] = defaultdict(dict)
+        self._gauges: Dict[str, Callable[[], Dict[Labels, float]]] = {}
+
+    @staticmethod
+    def _labels(labels: dict) -> Labels:
+        return tuple(sorted(labels.items()))
+
+    def describe(self, name: str, kind: str, text: str):
+        self._help[name] = kind, text
+
+    def inc(self, name: str, value: float = 1, **labels):
+        with self._lock:
+            self._counters[name][self._labels(labels)] += value
+
+    def observe(self, name: str, value: float, buckets: Tuple[float, ...] = LATENCY_BUCKETS, **labels):
+        key = self._labels(labels)
+        with self._lock:
+            histogram = self._histograms[name].get(key)
+            if histogram is None:
+                histogram = self._histograms[name][key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def gauge(self, name: str, collect: Callable[[], Dict[Labels, float]]):
+        """Register a gauge, `collect` returns the values by labels when the metrics are rendered"""
+        self._gauges[name] = collect
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    @staticmethod
+    def _format_labels(labels: Labels, **extra) -> str:
+        labels = labels + tuple(extra.items())
+        if not labels:
+            return ''
+        values = ','.join('{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"'))
+                          for name, value in labels)
+        return f'{{{values}}}'
+
+    def _header(self, lines: List[str], name: str, kind: str):
+        text = self._help.get(name, (kind, ''))[1]
+        if text:
+            lines.append(f'# HELP {name} {text}')
+        lines.append(f'# TYPE {name} {kind}')
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, values in sorted(self._counters.items()):
+                self._header(lines, name, 'counter')
+                for labels, value in values.items():
+                    lines.append(f'{name}{self._format_labels(labels)} {value:g}')
+
+            for name, histograms in sorted(self._histograms.items()):
+                self._header(lines, name, 'histogram')
+                for labels, histogram in histograms.items():
+                    total = 0
+                    for bucket, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                        total += count
+                        lines.append(f'{name}_bucket{self._format_labels(labels, le=bucket)} {total}')
+                    lines.append(f'{name}_sum{self._format_labels(labels)} {histogram.sum:g}')
+                    lines.append(f'{name}_count{self._format_labels(labels)} {total}')
+
+        for name, collect in sorted(self._gauges.items()):
+            self._header(lines, name, 'gauge')
+            for labels, value in collect().items():
+                lines.append(f'{name}{self._format_labels(labels)} {value:g}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+metrics.describe('bot_handler_seconds', 'histogram', 'Time spent in a command handler')
+metrics.describe('bot_handler_errors_total', 'counter', 'Exceptions raised by a command handler')
+metrics.describe('bot_filter_seconds', 'histogram', 'Time spent checking the filters of a handler')
+metrics.describe('bot_update_seconds', 'histogram', 'Time spent dispatching an update, by the handler which ran')
+metrics.describe('bot_update_db_queries', 'histogram', 'Database queries per update')
+metrics.describe('bot_update_api_calls', 'histogram', 'Bot API calls per update')
+metrics.describe('bot_api_calls_total', 'counter', 'Bot API calls by method')
+metrics.describe('bot_api_errors_total', 'counter', 'Failed Bot API calls by method')
+
+_local = threading.local()
+
+
+def enabled() -> bool:
+    return getattr(settings, 'METRICS_ENABLED', True)
+
+
+class UpdateMetrics:
+    """Count the database queries and Bot API calls made while dispatching an update in this thread"""
+
+    def __init__(self):
+        self.handler = 'none'
+        self.queries = 0
+        self.api_calls = 0
+
+    @staticmethod
+    def current() -> 'UpdateMetrics' or None:
+        return getattr(_local, 'update', None)
+
+    def _count_query(self, execute, sql, params, many, context):
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+    def __enter__(self) -> 'UpdateMetrics':
+        self._previous = UpdateMetrics.current()
+        _local.update = self
+        self._started = time.perf_counter()
+        self._wrapper = connection.execute_wrapper(self._count_query)
+        self._wrapper.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._wrapper.__exit__(*exc_info)
+        _local.update = self._previous
+        metrics.observe('bot_update_seconds', time.perf_counter() - self._started, handler=self.handler)
+        metrics.observe('bot_update_db_queries', self.queries, COUNT_BUCKETS, handler=self.handler)
+        metrics.observe('bot_update_api_calls', self.api_calls, COUNT_BUCKETS, handler=self.handler)
+
+
+def instrument_request(request):
+    """Count the Bot API calls made through a `telegram.utils.request.Request`"""
+    if getattr(request, '_instrumented', False):
+        return request
+    post = request.post
+
+    def counted_post(url, *args, **kwargs):
+        method = url.rsplit('/', 1)[-1]
+        update = UpdateMetrics.current()
+        if update:
+            update.api_calls += 1
+        metrics.inc('bot_api_calls_total', method=method)
+        try:
+            return post(url, *args, **kwargs)
+        except Exception:
+            metrics.inc('bot_api_errors_total', method=method)
+            raise
+
+    request.post = counted_post
+    request._instrumented = True
+    return request
@@ -0,0 +1,186 @@
+import atexit
+import cProfile
+import logging
+import marshal
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import nullcontext
+from typing import Dict, Tuple
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.utils import timezone
+
+COLLAPSED = 'collapsed'
+PSTATS = 'pstats'
+
+
+class _Sample:
+    """A profiled handler call"""
+
+    def __init__(self, profiler: 'Profiler', name: str, output: str):
+        self.profiler = profiler
+        self.name = name
+        self.output = output
+        self.profile: cProfile.Profile or None = None
+
+    def __enter__(self):
+        self.profiler._local.sampling = True
+        if self.output == PSTATS:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        else:
+            # The stacks are cut at the frame entering the sample, so they start with the handler
+            self.profiler._enter(self.name, sys._getframe(1))
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler._local.sampling = False
+        if self.profile:
+            self.profile.disable()
+            self.profiler._add_profile(self.name, self.profile)
+        else:
+            self.profiler._exit()
+
+
+class Profiler:
+    """Profile a sampled fraction of the command handler calls
+
+    Switched on with the `PROFILER_SAMPLE_RATE` setting (environment variable of the same name) or in the admin with
+    a `Profiling` row, which is re-read every `PROFILER_REFRESH_INTERVAL` seconds. Every `PROFILER_FLUSH_INTERVAL`
+    seconds the collected profiles are written to `profiles/` in the media storage:
+
+    - `collapsed`: the stacks of the sampled calls are sampled every `PROFILER_INTERVAL` seconds, one file per flush
+      in the collapsed stack format of flame graphs, the handler name is the root frame of every stack.
+    - `pstats`: the sampled calls run under `cProfile`, one file per flush and handler readable by `pstats.Stats`.
+    """
+
+    def __init__(self, sample_rate: float = None, output: str = None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self._sample_rate = sample_rate
+        self._output = output
+        self._config: Tuple[float, str] = (0, COLLAPSED)
+        self._config_loaded = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._active: Dict[int, Tuple[str, object]] = {}
+        self._stacks: Counter = Counter()
+        self._stats: Dict[str, pstats.Stats] = {}
+        self._flushed = time.monotonic()
+        self._sampler: threading.Thread or None = None
+        self._wake = threading.Event()
+
+    @property
+    def interval(self) -> float:
+        return getattr(settings, 'PROFILER_INTERVAL', 0.005)
+
+    @property
+    def flush_interval(self) -> float:
+        return getattr(settings, 'PROFILER_FLUSH_INTERVAL', 60)
+
+    def config(self) -> Tuple[float, str]:
+        """Sample rate and output format, the explicit ones, the settings or the active `Profiling` row"""
+        if self._sample_rate is not None:
+            return self._sample_rate, self._output or COLLAPSED
+        if getattr(settings, 'PROFILER_SAMPLE_RATE', 0):
+            return settings.PROFILER_SAMPLE_RATE, getattr(settings, 'PROFILER_OUTPUT', COLLAPSED)
+
+        now = time.monotonic()
+        refresh_interval = getattr(settings, 'PROFILER_REFRESH_INTERVAL', 10)
+        if self._config_loaded is None or now - self._config_loaded > refresh_interval:
+            from bot.models import Profiling
+            self._config_loaded = now
+            row = Profiling.objects.filter(active=True).order_by('id').values_list('sample_rate', 'output').first()
+            self._config = row or (0, COLLAPSED)
+        return self._config
+
+    def profile(self, name: str):
+        """Context manager profiling the code in it, if this call is sampled
+
+        Calls made inside a sampled call, eg. a handler running another one, are part of its sample and not sampled
+        on their own.
+        """
+        if getattr(self._local, 'sampling', False):
+            return nullcontext()
+        sample_rate, output = self.config()
+        if not sample_rate or random.random() >= sample_rate:
+            return nullcontext()
+        return _Sample(self, name, output)
+
+    def _enter(self, name: str, frame):
+        with self._lock:
+            self._active[threading.get_ident()] = name, frame
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample, name='Profiler', daemon=True)
+                self._sampler.start()
+                atexit.register(self.flush)
+        self._wake.set()
+
+    def _exit(self):
+        with self._lock:
+            self._active.pop(threading.get_ident(), None)
+        self._flush_if_due()
+
+    def _add_profile(self, name: str, profile: cProfile.Profile):
+        with self._lock:
+            if name in self._stats:
+                self._stats[name].add(profile)
+            else:
+                self._stats[name] = pstats.Stats(profile)
+        self._flush_if_due()
+
+    @staticmethod
+    def _stack(name: str, frame, root) -> str:
+        frames = []
+        while frame is not None and frame is not root:
+            frames.append(f'{frame.f_globals.get("__name__", "?")}.{frame.f_code.co_name}')
+            frame = frame.f_back
+        frames.append(name)
+        return ';'.join(reversed(frames))
+
+    def _sample(self):
+        while True:
+            self._wake.wait()
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                if not self._active:
+                    self._wake.clear()
+                    continue
+                for thread_id, (name, root) in self._active.items():
+                    if thread_id in frames:
+                        self._stacks[self._stack(name, frames[thread_id], root)] += 1
+            del frames
+
+    def _flush_if_due(self):
+        if time.monotonic() - self._flushed >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Write the collected profiles to the media storage"""
+        with self._lock:
+            self._flushed = time.monotonic()
+            stacks, self._stacks = self._stacks, Counter()
+            stats, self._stats = self._stats, {}
+
+        prefix = f'profiles/{timezone.now():%Y%m%d-%H%M%S}-{os.getpid()}'
+        try:
+            if stacks:
+                content = ''.join(f'{stack} {count}\n' for stack, count in sorted(stacks.items()))
+                name = default_storage.save(f'{prefix}.collapsed', ContentFile(content.encode()))
+                self.logger.info(f'Wrote {sum(stacks.values())} samples to {name}')
+            for handler, handler_stats in stats.items():
+                content = marshal.dumps(handler_stats.stats)
+                name = default_storage.save(f'{prefix}-{handler}.pstats', ContentFile(content))
+                self.logger.info(f'Wrote the profile of {handler} to {name}')
+        except OSError:
+            self.logger.exception('Could not write the profiles')
+
+
+profiler = Profiler()
@@ -0,0 +1,165 @@
+import itertools
+import logging
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+from telegram.error import RetryAfter
+
+# Bot API methods which count against the flood limits
+LIMITED_PREFIXES = ('send', 'forward', 'copy', 'editMessage')
+UNLIMITED_METHODS = {'sendChatAction'}
+
+
+class RateLimiter:
+    """Token buckets for the Bot API flood limits, shared by all processes of the host
+
+    There is one global bucket (`RATE_LIMIT_GLOBAL` messages per second) and one per chat (`RATE_LIMIT_CHAT` per
+    second for private chats, `RATE_LIMIT_GROUP` for groups and channels). The buckets live in a SQLite file
+    (`RATE_LIMIT_PATH`), so all bot processes together stay within the limits.
+
+    A bucket holds up to `RATE_LIMIT_BURST` tokens, so a handler can send a few replies at once. A call takes a token
+    of both buckets, the buckets may go negative, the caller then sleeps until its tokens are refilled. This way the
+    calls beyond the burst are spread at exactly the allowed rate. A chat can be paused, eg. after telegram
+    answered with a `RetryAfter`, the other chats are not affected.
+    """
+
+    def __init__(self, path: str = None, global_rate: float = None, chat_rate: float = None,
+                 group_rate: float = None, burst: float = None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self._path = path
+        self._global_rate = global_rate
+        self._chat_rate = chat_rate
+        self._group_rate = group_rate
+        self._burst = burst
+        self._local = threading.local()
+        # Shared by the threads, next() on a count is atomic
+        self._calls = itertools.count(1)
+
+    @property
+    def path(self) -> str:
+        return self._path or settings.RATE_LIMIT_PATH
+
+    @property
+    def global_rate(self) -> float:
+        return self._global_rate if self._global_rate is not None else getattr(settings, 'RATE_LIMIT_GLOBAL', 30)
+
+    @property
+    def burst(self) -> float:
+        return self._burst if self._burst is not None else getattr(settings, 'RATE_LIMIT_BURST', 3)
+
+    def chat_rate(self, chat_id: int) -> float:
+        if chat_id > 0:
+            return self._chat_rate if self._chat_rate is not None else getattr(settings, 'RATE_LIMIT_CHAT', 1)
+        return self._group_rate if self._group_rate is not None else getattr(settings, 'RATE_LIMIT_GROUP', 20 / 60)
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, '
+                               'updated REAL NOT NULL, paused_until REAL NOT NULL DEFAULT 0)')
+        return connection
+
+    def _take(self, key: str, rate: float, now: float) -> float:
+        """Take a token of the bucket, returns the seconds until it is available"""
+        row = self.connection.execute('SELECT tokens, updated, paused_until FROM buckets WHERE key = ?',
+                                      (key,)).fetchone()
+        burst = self.burst
+        tokens, updated, paused_until = row or (burst, now, 0)
+        tokens = min(burst, tokens + (now - updated) * rate) - 1
+        self.connection.execute('INSERT OR REPLACE INTO buckets (key, tokens, updated, paused_until) '
+                                'VALUES (?, ?, ?, ?)', (key, tokens, now, paused_until))
+        return max(-tokens / rate if tokens < 0 else 0, paused_until - now)
+
+    def reserve(self, chat_id: int = None) -> float:
+        """Take a token of the global bucket and the one of the chat, returns the seconds to wait before the call"""
+        now = time.time()
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            delay = self._take('global', self.global_rate, now)
+            if chat_id is not None:
+                delay = max(delay, self._take(f'chat:{chat_id}', self.chat_rate(chat_id), now))
+
+            if next(self._calls) % 1000 == 0:
+                # Full buckets of idle chats are the same as no bucket
+                connection.execute('DELETE FROM buckets WHERE updated < ? AND paused_until < ?', (now - 3600, now))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return delay
+
+    def acquire(self, chat_id: int = None) -> float:
+        """Wait until a call to the chat is allowed, returns the seconds waited"""
+        delay = self.reserve(chat_id)
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    def pause(self, chat_id: int or None, seconds: float):
+        """Do not allow calls to the chat (or any call without a chat) for `seconds`"""
+        key = 'global' if chat_id is None else f'chat:{chat_id}'
+        now = time.time()
+        self.connection.execute('INSERT INTO buckets (key, tokens, updated, paused_until) VALUES (?, 0, ?, ?) ON '
+                                'CONFLICT (key) DO UPDATE SET paused_until = MAX(paused_until, excluded.paused_until)',
+                                (key, now, now + seconds))
+
+    @staticmethod
+    def limited(method: str) -> bool:
+        return method.startswith(LIMITED_PREFIXES) and method not in UNLIMITED_METHODS
+
+    def call(self, method: str, data: dict or None, send):
+        """Run `send` once the call is allowed, retries it after a `RetryAfter` of telegram"""
+        chat_id = _chat_id(data)
+        retries = getattr(settings, 'RATE_LIMIT_RETRIES', 3)
+        for attempt in range(retries + 1):
+            self.acquire(chat_id)
+            try:
+                return send()
+            except RetryAfter as error:
+                self.pause(chat_id, error.retry_after)
+                if attempt == retries:
+                    raise
+                self.logger.warning(f'{method} to {chat_id} hit the flood limit, retry in {error.retry_after}s')
+
+    def instrument_request(self, request):
+        """Let the Bot API calls of a `telegram.utils.request.Request` wait for the rate limits"""
+        if getattr(request, '_rate_limited', False):
+            return request
+        post = request.post
+
+        def limited_post(url, data=None, *args, **kwargs):
+            method = url.rsplit('/', 1)[-1]
+            if not self.limited(method):
+                return post(url, data, *args, **kwargs)
+            return self.call(method, data, lambda: post(url, data, *args, **kwargs))
+
+        request.post = limited_post
+        request._rate_limited = True
+        return request
+
+    @staticmethod
+    def exempt(request):
+        """Never rate limit the request, eg. a fake api used by a benchmark"""
+        request._rate_limited = True
+        return request
+
+
+def _chat_id(data: dict or None) -> int or None:
+    try:
+        return int(data['chat_id'])
+    except (TypeError, KeyError, ValueError):
+        # No chat id or a @channelusername
+        return None
+
+
+def enabled() -> bool:
+    return getattr(settings, 'RATE_LIMIT_ENABLED', True)
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,97 @@
+import atexit
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from bot.models.promo_group import TelegramUser
+
+STATE_FIELDS = ['menu', 'current_group', 'tmp_data']
+
+
+class StateBackend:
+    """Storage of the conversation state of the users: their menu, current group and scratch data
+
+    The state is read from and written to the `TelegramUser` instance. Changes made while an update is dispatched are
+    collected by the `UpdateContext` and saved once when the update is done.
+    """
+
+    def load(self, user: TelegramUser) -> TelegramUser:
+        """Apply the stored state to a user loaded from the database"""
+        return user
+
+    def save(self, user: TelegramUser, fields: Iterable[str]):
+        raise NotImplementedError
+
+
+class DatabaseStateBackend(StateBackend):
+    """Keep the state in the `TelegramUser` table"""
+
+    def save(self, user: TelegramUser, fields: Iterable[str]):
+        user.save(update_fields=list(fields))
+
+
+class MemoryStateBackend(StateBackend):
+    """Keep the state of the last `CONVERSATION_STATE_CACHE_SIZE` users in memory
+
+    The state is only written to the database when a user is evicted. This only works if the updates of a user are
+    always handled by the same process, like they are with the update queue (`UPDATE_QUEUE_WORKERS`). The admin shows
+    the state of the database.
+    """
+
+    def __init__(self, max_size: int = None):
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._states: Dict[int, dict] = OrderedDict()
+        atexit.register(self.flush)
+
+    @property
+    def max_size(self) -> int:
+        return self._max_size if self._max_size is not None else getattr(settings,
+                                                                         'CONVERSATION_STATE_CACHE_SIZE', 10000)
+
+    def load(self, user: TelegramUser) -> TelegramUser:
+        with self._lock:
+            state = self._states.get(user.id)
+            if state is not None:
+                self._states.move_to_end(user.id)
+        for field, value in (state or {}).items():
+            setattr(user, field, value)
+        return user
+
+    def save(self, user: TelegramUser, fields: Iterable[str]):
+        values = {}
+        for field in fields:
+            attribute = 'current_group_id' if field == 'current_group' else field
+            values[attribute] = getattr(user, attribute)
+
+        evicted = []
+        with self._lock:
+            self._states.setdefault(user.id, {}).update(values)
+            self._states.move_to_end(user.id)
+            while len(self._states) > self.max_size:
+                evicted.append(self._states.popitem(last=False))
+
+        for user_id, state in evicted:
+            TelegramUser.objects.filter(id=user_id).update(**state)
+
+    def flush(self):
+        """Write all states to the database"""
+        with self._lock:
+            states, self._states = self._states, OrderedDict()
+        for user_id, state in states.items():
+            TelegramUser.objects.filter(id=user_id).update(**state)
+
+
+_backend: StateBackend = None
+
+
+def state_backend() -> StateBackend:
+    """The `CONVERSATION_STATE_BACKEND`"""
+    global _backend
+    if _backend is None:
+        path = getattr(settings, 'CONVERSATION_STATE_BACKEND', 'bot.utils.state.DatabaseStateBackend')
+        _backend = import_string(path)()
+    return _backend
@@ -1,5 +1,71 @@
+import json
+import logging
+
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.http import Http404, HttpResponse, JsonResponse
 from django.shortcuts import redirect
+from django.utils.crypto import constant_time_compare
+from django.views.decorators.csrf import csrf_exempt
+from django_telegrambot import views as telegrambot_views
+from django_telegrambot.apps import DjangoTelegramBot
+from telegram import Update
+
+from bot.ingest import update_deduplicator, update_key, update_queue, update_workers
+from bot.utils import metrics
+
+logger = logging.getLogger('webhook')
 
 
 def redirec_to_admin_view(request):
     return redirect('/admin')
+
+
+@csrf_exempt
+def webhook(request, bot_token):
+    """Put the update into the `UpdateQueue` and acknowledge it right away
+
+    The update is handled by the `UpdateWorkers` afterwards. Without workers (`UPDATE_QUEUE_WORKERS = 0`) the update
+    is handled in the request like before. Updates telegram delivers again are skipped, see `UpdateDeduplicator`. The
+    check is done before the update is queued, so the queued updates are still handled again after a crash.
+    """
+    bot = DjangoTelegramBot.getBot(bot_id=bot_token, safe=False)
+    if bot is None:
+        logger.warning(f'Request for not found token: {bot_token}')
+        return JsonResponse({})
+
+    try:
+        data = request.body.decode('utf-8')
+        update = Update.de_json(json.loads(data), bot)
+    except (ValueError, TypeError, KeyError):
+        logger.warning(f'Bot {bot.username} received invalid request: {request!r}')
+        return JsonResponse({})
+
+    if update_deduplicator.is_duplicate(bot_token, update.update_id):
+        logger.info(f'Skipped redelivered update {update.update_id}')
+        return JsonResponse({})
+
+    if not getattr(settings, 'UPDATE_QUEUE_WORKERS', 8):
+        return telegrambot_views.webhook(request, bot_token)
+
+    update_queue.put(bot_token, data, update_key(update))
+    update_workers.start()
+    return JsonResponse({})
+
+
+def metrics_access(request) -> bool:
+    """Whether the request comes from a `METRICS_ALLOWED_IPS` address or carries the `METRICS_TOKEN`"""
+    if request.META.get('REMOTE_ADDR') in getattr(settings, 'METRICS_ALLOWED_IPS', ['127.0.0.1', '::1']):
+        return True
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    return bool(token) and constant_time_compare(authorization, f'Bearer {token}')
+
+
+def metrics_view(request):
+    """The metrics of this process in the Prometheus text format"""
+    if not metrics.enabled():
+        raise Http404()
+    if not metrics_access(request):
+        raise PermissionDenied()
+    return HttpResponse(metrics.metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')